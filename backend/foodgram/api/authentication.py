@@ -0,0 +1,109 @@
+import hashlib
+import pickle
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+from rest_framework.authentication import TokenAuthentication
+from rest_framework.authtoken.models import Token
+from rest_framework.exceptions import AuthenticationFailed
+
+from .replicas import replica_state
+
+
+class TokenCache:
+    # Токен -> пользователь. По умолчанию LRU в памяти процесса: сброс
+    # из сигналов виден только текущему воркеру, остальные узнают об
+    # изменениях по истечении ttl. Если задан AUTH_TOKEN_CACHE_ALIAS,
+    # записи хранятся в общем кеше Django и сбрасываются сразу для всех.
+    # Объекты хранятся сериализованными, чтобы запросы не делили
+    # один экземпляр пользователя.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._entries = OrderedDict()
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'AUTH_TOKEN_CACHE_TTL', 60)
+
+    @property
+    def max_size(self):
+        return getattr(settings, 'AUTH_TOKEN_CACHE_SIZE', 1024)
+
+    @property
+    def backend(self):
+        alias = getattr(settings, 'AUTH_TOKEN_CACHE_ALIAS', None)
+        return caches[alias] if alias else None
+
+    def make_key(self, key):
+        return 'api:auth:' + hashlib.sha256(key.encode()).hexdigest()
+
+    def get(self, key):
+        backend = self.backend
+        if backend is not None:
+            return backend.get(self.make_key(key))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            data, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+        return pickle.loads(data)
+
+    def set(self, key, token):
+        backend = self.backend
+        if backend is not None:
+            backend.set(self.make_key(key), token, self.ttl)
+            return
+        data = pickle.dumps(token, pickle.HIGHEST_PROTOCOL)
+        with self._lock:
+            self._entries[key] = (data, time.monotonic() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, *keys):
+        backend = self.backend
+        if backend is not None:
+            backend.delete_many([self.make_key(key) for key in keys])
+            return
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def invalidate_on_commit(self, *keys):
+        if keys:
+            transaction.on_commit(lambda: self.invalidate(*keys))
+
+    def invalidate_user(self, user_id):
+        self.invalidate_on_commit(*Token.objects.filter(
+            user_id=user_id).values_list('key', flat=True))
+
+
+token_cache = TokenCache()
+
+
+class CachedTokenAuthentication(TokenAuthentication):
+    # Замена TokenAuthentication без запроса к базе на каждый вызов API.
+
+    def authenticate_credentials(self, key):
+        token = token_cache.get(key)
+        if token is None:
+            try:
+                user, token = super().authenticate_credentials(key)
+            except AuthenticationFailed:
+                # Только что выданный токен мог еще не дойти до реплики.
+                if replica_state.replica is None:
+                    raise
+                replica_state.pin()
+                user, token = super().authenticate_credentials(key)
+            token_cache.set(key, token)
+            return user, token
+        return token.user, token
@@ -0,0 +1,220 @@
+import random
+import statistics
+import time
+import tracemalloc
+
+from django.contrib.auth.hashers import make_password
+from django.db import connection
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from recipes.models import (Favorite, Ingredient, IngredientAmount, Recipe,
+                            ShoppingCart, ShoppingListItem, Tag, TagRecipe)
+from recipes.similarity import rebuild_similar_recipes
+from users.models import CustomUser, Follow
+
+# Абсолютный запас, чтобы шум на быстрых эндпоинтах не считался регрессией.
+ABSOLUTE_SLACK = {'p95_ms': 2.0, 'peak_kb': 64.0}
+IMAGE = (
+    'data:image/png;base64,iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAYAAAAfFcSJAAAA'
+    'DUlEQVR42mNk+M9QDwADhgGAWjR9awAAAABJRU5ErkJggg=='
+)
+
+
+def seed(users=50, recipes=500, ingredients=2000, tags=10,
+         ingredients_per_recipe=8, favorites=20, carts=10, follows=10,
+         seed_value=0):
+    rnd = random.Random(seed_value)
+    password = make_password('benchmark-password')
+    CustomUser.objects.bulk_create(
+        (CustomUser(email=f'bench{i}@example.org', username=f'bench{i}',
+                    first_name='Bench', last_name=str(i), password=password)
+         for i in range(users)),
+    )
+    user_ids = list(CustomUser.objects.values_list('id', flat=True))
+    Tag.objects.bulk_create(
+        Tag(name=f'Тег {i}', slug=f'tag-{i}', color=f'#{i:06x}')
+        for i in range(tags)
+    )
+    Tag.objects.assign_bits()
+    tag_ids = list(Tag.objects.values_list('id', flat=True))
+    Ingredient.objects.bulk_create(
+        (Ingredient(name=f'ингредиент {i}', measurement_unit='г')
+         for i in range(ingredients)),
+    )
+    ingredient_ids = list(Ingredient.objects.values_list('id', flat=True))
+    Recipe.objects.bulk_create(
+        (Recipe(author_id=rnd.choice(user_ids), name=f'Рецепт {i}',
+                text='Описание рецепта', cooking_time=rnd.randint(5, 120),
+                image='image/benchmark.png')
+         for i in range(recipes)),
+    )
+    recipe_ids = list(Recipe.objects.values_list('id', flat=True))
+    TagRecipe.objects.bulk_create(
+        (TagRecipe(recipe_id=recipe_id, tag_id=tag_id)
+         for recipe_id in recipe_ids
+         for tag_id in rnd.sample(tag_ids, min(2, len(tag_ids)))),
+    )
+    IngredientAmount.objects.bulk_create(
+        (IngredientAmount(recipe_id=recipe_id, ingredient_id=ingredient_id,
+                          amount=rnd.randint(1, 500))
+         for recipe_id in recipe_ids
+         for ingredient_id in rnd.sample(
+             ingredient_ids,
+             min(ingredients_per_recipe, len(ingredient_ids)))),
+    )
+    for model, per_user in ((Favorite, favorites), (ShoppingCart, carts)):
+        model.objects.bulk_create(
+            (model(user_id=user_id, recipe_id=recipe_id)
+             for user_id in user_ids
+             for recipe_id in rnd.sample(
+                 recipe_ids, min(per_user, len(recipe_ids)))),
+        )
+    Follow.objects.bulk_create(
+        (Follow(user_id=user_id, author_id=author_id)
+         for user_id in user_ids
+         for author_id in rnd.sample(
+             [pk for pk in user_ids if pk != user_id],
+             min(follows, len(user_ids) - 1))),
+    )
+    ShoppingListItem.objects.rebuild()
+    Recipe.objects.recount()
+    Recipe.objects.update_derived_fields()
+    CustomUser.objects.recount()
+    rebuild_similar_recipes()
+    Recipe.objects.update_trending_scores()
+    return {
+        'user': CustomUser.objects.get(pk=user_ids[0]),
+        'recipe_ids': recipe_ids,
+        'ingredient_ids': ingredient_ids,
+        'tag': Tag.objects.first(),
+    }
+
+
+def get_scenarios(data):
+    user = data['user']
+    recipe_id = data['recipe_ids'][len(data['recipe_ids']) // 2]
+    recipes = reverse('recipes-list')
+    recipe_body = {
+        'name': 'Новый рецепт',
+        'text': 'Описание',
+        'cooking_time': 10,
+        'image': IMAGE,
+        'tags': [data['tag'].id],
+        'ingredients': [
+            {'id': ingredient_id, 'amount': 10}
+            for ingredient_id in data['ingredient_ids'][:10]
+        ],
+    }
+    return [
+        ('recipes_anonymous', None, 'get', f'{recipes}?limit=6', None),
+        ('recipes_page_6', user, 'get', f'{recipes}?limit=6', None),
+        ('recipes_page_50', user, 'get', f'{recipes}?limit=50', None),
+        ('recipes_deep_page', user, 'get',
+         f'{recipes}?limit=6&page={max(len(data["recipe_ids"]) // 6, 1)}',
+         None),
+        ('recipes_cursor', user, 'get',
+         f'{recipes}?limit=50&pagination=cursor', None),
+        ('recipes_tag_filter', user, 'get',
+         f'{recipes}?limit=50&tags={data["tag"].slug}', None),
+        ('recipes_search', user, 'get',
+         f'{recipes}?limit=6&search=ингредиент 1', None),
+        ('recipes_tags_all', user, 'get',
+         f'{recipes}?limit=50&tags={data["tag"].slug}&tags=tag-1'
+         '&tags_mode=all', None),
+        ('recipes_trending', user, 'get',
+         f'{recipes}?limit=6&ordering=trending', None),
+        ('recipes_favorited', user, 'get',
+         f'{recipes}?limit=50&is_favorited=1', None),
+        ('recipes_match', user, 'get',
+         f'{reverse("recipes-match")}?limit=6&ingredients='
+         f'{",".join(map(str, data["ingredient_ids"][:20]))}', None),
+        ('recipe_detail', user, 'get',
+         reverse('recipes-detail', args=[recipe_id]), None),
+        ('recipe_similar', user, 'get',
+         reverse('recipes-similar', args=[recipe_id]), None),
+        ('recipe_create', user, 'post', recipes, recipe_body),
+        ('tags', None, 'get', reverse('tag-list'), None),
+        ('ingredients_search', user, 'get',
+         f'{reverse("ingredients-list")}?name=ингредиент 1', None),
+        ('users', user, 'get', f'{reverse("users-list")}?limit=50', None),
+        ('subscriptions', user, 'get',
+         f'{reverse("subscriptions")}?limit=6&recipes_limit=3', None),
+        ('download_shopping_cart', user, 'get',
+         reverse('recipes-download-shopping-cart'), None),
+        ('favorite_toggle', user, 'toggle',
+         reverse('favorite', args=[recipe_id]), None),
+        ('shopping_cart_batch', user, 'toggle',
+         reverse('shopping_cart_batch'),
+         {'recipes': data['recipe_ids'][:20]}),
+    ]
+
+
+def make_client(user):
+    client = APIClient()
+    if user is not None:
+        token, _ = Token.objects.get_or_create(user=user)
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+    return client
+
+
+def call(client, method, path, body):
+    if method == 'toggle':
+        response = client.post(path, body, format='json')
+        client.delete(path, body, format='json')
+    elif method == 'post':
+        response = client.post(path, body, format='json')
+    else:
+        response = client.get(path)
+    if getattr(response, 'streaming', False):
+        b''.join(response.streaming_content)
+    return response
+
+
+def run_scenario(client, method, path, body, iterations=20, warmup=2):
+    for _ in range(warmup):
+        call(client, method, path, body)
+    timings = []
+    for _ in range(iterations):
+        started = time.perf_counter()
+        response = call(client, method, path, body)
+        timings.append((time.perf_counter() - started) * 1000)
+    with CaptureQueriesContext(connection) as queries:
+        call(client, method, path, body)
+    query_count = len(queries.captured_queries)
+    tracemalloc.start()
+    call(client, method, path, body)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    timings.sort()
+    return {
+        'status': response.status_code,
+        'p50_ms': round(statistics.median(timings), 2),
+        'p95_ms': round(timings[max(int(len(timings) * 0.95) - 1, 0)], 2),
+        'queries': query_count,
+        'peak_kb': round(peak / 1024, 1),
+    }
+
+
+def compare(results, baseline, tolerance):
+    failures = []
+    for name, result in results.items():
+        expected = baseline.get(name)
+        if expected is None:
+            continue
+        if result['queries'] > expected['queries']:
+            failures.append(
+                f'{name}: запросов {result["queries"]}, '
+                f'было {expected["queries"]}'
+            )
+        for metric, slack in ABSOLUTE_SLACK.items():
+            limit = max(expected[metric] * (1 + tolerance),
+                        expected[metric] + slack)
+            if result[metric] > limit:
+                failures.append(
+                    f'{name}: {metric} {result[metric]}, '
+                    f'допустимо {limit:.1f}'
+                )
+    return failures
@@ -0,0 +1,143 @@
+import hashlib
+import json
+import time
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.utils.cache import patch_vary_headers
+from django.utils.http import (http_date, parse_etags, parse_http_date_safe,
+                               quote_etag)
+from rest_framework import status
+from rest_framework.response import Response
+
+RECIPES = 'recipes'
+RECIPES_DETAIL = 'recipes-detail'
+TAGS = 'tags'
+INGREDIENTS = 'ingredients'
+
+
+def recipe_namespace(recipe_id):
+    return f'recipe:{recipe_id}'
+
+
+class ResponseCache:
+    # Кешируются данные ответа, а не байты: рендеринг по-прежнему
+    # выполняется DRF, но без запросов к базе и сериализации.
+    # Каждый namespace хранит версию и время последнего изменения,
+    # инвалидация просто записывает новую версию. Версии случайные:
+    # счетчик после вытеснения ключа из кеша начался бы заново и
+    # вернул бы в оборот ответы, закешированные до инвалидации.
+
+    @property
+    def backend(self):
+        return caches[getattr(settings, 'API_CACHE_ALIAS', 'default')]
+
+    @property
+    def timeout(self):
+        return getattr(settings, 'API_CACHE_TIMEOUT', 600)
+
+    def get_namespaces(self, names):
+        keys = {f'api:ns:{name}': name for name in names}
+        found = self.backend.get_many(list(keys))
+        missing = {
+            key: self.new_version() for key in keys if key not in found
+        }
+        if missing:
+            self.backend.set_many(missing, None)
+            found.update(missing)
+        return [found[key] for key in keys]
+
+    def new_version(self):
+        return uuid.uuid4().hex, time.time()
+
+    def invalidate(self, *names):
+        self.backend.set_many(
+            {f'api:ns:{name}': self.new_version() for name in names}, None)
+
+    def invalidate_on_commit(self, *names):
+        transaction.on_commit(lambda: self.invalidate(*names))
+
+    def make_key(self, names, visibility, path):
+        namespaces = self.get_namespaces(names)
+        versions = ':'.join(
+            f'{name}={version}'
+            for name, (version, _) in zip(names, namespaces)
+        )
+        digest = hashlib.md5(
+            f'{versions}|{visibility}|{path}'.encode()).hexdigest()
+        last_modified = max(modified for _, modified in namespaces)
+        return f'api:response:{digest}', last_modified
+
+    def get(self, key):
+        return self.backend.get(key)
+
+    def set(self, key, data, last_modified):
+        content = json.dumps(data, cls=DjangoJSONEncoder, sort_keys=True)
+        entry = {
+            'data': data,
+            'etag': quote_etag(hashlib.md5(content.encode()).hexdigest()),
+            'last_modified': int(last_modified),
+        }
+        self.backend.set(key, entry, self.timeout)
+        return entry
+
+    def is_not_modified(self, request, entry):
+        if_none_match = request.META.get('HTTP_IF_NONE_MATCH')
+        if if_none_match:
+            etags = parse_etags(if_none_match)
+            return '*' in etags or entry['etag'] in etags
+        if_modified_since = parse_http_date_safe(
+            request.META.get('HTTP_IF_MODIFIED_SINCE', ''))
+        return (if_modified_since is not None
+                and entry['last_modified'] <= if_modified_since)
+
+    def respond(self, request, entry):
+        if self.is_not_modified(request, entry):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = Response(entry['data'])
+        response['ETag'] = entry['etag']
+        response['Last-Modified'] = http_date(entry['last_modified'])
+        patch_vary_headers(response, ('Authorization',))
+        return response
+
+
+response_cache = ResponseCache()
+
+
+class CachedResponseMixin:
+    cache_namespaces = ()
+    cache_detail_namespaces = ()
+
+    def get_cache_visibility(self):
+        return 'public'
+
+    def get_cache_namespaces(self):
+        if self.action == 'retrieve':
+            return list(self.cache_detail_namespaces)
+        return list(self.cache_namespaces)
+
+    def cached_response(self, handler, request, *args, **kwargs):
+        visibility = self.get_cache_visibility()
+        if visibility is None:
+            return handler(request, *args, **kwargs)
+        key, last_modified = response_cache.make_key(
+            self.get_cache_namespaces(), visibility,
+            request.get_full_path())
+        entry = response_cache.get(key)
+        if entry is None:
+            response = handler(request, *args, **kwargs)
+            if response.status_code != status.HTTP_200_OK:
+                return response
+            entry = response_cache.set(key, response.data, last_modified)
+        return response_cache.respond(request, entry)
+
+    def list(self, request, *args, **kwargs):
+        return self.cached_response(super().list, request, *args, **kwargs)
+
+    def retrieve(self, request, *args, **kwargs):
+        return self.cached_response(
+            super().retrieve, request, *args, **kwargs)
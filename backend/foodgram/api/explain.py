@@ -0,0 +1,93 @@
+import re
+
+from django.db import connections
+from django.http import HttpRequest
+
+from recipes.models import Ingredient, Recipe, Tag
+from users.managers import recipes_preview
+from users.models import CustomUser
+from .filters import IngredientSearchFilter, RecipeFilterSet
+from .utils import shopping_list_items
+
+PAGE_SIZE = 6
+SEQ_SCAN = {
+    'postgresql': re.compile(r'Seq Scan on (\w+)'),
+    # «SCAN t USING INDEX» и виртуальные таблицы FTS полным
+    # просмотром не считаем. Просмотр в порядке первичного ключа с LIMIT
+    # (лента без фильтров) SQLite тоже показывает как SCAN, хотя он
+    # останавливается на первой странице.
+    'sqlite': re.compile(
+        r'\bSCAN (?:TABLE )?(\w+)(?!.*\b(?:USING|VIRTUAL)\b)'),
+}
+
+
+def recipe_filter(user, data):
+    request = HttpRequest()
+    request.user = user
+    return RecipeFilterSet(
+        data, queryset=Recipe.objects.for_list(user), request=request
+    ).qs[:PAGE_SIZE]
+
+
+def get_hot_paths(user):
+    """Запросы, которые выполняют самые нагруженные эндпоинты.
+
+    Собираются теми же методами, что и во вьюсетах, на образцах
+    реальных данных: первом рецепте, его авторе, теге и ингредиенте.
+    """
+    recipe = Recipe.objects.order_by('id').first()
+    tag = Tag.objects.order_by('id').first()
+    ingredient = Ingredient.objects.order_by('id').first()
+    author_ids = list(user.follower.values_list(
+        'author_id', flat=True)[:PAGE_SIZE])
+    word = ingredient.name.split()[0] if ingredient else 'а'
+    paths = [
+        ('recipes_feed', Recipe.objects.for_list(user)[:PAGE_SIZE]),
+        ('recipes_author', recipe_filter(
+            user, {'author': [recipe.author_id]} if recipe else {})),
+        ('recipes_tags', recipe_filter(
+            user, {'tags': [tag.slug]} if tag else {})),
+        ('recipes_tags_all', recipe_filter(
+            user, {'tags': [tag.slug], 'tags_mode': 'all'} if tag else {})),
+        ('recipes_favorited', recipe_filter(user, {'is_favorited': 'true'})),
+        ('recipes_in_shopping_cart', recipe_filter(
+            user, {'is_in_shopping_cart': 'true'})),
+        ('recipes_search', recipe_filter(user, {'search': word})),
+        ('recipes_trending', recipe_filter(user, {'ordering': 'trending'})),
+        ('recipes_similar', Recipe.objects.for_list(user).filter(
+            similar_to__recipe_id=recipe.pk if recipe else 0
+        ).order_by('-similar_to__score', 'id')[:PAGE_SIZE]),
+        ('download_shopping_cart', shopping_list_items(user)),
+        ('ingredients_search', IngredientSearchFilter(
+            {'name': word}, queryset=Ingredient.objects.all()).qs),
+        ('subscriptions', user.follower.with_recipes()[:PAGE_SIZE]),
+        ('subscriptions_recipes', recipes_preview(3).queryset.filter(
+            author_id__in=author_ids or [user.pk])),
+    ]
+    return paths
+
+
+def seq_scans(plan, vendor):
+    pattern = SEQ_SCAN.get(vendor)
+    if pattern is None:
+        return []
+    return sorted({
+        match.group(1)
+        for line in plan.splitlines()
+        for match in [pattern.search(line)] if match
+    })
+
+
+def explain_hot_paths(user, analyze=False, using='default'):
+    vendor = connections[using].vendor
+    options = {'analyze': True} if analyze and vendor == 'postgresql' else {}
+    for name, queryset in get_hot_paths(user):
+        plan = queryset.using(using).explain(**options)
+        yield name, plan, seq_scans(plan, vendor)
+
+
+def get_sample_user(pk=None):
+    users = CustomUser.objects.order_by('id')
+    if pk is not None:
+        return users.filter(pk=pk).first()
+    return users.first()
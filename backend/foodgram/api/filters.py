@@ -2,8 +2,7 @@ import django_filters
 from django_filters.rest_framework.filters import BooleanFilter
 from django_filters import FilterSet, filters, rest_framework
 
-from recipes.models import (Favorite, Ingredient, Recipe,
-                            ShoppingCart, Tag)
+from recipes.models import Favorite, Ingredient, Recipe, ShoppingCart, Tag
 from users.models import CustomUser
 
 
@@ -17,7 +16,8 @@ class RecipeFilterSet(rest_framework.FilterSet):
     tags = django_filters.ModelMultipleChoiceFilter(
         field_name='tags__slug',
         to_field_name='slug',
-        queryset=Tag.objects.all()
+        queryset=Tag.objects.all(),
+        method='filter_tags',
     )
 
     is_favorited = BooleanFilter(
@@ -30,19 +30,50 @@ class RecipeFilterSet(rest_framework.FilterSet):
         method='filter_is_in_shopping_cart',
     )
 
+    search = filters.CharFilter(method='filter_search')
+
+    ordering = filters.ChoiceFilter(
+        choices=(('trending', 'Популярные сейчас'),),
+        method='filter_ordering',
+    )
+
     class Meta:
         model = Recipe
         fields = ['tags', 'is_favorited', 'author']
 
-    def filter_is_favorited(self, queryset, name, tags):
-        user = self.request.user
-        fav_recipes = Favorite.objects.filter(user=user).values('recipe')
-        return queryset.filter(id__in=fav_recipes)
+    def filter_tags(self, queryset, name, value):
+        # ?tags_mode=all - рецепты со всеми выбранными тегами,
+        # по умолчанию - хотя бы с одним.
+        return queryset.with_tags(
+            value, match_all=self.data.get('tags_mode') == 'all')
+
+    def filter_user_recipes(self, queryset, model):
+        # IN по рецептам пользователя, а не фильтр по аннотации
+        # EXISTS(...) = true: её база проверяет для каждого рецепта
+        # по порядку выдачи, полным просмотром таблицы рецептов.
+        user = getattr(self.request, 'user', None)
+        if user is None or user.is_anonymous:
+            return queryset.none()
+        return queryset.filter(pk__in=model.objects.filter(
+            user=user).values('recipe_id'))
+
+    def filter_is_favorited(self, queryset, name, value):
+        if not value:
+            return queryset
+        return self.filter_user_recipes(queryset, Favorite)
+
+    def filter_is_in_shopping_cart(self, queryset, name, value):
+        if not value:
+            return queryset
+        return self.filter_user_recipes(queryset, ShoppingCart)
+
+    def filter_search(self, queryset, name, value):
+        if not value.strip():
+            return queryset
+        return queryset.search(value)
 
-    def filter_is_in_shopping_cart(self, queryset, name, tags):
-        user = self.request.user
-        recipes = ShoppingCart.objects.filter(user=user).values('recipe')
-        return queryset.filter(id__in=recipes)
+    def filter_ordering(self, queryset, name, value):
+        return queryset.trending()
 
 
 class IngredientSearchFilter(FilterSet):
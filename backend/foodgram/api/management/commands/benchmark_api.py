@@ -0,0 +1,94 @@
+import json
+import logging
+import tempfile
+
+from django.core.cache import caches
+from django.core.management.base import BaseCommand, CommandError
+from django.test.utils import (override_settings, setup_databases,
+                               setup_test_environment,
+                               teardown_databases, teardown_test_environment)
+
+from api import benchmark
+
+
+class Command(BaseCommand):
+    help = ('Замеряет задержку, число запросов к базе и пиковую память '
+            'эндпоинтов API на синтетических данных во временной базе')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50)
+        parser.add_argument('--recipes', type=int, default=500)
+        parser.add_argument('--ingredients', type=int, default=2000)
+        parser.add_argument('--tags', type=int, default=10)
+        parser.add_argument('--iterations', type=int, default=20)
+        parser.add_argument(
+            '--only', nargs='+', help='Запустить только указанные сценарии')
+        parser.add_argument(
+            '--baseline', help='JSON с прошлыми результатами для сравнения')
+        parser.add_argument(
+            '--save', help='Сохранить результаты в JSON файл')
+        parser.add_argument(
+            '--tolerance', type=float, default=0.25,
+            help='Допустимый рост p95 и памяти относительно baseline')
+        parser.add_argument(
+            '--keepdb', action='store_true',
+            help='Не удалять временную базу после замеров')
+
+    def handle(self, *args, **options):
+        # Построчный лог каждого запроса только мешает читать результаты.
+        logging.getLogger('api.sql').setLevel(logging.WARNING)
+        setup_test_environment()
+        old_config = setup_databases(
+            verbosity=0, interactive=False, keepdb=options['keepdb'])
+        try:
+            with tempfile.TemporaryDirectory() as media_root, \
+                    override_settings(MEDIA_ROOT=media_root,
+                                      RECIPE_IMAGE_ASYNC=False,
+                                      THROTTLE_ENABLED=False):
+                results = self.run_benchmarks(options)
+        finally:
+            teardown_databases(
+                old_config, verbosity=0, keepdb=options['keepdb'])
+            teardown_test_environment()
+        if options['save']:
+            with open(options['save'], 'w', encoding='utf-8') as file:
+                json.dump(results, file, ensure_ascii=False, indent=2)
+        if options['baseline']:
+            with open(options['baseline'], encoding='utf-8') as file:
+                baseline = json.load(file)
+            failures = benchmark.compare(
+                results, baseline, options['tolerance'])
+            if failures:
+                raise CommandError(
+                    'Регрессия производительности:\n' + '\n'.join(failures))
+            self.stdout.write(self.style.SUCCESS('Регрессий не найдено'))
+
+    def run_benchmarks(self, options):
+        caches['default'].clear()
+        data = benchmark.seed(
+            users=options['users'],
+            recipes=options['recipes'],
+            ingredients=options['ingredients'],
+            tags=options['tags'],
+        )
+        clients = {}
+        results = {}
+        self.stdout.write(
+            f'{"сценарий":<24}{"код":>5}{"p50, мс":>10}{"p95, мс":>10}'
+            f'{"запросы":>9}{"память, КБ":>12}'
+        )
+        for name, user, method, path, body in benchmark.get_scenarios(data):
+            if options['only'] and name not in options['only']:
+                continue
+            if user not in clients:
+                clients[user] = benchmark.make_client(user)
+            result = benchmark.run_scenario(
+                clients[user], method, path, body,
+                iterations=options['iterations'])
+            results[name] = result
+            self.stdout.write(
+                f'{name:<24}{result["status"]:>5}{result["p50_ms"]:>10}'
+                f'{result["p95_ms"]:>10}{result["queries"]:>9}'
+                f'{result["peak_kb"]:>12}'
+            )
+        return results
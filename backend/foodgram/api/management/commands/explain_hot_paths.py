@@ -0,0 +1,48 @@
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
+
+from api.explain import explain_hot_paths, get_sample_user
+
+
+class Command(BaseCommand):
+    help = ('Выполняет EXPLAIN для запросов основных эндпоинтов API '
+            'и сообщает о полных просмотрах таблиц')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', type=int,
+            help='id пользователя, от имени которого строятся запросы')
+        parser.add_argument(
+            '--analyze', action='store_true',
+            help='EXPLAIN ANALYZE (только PostgreSQL, запросы выполняются)')
+        parser.add_argument(
+            '--plans', action='store_true', help='Печатать планы целиком')
+        parser.add_argument(
+            '--strict', action='store_true',
+            help='Завершиться с ошибкой, если есть полные просмотры')
+        parser.add_argument('--database', default='default')
+
+    def handle(self, *args, **options):
+        user = get_sample_user(options['user'])
+        if user is None:
+            raise CommandError('В базе нет пользователей для примера')
+        vendor = connections[options['database']].vendor
+        if vendor not in ('postgresql', 'sqlite'):
+            self.stderr.write(
+                f'Полные просмотры для {vendor} не распознаются, '
+                'выводятся только планы')
+            options['plans'] = True
+        found = []
+        for name, plan, tables in explain_hot_paths(
+                user, options['analyze'], options['database']):
+            if tables:
+                found.append(name)
+                self.stdout.write(self.style.WARNING(
+                    f'{name}: полный просмотр {", ".join(tables)}'))
+            else:
+                self.stdout.write(f'{name}: ok')
+            if options['plans']:
+                self.stdout.write(plan + '\n')
+        if found and options['strict']:
+            raise CommandError(
+                f'Полные просмотры таблиц в {len(found)} запросах')
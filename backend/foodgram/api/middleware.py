@@ -0,0 +1,165 @@
+import json
+import logging
+import re
+import time
+from collections import Counter
+from contextlib import ExitStack
+
+from django.conf import settings
+from django.db import connections
+from rest_framework.permissions import SAFE_METHODS
+
+from .replicas import get_replicas, replica_state
+
+logger = logging.getLogger('api.sql')
+
+STRING_LITERAL = re.compile(r"'(?:[^']|'')*'")
+NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+VALUE_LIST = re.compile(r'\(\s*(?:\?|%s)(?:\s*,\s*(?:\?|%s))*\s*\)')
+WHITESPACE = re.compile(r'\s+')
+
+
+class QueryBudgetExceeded(AssertionError):
+    pass
+
+
+def fingerprint(sql):
+    sql = STRING_LITERAL.sub('?', sql)
+    sql = NUMBER.sub('?', sql)
+    sql = VALUE_LIST.sub('(...)', sql)
+    return WHITESPACE.sub(' ', sql).strip()
+
+
+class QueryStats:
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+        self.fingerprints = Counter()
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - started
+            self.count += 1
+            self.fingerprints[fingerprint(sql)] += 1
+
+    def repeated(self, threshold):
+        return [
+            {'sql': sql[:300], 'count': count}
+            for sql, count in self.fingerprints.most_common()
+            if count >= threshold
+        ]
+
+
+def get_query_budget(view_func, method):
+    view = getattr(view_func, 'cls', view_func)
+    budget = getattr(view, 'query_budget', None)
+    if isinstance(budget, dict):
+        actions = getattr(view_func, 'actions', None) or {}
+        budget = budget.get(actions.get(method.lower()))
+    if budget is None:
+        budget = getattr(settings, 'SQL_QUERY_BUDGET', None)
+    return budget
+
+
+class QueryInstrumentationMiddleware:
+    # Запросы, выполненные при отдаче StreamingHttpResponse,
+    # происходят уже после middleware и здесь не учитываются.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        stats = QueryStats()
+        request.query_budget = None
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(stats))
+            response = self.get_response(request)
+        db_ms = stats.duration * 1000
+        repeated = stats.repeated(
+            getattr(settings, 'SQL_N_PLUS_ONE_THRESHOLD', 5))
+        budget = request.query_budget
+        over_budget = budget is not None and stats.count > budget
+        timing = f'db;dur={db_ms:.2f};desc="{stats.count} queries"'
+        if response.has_header('Server-Timing'):
+            timing = f'{response["Server-Timing"]}, {timing}'
+        response['Server-Timing'] = timing
+        record = {
+            'method': request.method,
+            'path': request.path,
+            'status': response.status_code,
+            'queries': stats.count,
+            'db_ms': round(db_ms, 2),
+            'budget': budget,
+            'repeated': repeated,
+        }
+        level = logging.WARNING if repeated or over_budget else logging.INFO
+        logger.log(level, json.dumps(record, ensure_ascii=False))
+        strict = getattr(settings, 'SQL_INSTRUMENTATION_STRICT', False)
+        if strict and over_budget:
+            raise QueryBudgetExceeded(
+                f'{request.method} {request.path}: {stats.count} запросов '
+                f'при бюджете {budget}'
+            )
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.query_budget = get_query_budget(view_func, request.method)
+
+
+class ReplicaRoutingMiddleware:
+    # Безопасные запросы к API читают с реплик (ReplicaRouter). После
+    # записи запрос до конца работает с основной базой, а cookie
+    # REPLICA_PIN_COOKIE на REPLICA_PIN_SECONDS направляет туда же
+    # следующие запросы клиента, пока реплики догоняют основную базу.
+    # Запросы StreamingHttpResponse выполняются уже после сброса
+    # состояния и идут в основную базу.
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.cookie = getattr(settings, 'REPLICA_PIN_COOKIE', 'db_primary')
+        self.pin_seconds = getattr(settings, 'REPLICA_PIN_SECONDS', 5)
+        self.path_prefix = getattr(settings, 'REPLICA_PATH_PREFIX', '/api/')
+
+    def use_replica(self, request):
+        return (request.method in SAFE_METHODS
+                and request.path.startswith(self.path_prefix)
+                and self.cookie not in request.COOKIES)
+
+    def __call__(self, request):
+        replicas = get_replicas()
+        if not replicas:
+            return self.get_response(request)
+        replica_state.reset(enabled=self.use_replica(request))
+        try:
+            with ExitStack() as stack:
+                for alias in replicas:
+                    stack.enter_context(
+                        connections[alias].execute_wrapper(replica_state))
+                response = self.get_response(request)
+            wrote = (replica_state.pinned
+                     or request.method not in SAFE_METHODS)
+        finally:
+            replica_state.reset()
+        if wrote:
+            response.set_cookie(
+                self.cookie, '1', max_age=self.pin_seconds, httponly=True)
+        return response
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        request.replica_view = (view_func, view_args, view_kwargs)
+
+    def process_exception(self, request, exception):
+        # Чтение ничего не изменило: после сбоя реплики представление
+        # повторяется на основной базе.
+        view = getattr(request, 'replica_view', None)
+        if view is None or not replica_state.failed:
+            return None
+        replica_state.enabled = False
+        replica_state.failed = None
+        view_func, view_args, view_kwargs = view
+        return view_func(request, *view_args, **view_kwargs)
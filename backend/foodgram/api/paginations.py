@@ -1,6 +1,60 @@
-from rest_framework.pagination import PageNumberPagination
+from rest_framework.exceptions import ValidationError
+from rest_framework.pagination import CursorPagination, PageNumberPagination
 
 
 class LimitPageNumberPagination(PageNumberPagination):
     page_size = 6
     page_size_query_param = 'limit'
+
+
+class LimitCursorPagination(CursorPagination):
+    page_size = 6
+    page_size_query_param = 'limit'
+    ordering = 'id'
+
+    def get_ordering(self, request, queryset, view):
+        # Курсор продолжает порядок выдачи (например, ?ordering=trending),
+        # а не подменяет его сортировкой по id. Порядок по вычисляемому
+        # значению (ранг поиска) в курсор не записать, такой запрос - 400.
+        query = queryset.query
+        ordering = tuple(query.order_by)
+        columns = {field.attname for field in
+                   queryset.model._meta.concrete_fields}
+        if query.extra_order_by or not all(
+                isinstance(field, str) and field.lstrip('-') in columns
+                for field in ordering):
+            raise ValidationError({self.cursor_query_param: [
+                'Курсорная пагинация недоступна для этой сортировки.']})
+        return ordering or super().get_ordering(request, queryset, view)
+
+
+class FeedPagination(LimitPageNumberPagination):
+    # Постраничная выдача по умолчанию, курсорная (по ключу сортировки,
+    # без OFFSET и COUNT) - при ?pagination=cursor или переданном ?cursor=.
+    mode_query_param = 'pagination'
+    cursor_pagination_class = LimitCursorPagination
+    cursor_paginator = None
+
+    def use_cursor(self, request):
+        return (
+            request.query_params.get(self.mode_query_param) == 'cursor'
+            or self.cursor_pagination_class.cursor_query_param
+            in request.query_params
+        )
+
+    def paginate_queryset(self, queryset, request, view=None):
+        if not self.use_cursor(request):
+            return super().paginate_queryset(queryset, request, view)
+        self.cursor_paginator = self.cursor_pagination_class()
+        return self.cursor_paginator.paginate_queryset(
+            queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super().get_paginated_response(data)
+
+    def to_html(self):
+        if self.cursor_paginator is not None:
+            return self.cursor_paginator.to_html()
+        return super().to_html()
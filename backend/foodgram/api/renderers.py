@@ -0,0 +1,146 @@
+import csv
+import io
+import json
+import os
+
+from django.conf import settings
+from rest_framework.renderers import BaseRenderer
+
+try:
+    from reportlab.lib.pagesizes import A4
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+    from reportlab.pdfgen import canvas
+except ImportError:
+    canvas = None
+
+
+class ShoppingListRenderer(BaseRenderer):
+    charset = 'utf-8'
+    extension = None
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        if isinstance(data, dict):
+            data = '\n'.join(f'{key}: {value}' for key, value in data.items())
+        return str(data).encode(self.charset)
+
+    def stream(self, rows):
+        raise NotImplementedError
+
+    def get_filename(self, name='shop_list'):
+        return f'{name}.{self.extension}'
+
+    def get_content_type(self):
+        if self.charset is None:
+            return self.media_type
+        return f'{self.media_type}; charset={self.charset}'
+
+
+class TextShoppingListRenderer(ShoppingListRenderer):
+    media_type = 'text/plain'
+    format = 'txt'
+    extension = 'txt'
+
+    def stream(self, rows):
+        for row in rows:
+            yield (
+                f'{row["name"]} – {row["amount"]}'
+                f'{row["measurement_unit"]}.\n'
+            )
+
+
+class _Echo:
+
+    def write(self, value):
+        return value
+
+
+class CSVShoppingListRenderer(ShoppingListRenderer):
+    media_type = 'text/csv'
+    format = 'csv'
+    extension = 'csv'
+    header = ('name', 'amount', 'measurement_unit')
+
+    def stream(self, rows):
+        writer = csv.writer(_Echo())
+        yield writer.writerow(self.header)
+        for row in rows:
+            yield writer.writerow([row[field] for field in self.header])
+
+
+class JSONShoppingListRenderer(ShoppingListRenderer):
+    media_type = 'application/json'
+    format = 'json'
+    extension = 'json'
+
+    def render(self, data, accepted_media_type=None, renderer_context=None):
+        if data is None:
+            return b''
+        return json.dumps(data, ensure_ascii=False).encode(self.charset)
+
+    def stream(self, rows):
+        yield '['
+        separator = ''
+        for row in rows:
+            yield separator + json.dumps(row, ensure_ascii=False)
+            separator = ','
+        yield ']'
+
+
+def get_pdf_font_path():
+    # Встроенные шрифты PDF не содержат кириллицы.
+    font_path = getattr(settings, 'SHOPPING_LIST_PDF_FONT', None)
+    if font_path and os.path.isfile(font_path):
+        return font_path
+    return None
+
+
+class PDFShoppingListRenderer(ShoppingListRenderer):
+    media_type = 'application/pdf'
+    format = 'pdf'
+    charset = None
+    extension = 'pdf'
+    font_name = 'ShoppingListFont'
+    font_size = 12
+    line_height = 18
+    margin = 50
+
+    def get_font(self):
+        if self.font_name not in pdfmetrics.getRegisteredFontNames():
+            pdfmetrics.registerFont(
+                TTFont(self.font_name, get_pdf_font_path()))
+        return self.font_name
+
+    def stream(self, rows):
+        # PDF нельзя отдавать частями до завершения документа,
+        # поэтому строки пишутся в буфер и файл отдается одним куском.
+        buffer = io.BytesIO()
+        pdf = canvas.Canvas(buffer, pagesize=A4)
+        font = self.get_font()
+        width, height = A4
+        y = height - self.margin
+        pdf.setFont(font, self.font_size)
+        for row in rows:
+            if y < self.margin:
+                pdf.showPage()
+                pdf.setFont(font, self.font_size)
+                y = height - self.margin
+            pdf.drawString(
+                self.margin, y,
+                f'{row["name"]} – {row["amount"]} '
+                f'{row["measurement_unit"]}.'
+            )
+            y -= self.line_height
+        pdf.save()
+        yield buffer.getvalue()
+
+
+SHOPPING_LIST_RENDERERS = [
+    TextShoppingListRenderer,
+    CSVShoppingListRenderer,
+    JSONShoppingListRenderer,
+]
+if canvas is not None and get_pdf_font_path():
+    SHOPPING_LIST_RENDERERS.append(PDFShoppingListRenderer)
@@ -0,0 +1,120 @@
+import logging
+import random
+import threading
+import time
+
+from django.conf import settings
+from django.db import (DEFAULT_DB_ALIAS, DatabaseError, InterfaceError,
+                       OperationalError, connections)
+
+logger = logging.getLogger('api.replicas')
+
+
+def get_replicas():
+    return getattr(settings, 'DATABASE_REPLICAS', ())
+
+
+class ReplicaHealth:
+    # Реплика, на которой не удалось подключиться или выполнить запрос,
+    # исключается из выбора на REPLICA_RETRY_SECONDS. Состояние у каждого
+    # процесса свое.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._down_until = {}
+
+    @property
+    def retry_seconds(self):
+        return getattr(settings, 'REPLICA_RETRY_SECONDS', 30)
+
+    def available(self):
+        now = time.monotonic()
+        with self._lock:
+            return [alias for alias in get_replicas()
+                    if self._down_until.get(alias, 0) <= now]
+
+    def mark_down(self, alias, error=None):
+        logger.warning('Реплика %s недоступна: %s', alias, error)
+        with self._lock:
+            self._down_until[alias] = time.monotonic() + self.retry_seconds
+
+
+replica_health = ReplicaHealth()
+
+
+class ReplicaState(threading.local):
+    # Маршрутизация текущего запроса: enabled выставляет middleware для
+    # безопасных методов, pinned - первая запись (или cookie после записи
+    # в предыдущем запросе), после которой все чтения идут в основную базу.
+    enabled = False
+    pinned = False
+    replica = None
+    failed = None
+
+    def reset(self, enabled=False):
+        self.enabled = enabled
+        self.pinned = False
+        self.replica = None
+        self.failed = None
+
+    def pin(self):
+        self.pinned = True
+
+    def get_read_alias(self):
+        if not self.enabled or self.pinned:
+            return None
+        if connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return None
+        if self.replica is None:
+            self.replica = self.choose_replica()
+        return self.replica
+
+    def choose_replica(self):
+        candidates = replica_health.available()
+        random.shuffle(candidates)
+        for alias in candidates:
+            try:
+                connections[alias].ensure_connection()
+            except DatabaseError as error:
+                replica_health.mark_down(alias, error)
+            else:
+                return alias
+        return None
+
+    def __call__(self, execute, sql, params, many, context):
+        # Обертка запросов к репликам: ошибку соединения или схемы
+        # запоминаем, чтобы middleware повторил запрос на основной базе.
+        try:
+            return execute(sql, params, many, context)
+        except (OperationalError, InterfaceError) as error:
+            alias = context['connection'].alias
+            replica_health.mark_down(alias, error)
+            self.failed = alias
+            raise
+
+
+replica_state = ReplicaState()
+
+
+class ReplicaRouter:
+    # Без DATABASE_REPLICAS и вне ReplicaRoutingMiddleware (команды,
+    # фоновые потоки) ничего не меняет: все идет в default.
+
+    def db_for_read(self, model, **hints):
+        return replica_state.get_read_alias()
+
+    def db_for_write(self, model, **hints):
+        replica_state.pin()
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        databases = {DEFAULT_DB_ALIAS, *get_replicas()}
+        if obj1._state.db in databases and obj2._state.db in databases:
+            return True
+        return None
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        # Схема реплик приходит с основной базы через репликацию.
+        if db in get_replicas():
+            return False
+        return None
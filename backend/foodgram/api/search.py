@@ -0,0 +1,226 @@
+import bisect
+import heapq
+import threading
+import time
+from collections import Counter, defaultdict
+
+from django.conf import settings
+
+from recipes.models import Ingredient, IngredientAmount
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+class IngredientIndex:
+    # Индекс живет в памяти процесса: сигналы сбрасывают его только
+    # в текущем воркере, остальные перестраивают его по истечении ttl.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = None
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'INGREDIENT_INDEX_TTL', 300)
+
+    @property
+    def limit(self):
+        return getattr(settings, 'INGREDIENT_SEARCH_LIMIT', 20)
+
+    def invalidate(self):
+        self._data = None
+
+    def build(self):
+        rows = sorted(
+            (name.lower(), pk, name, measurement_unit)
+            for pk, name, measurement_unit in Ingredient.objects.values_list(
+                'id', 'name', 'measurement_unit').iterator()
+        )
+        keys = [row[0] for row in rows]
+        entries = [
+            {'id': pk, 'name': name, 'measurement_unit': measurement_unit}
+            for _, pk, name, measurement_unit in rows
+        ]
+        return keys, entries, time.monotonic()
+
+    def get_data(self):
+        data = self._data
+        if data is None or time.monotonic() - data[2] > self.ttl:
+            with self._lock:
+                data = self._data
+                if data is None or time.monotonic() - data[2] > self.ttl:
+                    data = self._data = self.build()
+        return data[0], data[1]
+
+    def search(self, query, limit=None):
+        limit = limit or self.limit
+        query = query.strip().lower()
+        keys, entries = self.get_data()
+        start = bisect.bisect_left(keys, query)
+        end = start
+        while (end < len(keys) and end - start < limit
+               and keys[end].startswith(query)):
+            end += 1
+        result = entries[start:end]
+        if not query or len(result) >= limit:
+            return result
+        substring_matches = heapq.nsmallest(
+            limit - len(result),
+            (
+                (key.find(query), key, index)
+                for index, key in enumerate(keys)
+                if query in key and not key.startswith(query)
+            )
+        )
+        return result + [entries[index] for _, _, index in substring_matches]
+
+
+ingredient_index = IngredientIndex()
+
+
+class RecipeMatchIndex:
+    # Инвертированный индекс ингредиент -> рецепты для подбора рецептов
+    # по имеющимся продуктам. Как и IngredientIndex, живет в памяти
+    # процесса. Рецепты, измененные после сборки снимка, хранятся
+    # отдельно в _changes и перекрывают снимок до следующей пересборки.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._data = None
+        self._changes = {}
+
+    @property
+    def ttl(self):
+        return getattr(settings, 'RECIPE_MATCH_INDEX_TTL', 300)
+
+    @property
+    def max_changes(self):
+        return getattr(settings, 'RECIPE_MATCH_MAX_CHANGES', 1000)
+
+    def invalidate(self):
+        self._data = None
+
+    def update_recipe(self, recipe_id, ingredient_ids):
+        with self._lock:
+            self._changes[recipe_id] = (
+                frozenset(ingredient_ids), time.monotonic())
+
+    def remove_recipe(self, recipe_id):
+        self.update_recipe(recipe_id, ())
+
+    def build(self):
+        started = time.monotonic()
+        postings = defaultdict(list)
+        sizes = Counter()
+        for recipe_id, ingredient_id in IngredientAmount.objects.order_by(
+                'recipe_id').values_list('recipe_id', 'ingredient_id'
+                                         ).iterator():
+            postings[ingredient_id].append(recipe_id)
+            sizes[recipe_id] += 1
+        recipe_ids = sorted(sizes)
+        if numpy is None:
+            return {
+                'postings': {key: tuple(value)
+                             for key, value in postings.items()},
+                'sizes': dict(sizes),
+                'built_at': started,
+            }
+        positions = {recipe_id: index
+                     for index, recipe_id in enumerate(recipe_ids)}
+        return {
+            'postings': {
+                key: numpy.fromiter(
+                    (positions[recipe_id] for recipe_id in value),
+                    dtype=numpy.int32, count=len(value))
+                for key, value in postings.items()
+            },
+            'recipe_ids': numpy.array(recipe_ids, dtype=numpy.int64),
+            'sizes': numpy.array(
+                [sizes[recipe_id] for recipe_id in recipe_ids],
+                dtype=numpy.int32),
+            'positions': positions,
+            'built_at': started,
+        }
+
+    def get_data(self):
+        data = self._data
+        if (data is None or time.monotonic() - data['built_at'] > self.ttl
+                or len(self._changes) > self.max_changes):
+            with self._lock:
+                data = self._data
+                if (data is None
+                        or time.monotonic() - data['built_at'] > self.ttl
+                        or len(self._changes) > self.max_changes):
+                    data = self._data = self.build()
+                    # Изменения, сделанные во время сборки, могли в снимок
+                    # не попасть, поэтому оставляем их.
+                    self._changes = {
+                        recipe_id: change
+                        for recipe_id, change in self._changes.items()
+                        if change[1] >= data['built_at']
+                    }
+        return data, dict(self._changes)
+
+    def match_snapshot(self, data, ingredient_ids, changed, max_missing):
+        if numpy is None:
+            hits = Counter()
+            for ingredient_id in ingredient_ids:
+                hits.update(data['postings'].get(ingredient_id, ()))
+            return sorted(
+                (data['sizes'][recipe_id] - matched, -matched, recipe_id)
+                for recipe_id, matched in hits.items()
+                if recipe_id not in changed and (
+                    max_missing is None
+                    or data['sizes'][recipe_id] - matched <= max_missing)
+            )
+        lists = [data['postings'][ingredient_id]
+                 for ingredient_id in ingredient_ids
+                 if ingredient_id in data['postings']]
+        if not lists:
+            return []
+        hits = numpy.bincount(
+            numpy.concatenate(lists), minlength=len(data['recipe_ids']))
+        for recipe_id in changed:
+            position = data['positions'].get(recipe_id)
+            if position is not None:
+                hits[position] = 0
+        candidates = numpy.flatnonzero(hits)
+        matched = hits[candidates]
+        missing = data['sizes'][candidates] - matched
+        if max_missing is not None:
+            keep = missing <= max_missing
+            candidates, matched, missing = (
+                candidates[keep], matched[keep], missing[keep])
+        recipe_ids = data['recipe_ids'][candidates]
+        order = numpy.lexsort((recipe_ids, -matched, missing))
+        return list(zip(missing[order].tolist(), (-matched[order]).tolist(),
+                        recipe_ids[order].tolist()))
+
+    def match(self, ingredient_ids, max_missing=None):
+        """Рецепты, в которых есть хотя бы один из ингредиентов.
+
+        Возвращает список (missing, matched, recipe_id): сначала рецепты
+        с наименьшим числом недостающих ингредиентов, затем с наибольшим
+        числом совпавших.
+        """
+        ingredient_ids = frozenset(ingredient_ids)
+        data, changes = self.get_data()
+        snapshot = self.match_snapshot(
+            data, ingredient_ids, changes, max_missing)
+        changed = []
+        for recipe_id, (recipe_ingredients, _) in changes.items():
+            matched = len(recipe_ingredients & ingredient_ids)
+            missing = len(recipe_ingredients) - matched
+            if matched and (max_missing is None or missing <= max_missing):
+                changed.append((missing, -matched, recipe_id))
+        return [
+            (missing, -matched, recipe_id)
+            for missing, matched, recipe_id in heapq.merge(
+                snapshot, sorted(changed))
+        ]
+
+
+recipe_match_index = RecipeMatchIndex()
@@ -1,13 +1,31 @@
 from drf_extra_fields.fields import Base64ImageField
-from django.db.models import F
-from django.shortcuts import get_object_or_404
+from django.db import transaction
 from djoser.serializers import UserCreateSerializer
 from rest_framework import serializers
+from rest_framework.settings import api_settings
 
+from recipes.images import get_variant_urls, schedule_recipe_image
 from recipes.models import (Favorite, Ingredient, IngredientAmount, Recipe,
-                            ShoppingCart, Tag, TagRecipe)
+                            ShoppingCart, ShoppingListItem, Tag, TagRecipe)
+from recipes.similarity import schedule_similar_update
 from users.models import CustomUser, Follow
-from .utils import DataSerializerMixin
+from .search import recipe_match_index
+
+BATCH_MAX_SIZE = 100
+
+
+class ImageVariantsField(serializers.ReadOnlyField):
+
+    def to_representation(self, recipe):
+        request = self.context.get('request')
+        variants = get_variant_urls(recipe)
+        if request is not None:
+            variants = {
+                variant: {key: request.build_absolute_uri(url)
+                          for key, url in formats.items()}
+                for variant, formats in variants.items()
+            }
+        return variants
 
 
 class UserSerializer(UserCreateSerializer):
@@ -20,9 +38,12 @@ class UserSerializer(UserCreateSerializer):
             'username',
             'id',
             'email',
-            'is_subscribed'
+            'is_subscribed',
+            'recipes_count',
+            'followers_count',
         )
         model = CustomUser
+        read_only_fields = ('recipes_count', 'followers_count')
         extra_kwargs = {
             'username': {'required': True},
             'email': {'required': True},
@@ -30,6 +51,8 @@ class UserSerializer(UserCreateSerializer):
         }
 
     def get_is_subscribed(self, obj):
+        if hasattr(obj, 'is_subscribed'):
+            return obj.is_subscribed
         request = self.context.get('request')
         if request is None or request.user.is_anonymous:
             return False
@@ -84,6 +107,7 @@ class ListRecipeSerializer(serializers.ModelSerializer):
         many=True,
     )
     image = Base64ImageField(max_length=None, use_url=True,)
+    image_variants = ImageVariantsField(source='*')
     is_favorited = serializers.SerializerMethodField()
     is_in_shopping_cart = serializers.SerializerMethodField()
 
@@ -91,10 +115,13 @@ class ListRecipeSerializer(serializers.ModelSerializer):
         model = Recipe
         fields = ('id', 'tags', 'author', 'ingredients',
                   'is_favorited', 'is_in_shopping_cart',
-                  'name', 'image', 'text', 'cooking_time'
+                  'name', 'image', 'image_variants', 'text', 'cooking_time',
+                  'favorites_count', 'shopping_cart_count',
                   )
 
     def get_is_favorited(self, obj):
+        if hasattr(obj, 'is_favorited'):
+            return obj.is_favorited
         request = self.context.get('request')
         if not request or request.user.is_anonymous:
             return False
@@ -104,6 +131,8 @@ class ListRecipeSerializer(serializers.ModelSerializer):
         ).exists()
 
     def get_is_in_shopping_cart(self, obj):
+        if hasattr(obj, 'is_in_shopping_cart'):
+            return obj.is_in_shopping_cart
         request = self.context.get('request')
         if not request or request.user.is_anonymous:
             return False
@@ -113,6 +142,22 @@ class ListRecipeSerializer(serializers.ModelSerializer):
         ).exists()
 
 
+class MatchedRecipeSerializer(ListRecipeSerializer):
+    missing_ingredients = serializers.ReadOnlyField()
+    matched_ingredients = serializers.ReadOnlyField()
+
+    class Meta(ListRecipeSerializer.Meta):
+        fields = ListRecipeSerializer.Meta.fields + (
+            'missing_ingredients', 'matched_ingredients')
+
+
+class SimilarRecipeSerializer(ListRecipeSerializer):
+    similarity = serializers.FloatField(read_only=True)
+
+    class Meta(ListRecipeSerializer.Meta):
+        fields = ListRecipeSerializer.Meta.fields + ('similarity',)
+
+
 class RecipeSerializer(serializers.ModelSerializer):
     tags = serializers.PrimaryKeyRelatedField(
         source='tagrecipe_set',
@@ -154,6 +199,12 @@ class RecipeSerializer(serializers.ModelSerializer):
                     'Ингредиенты в рецепте дублируются'
                 )
             ingredients_list.append(check_id)
+        found = Ingredient.objects.in_bulk(ingredients_list)
+        missing = [str(pk) for pk in ingredients_list if pk not in found]
+        if missing:
+            raise serializers.ValidationError(
+                f'Ингредиенты не найдены: {", ".join(missing)}'
+            )
         return data
 
     def validate_cooking_time(self, data):
@@ -170,137 +221,181 @@ class RecipeSerializer(serializers.ModelSerializer):
         return data
 
     def create_recipe_ingredient_and_tag(self, ingredients, tags, recipe):
-        for tag in tags:
-            recipe.tags.add(tag)
-        for ingredient in ingredients:
-            current_ingredient = get_object_or_404(
-                Ingredient,
-                id=ingredient.get('ingredient').get('id')
-            )
-            amount = ingredient.get('amount')
-            if IngredientAmount.objects.filter(
-                recipe=recipe, ingredient=current_ingredient
-            ).exists():
-                amount += F('amount')
-            IngredientAmount.objects.update_or_create(
-                ingredient=current_ingredient,
+        TagRecipe.objects.bulk_create(
+            TagRecipe(recipe=recipe, tag=tag) for tag in tags
+        )
+        IngredientAmount.objects.bulk_create(
+            IngredientAmount(
                 recipe=recipe,
-                defaults={'amount': amount}
+                ingredient_id=ingredient['ingredient']['id'],
+                amount=ingredient['amount'],
             )
+            for ingredient in ingredients
+        )
+
+    def update_recipe_tags(self, tags, recipe):
+        current = set(
+            TagRecipe.objects.filter(recipe=recipe).values_list(
+                'tag_id', flat=True)
+        )
+        new = {tag.id for tag in tags}
+        if current - new:
+            TagRecipe.objects.filter(
+                recipe=recipe, tag_id__in=current - new).delete()
+        TagRecipe.objects.bulk_create(
+            TagRecipe(recipe=recipe, tag_id=tag_id) for tag_id in new - current
+        )
 
+    def update_recipe_ingredients(self, ingredients, recipe):
+        current = {
+            row.ingredient_id: row
+            for row in IngredientAmount.objects.filter(recipe=recipe)
+        }
+        old_amounts = {
+            ingredient_id: row.amount
+            for ingredient_id, row in current.items()
+        }
+        new_amounts = {
+            ingredient['ingredient']['id']: ingredient['amount']
+            for ingredient in ingredients
+        }
+        removed = set(current) - set(new_amounts)
+        if removed:
+            IngredientAmount.objects.filter(
+                recipe=recipe, ingredient_id__in=removed).delete()
+        changed = []
+        for ingredient_id, amount in new_amounts.items():
+            row = current.get(ingredient_id)
+            if row is not None and row.amount != amount:
+                row.amount = amount
+                changed.append(row)
+        if changed:
+            IngredientAmount.objects.bulk_update(changed, ['amount'])
+        IngredientAmount.objects.bulk_create(
+            IngredientAmount(
+                recipe=recipe, ingredient_id=ingredient_id, amount=amount)
+            for ingredient_id, amount in new_amounts.items()
+            if ingredient_id not in current
+        )
+        return old_amounts, new_amounts
+
+    def update_recipe_indexes(self, recipe, ingredient_ids):
+        ingredient_ids = list(ingredient_ids)
+        transaction.on_commit(lambda: recipe_match_index.update_recipe(
+            recipe.pk, ingredient_ids))
+        schedule_similar_update(recipe.pk)
+
+    @transaction.atomic
     def create(self, validated_data):
         author = self.context.get('user_id')
         tags = validated_data.pop('tagrecipe_set')
         ingredients = validated_data.pop('recipes_ingredients_list')
         recipe = Recipe.objects.create(author=author, **validated_data)
-        recipe.save()
         self.create_recipe_ingredient_and_tag(ingredients, tags, recipe)
+        Recipe.objects.filter(pk=recipe.pk).update_derived_fields()
+        self.update_recipe_indexes(
+            recipe, [item['ingredient']['id'] for item in ingredients])
+        schedule_recipe_image(recipe)
         return recipe
 
+    @transaction.atomic
     def update(self, instance, validated_data):
         tags = validated_data.pop('tagrecipe_set')
         ingredients = validated_data.pop('recipes_ingredients_list')
         instance = super().update(instance, validated_data)
-        instance.tags.clear()
-        instance.tags.set(tags)
-        instance.ingredients.clear()
-        self.create_recipe_ingredient_and_tag(
-            ingredients=ingredients, tags=tags, recipe=instance)
+        self.update_recipe_tags(tags, instance)
+        old_amounts, new_amounts = self.update_recipe_ingredients(
+            ingredients, instance)
+        ShoppingListItem.objects.change_recipe(
+            instance, old_amounts, new_amounts)
+        Recipe.objects.filter(pk=instance.pk).update_derived_fields()
+        self.update_recipe_indexes(instance, new_amounts)
+        schedule_recipe_image(instance)
         return instance
 
     def to_representation(self, instance):
-        return ListRecipeSerializer(
-            instance,
-            context={
-                "user_id": self.context.get('user_id')
-            }
-        ).data
-
-
-class ShoppingCartCreateSerializer(DataSerializerMixin,
-                                   serializers.ModelSerializer):
-    recipe = serializers.IntegerField(source='recipe.id')
-    user = serializers.IntegerField(source='user.id')
-
-    class Meta:
-        model = ShoppingCart
-        fields = ['recipe', 'user']
-
-    def create(self, validated_data):
-        return self.create_serializer(
-            Recipe, ShoppingCart, validated_data)
-
-    def validate(self, data):
-        return self.validate_serializer(
-            ShoppingCart, data)
+        request = self.context.get('request')
+        instance = Recipe.objects.for_list(
+            request.user if request else None).get(pk=instance.pk)
+        return ListRecipeSerializer(instance, context=self.context).data
 
 
 class ShoppingCartSerializer(serializers.ModelSerializer):
     id = serializers.ReadOnlyField(source='recipe.id')
     name = serializers.ReadOnlyField(source='recipe.name')
     image = Base64ImageField(read_only=True, source='recipe.image')
+    image_variants = ImageVariantsField(source='recipe')
     cooking_time = serializers.ReadOnlyField(source='recipe.cooking_time')
 
     class Meta:
         model = ShoppingCart
-        fields = ['id', 'name', 'image', 'cooking_time']
-
-
-class FavoriteCreateSerializer(DataSerializerMixin,
-                               serializers.ModelSerializer):
-    recipe = serializers.IntegerField(source='recipe.id')
-    user = serializers.IntegerField(source='user.id')
-
-    class Meta:
-        model = Favorite
-        fields = ['recipe', 'user']
-
-    def create(self, validated_data):
-        return self.create_serializer(
-            Recipe, Favorite, validated_data)
-
-    def validate(self, data):
-        return self.validate_serializer(
-            Favorite, data)
+        fields = ['id', 'name', 'image', 'image_variants', 'cooking_time']
 
 
 class FavoriteSerializer(serializers.ModelSerializer):
     id = serializers.IntegerField(source='recipe.id')
     name = serializers.ReadOnlyField(source='recipe.name')
     image = Base64ImageField(read_only=True, source='recipe.image')
+    image_variants = ImageVariantsField(source='recipe')
     cooking_time = serializers.ReadOnlyField(source='recipe.cooking_time')
 
     class Meta:
         model = Favorite
-        fields = ['id', 'name', 'image', 'cooking_time']
+        fields = ['id', 'name', 'image', 'image_variants', 'cooking_time']
 
 
-class FollowCreateSerializer(serializers.ModelSerializer):
-    user = serializers.IntegerField(source='user.id')
-    author = serializers.IntegerField(source='author.id')
-
-    class Meta:
-        model = Follow
-        fields = ['user', 'author']
-
-    def create(self, validated_data):
-        author = get_object_or_404(
-            CustomUser,
-            pk=validated_data.get('author').get('id')
-        )
-        user = validated_data.get('user')
-        return Follow.objects.create(user=user, author=author)
+class BatchIdsSerializer(serializers.Serializer):
+    # Тело пакетного запроса: {ids_field: [...]} или, только для очистки,
+    # {"all": true}. Лишние ключи - ошибка: опечатка вроде {"recipe": [1]}
+    # не должна превращаться в удаление всего списка.
+    ids_field = None
+    all = serializers.BooleanField(required=False, default=False)
 
     def validate(self, data):
-        if Follow.objects.filter(
-                author__id=data.get('author').get('id'),
-                user__id=data.get('user').get('id')).exists():
+        unknown = sorted(set(self.initial_data) - set(self.fields))
+        if unknown:
             raise serializers.ValidationError(
-                'Вы уже подписаны на этого автора'
-            )
+                {key: ['Неизвестное поле.'] for key in unknown})
+        if (self.ids_field in data) == data['all']:
+            raise serializers.ValidationError({
+                api_settings.NON_FIELD_ERRORS_KEY: [
+                    f'Передайте либо {self.ids_field}, либо all: true.']
+            })
+        if data['all'] and not self.context.get('allow_all'):
+            raise serializers.ValidationError(
+                {'all': ['Доступно только для удаления.']})
         return data
 
 
+class RecipeIdsSerializer(BatchIdsSerializer):
+    ids_field = 'recipes'
+    recipes = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=BATCH_MAX_SIZE,
+        required=False,
+    )
+
+
+class AuthorIdsSerializer(BatchIdsSerializer):
+    ids_field = 'authors'
+    authors = serializers.ListField(
+        child=serializers.IntegerField(min_value=1),
+        allow_empty=False,
+        max_length=BATCH_MAX_SIZE,
+        required=False,
+    )
+
+
+class RecipeMinifiedSerializer(serializers.ModelSerializer):
+    image = Base64ImageField(read_only=True)
+    image_variants = ImageVariantsField(source='*')
+
+    class Meta:
+        model = Recipe
+        fields = ('id', 'name', 'image', 'image_variants', 'cooking_time')
+
+
 class FollowSerializer(UserSerializer):
     email = serializers.ReadOnlyField(source='author.email')
     id = serializers.ReadOnlyField(source='author.id')
@@ -308,12 +403,10 @@ class FollowSerializer(UserSerializer):
     first_name = serializers.ReadOnlyField(source='author.first_name')
     last_name = serializers.ReadOnlyField(source='author.last_name')
     is_subscribed = serializers.SerializerMethodField()
-    recipes = RecipeSerializer(
-        source='author.recipes',
-        many=True,
-        data=Recipe.objects.all(),
-    )
-    recipes_count = serializers.SerializerMethodField()
+    recipes = serializers.SerializerMethodField()
+    recipes_count = serializers.ReadOnlyField(source='author.recipes_count')
+    followers_count = serializers.ReadOnlyField(
+        source='author.followers_count')
 
     class Meta:
         model = Follow
@@ -326,12 +419,15 @@ class FollowSerializer(UserSerializer):
             'is_subscribed',
             'recipes',
             'recipes_count',
+            'followers_count',
         )
 
     def get_is_subscribed(self, username):
         return True
 
-    def get_recipes_count(self, obj):
-        author = obj.author
-        count = Recipe.objects.filter(author=author).count()
-        return count
+    def get_recipes(self, obj):
+        recipes = getattr(obj.author, 'recipes_preview', None)
+        if recipes is None:
+            recipes = obj.author.recipes.all()
+        return RecipeMinifiedSerializer(
+            recipes, many=True, context=self.context).data
@@ -0,0 +1,177 @@
+from django.db import connections, transaction
+from django.db.models import F
+from django.db.models.signals import post_delete, post_save, pre_delete
+from django.dispatch import receiver
+from rest_framework.authtoken.models import Token
+
+from recipes.images import delete_variants
+from recipes.models import (Favorite, Ingredient, IngredientAmount, Recipe,
+                            ShoppingCart, ShoppingListItem, Tag, TagRecipe,
+                            delete_fts_rows)
+from users.models import CustomUser, Follow
+from .authentication import token_cache
+from .cache import (INGREDIENTS, RECIPES, RECIPES_DETAIL, TAGS,
+                    recipe_namespace, response_cache)
+from .search import ingredient_index, recipe_match_index
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(post_delete, sender=Ingredient)
+def invalidate_ingredient_index(sender, **kwargs):
+    ingredient_index.invalidate()
+    response_cache.invalidate_on_commit(INGREDIENTS, RECIPES, RECIPES_DETAIL)
+
+
+@receiver(post_save, sender=Ingredient)
+@receiver(pre_delete, sender=Ingredient)
+def update_recipe_search(sender, instance, created=False, **kwargs):
+    if created:
+        return
+    recipe_ids = list(IngredientAmount.objects.filter(
+        ingredient=instance).values_list('recipe_id', flat=True))
+    if recipe_ids:
+        transaction.on_commit(lambda: Recipe.objects.filter(
+            pk__in=recipe_ids).update_search_documents())
+
+
+@receiver(pre_delete, sender=Tag)
+def update_recipe_tags_mask(sender, instance, **kwargs):
+    recipe_ids = list(TagRecipe.objects.filter(
+        tag=instance).values_list('recipe_id', flat=True))
+    if recipe_ids:
+        transaction.on_commit(lambda: Recipe.objects.filter(
+            pk__in=recipe_ids).update_tags_mask())
+
+
+@receiver(post_save, sender=Tag)
+@receiver(post_delete, sender=Tag)
+def invalidate_tags(sender, **kwargs):
+    response_cache.invalidate_on_commit(TAGS, RECIPES, RECIPES_DETAIL)
+
+
+@receiver(post_save, sender=Recipe)
+@receiver(post_delete, sender=Recipe)
+def invalidate_recipe(sender, instance, **kwargs):
+    response_cache.invalidate_on_commit(
+        RECIPES, recipe_namespace(instance.pk))
+
+
+@receiver(post_delete, sender=Recipe)
+def remove_from_match_index(sender, instance, **kwargs):
+    recipe_id = instance.pk
+    transaction.on_commit(
+        lambda: recipe_match_index.remove_recipe(recipe_id))
+
+
+@receiver(post_delete, sender=Recipe)
+def remove_image_variants(sender, instance, **kwargs):
+    source_name = instance.image_variants_source
+    if source_name:
+        transaction.on_commit(lambda: delete_variants(source_name))
+
+
+@receiver(post_delete, sender=Recipe)
+def remove_from_search(sender, instance, using, **kwargs):
+    # В SQLite поиск идет по отдельной FTS-таблице без внешнего ключа,
+    # в PostgreSQL вектор хранится в строке рецепта.
+    connection = connections[using]
+    if connection.vendor == 'sqlite':
+        with connection.cursor() as cursor:
+            delete_fts_rows(cursor, [instance.pk])
+
+
+@receiver(post_save, sender=ShoppingCart)
+def add_to_shopping_list(sender, instance, created=False, raw=False,
+                         **kwargs):
+    if created and not raw:
+        ShoppingListItem.objects.add_recipe(
+            instance.user_id, instance.recipe_id)
+
+
+@receiver(pre_delete, sender=ShoppingCart)
+def remove_from_shopping_list(sender, instance, **kwargs):
+    # pre_delete: при каскадном удалении рецепта или пользователя
+    # Django рассылает его до удаления строк, состав рецепта ещё в базе.
+    # Рецепт в N корзинах удаляется за O(N) запросов.
+    ShoppingListItem.objects.remove_recipe(
+        instance.user_id, instance.recipe_id)
+
+
+@receiver(post_save, sender=IngredientAmount)
+@receiver(post_delete, sender=IngredientAmount)
+@receiver(post_save, sender=TagRecipe)
+@receiver(post_delete, sender=TagRecipe)
+def invalidate_recipe_relations(sender, instance, **kwargs):
+    response_cache.invalidate_on_commit(
+        RECIPES, recipe_namespace(instance.recipe_id))
+
+
+@receiver(post_save, sender=CustomUser)
+def invalidate_user_tokens(sender, instance, created=False, raw=False,
+                           **kwargs):
+    # Смена пароля, блокировка и правка профиля меняют пользователя,
+    # закешированного вместе с токеном.
+    if not created and not raw:
+        token_cache.invalidate_user(instance.pk)
+
+
+@receiver(post_delete, sender=Token)
+def invalidate_token(sender, instance, **kwargs):
+    token_cache.invalidate_on_commit(instance.key)
+
+
+# Поля пользователя, которых нет в ответах API: их сохранение (например,
+# last_login при входе по токену) не сбрасывает кеш рецептов.
+HIDDEN_USER_FIELDS = frozenset(
+    {'last_login', 'password', 'recipes_count', 'followers_count'})
+
+
+@receiver(post_save, sender=CustomUser)
+@receiver(post_delete, sender=CustomUser)
+def invalidate_authors(sender, instance, created=False, update_fields=None,
+                       **kwargs):
+    if created:
+        return
+    if update_fields is not None and update_fields <= HIDDEN_USER_FIELDS:
+        return
+    response_cache.invalidate_on_commit(RECIPES, RECIPES_DETAIL)
+
+
+# Модель строк -> (модель со счётчиком, ссылка на неё, поле счётчика).
+COUNTERS = {
+    Favorite: (Recipe, 'recipe_id', 'favorites_count'),
+    ShoppingCart: (Recipe, 'recipe_id', 'shopping_cart_count'),
+    Recipe: (CustomUser, 'author_id', 'recipes_count'),
+    Follow: (CustomUser, 'author_id', 'followers_count'),
+}
+
+
+def change_counters(sender, pks, delta):
+    # Для пакетных операций, которые обходят сигналы.
+    model, _, counter = COUNTERS[sender]
+    pks = [pk for pk in pks if pk is not None]
+    if not pks:
+        return
+    counters = model.objects.filter(pk__in=pks)
+    if delta < 0:
+        counters = counters.filter(**{f'{counter}__gte': -delta})
+    counters.update(**{counter: F(counter) + delta})
+
+
+def change_counter(sender, instance, delta):
+    _, field, _ = COUNTERS[sender]
+    change_counters(sender, [getattr(instance, field)], delta)
+
+
+def increment_counter(sender, instance, created, raw=False, **kwargs):
+    if created and not raw:
+        change_counter(sender, instance, 1)
+
+
+def decrement_counter(sender, instance, **kwargs):
+    change_counter(sender, instance, -1)
+
+
+for counted_model in COUNTERS:
+    post_save.connect(increment_counter, sender=counted_model)
+    post_delete.connect(decrement_counter, sender=counted_model)
@@ -0,0 +1,1016 @@
+import io
+import json
+import shutil
+import tempfile
+import threading
+from contextlib import ExitStack
+from unittest import mock, skipIf, skipUnless
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.management import CommandError, call_command
+from django.db import OperationalError, connection, connections
+from django.db.backends.utils import CursorWrapper
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from rest_framework.authtoken.models import Token
+from rest_framework.test import APIClient
+
+from api import benchmark
+from api.authentication import TokenCache
+from api.explain import get_hot_paths, seq_scans
+from api.middleware import QueryBudgetExceeded
+from api.replicas import replica_health
+from api.search import RecipeMatchIndex, ingredient_index
+from api.throttling import TokenBucketStore
+from api.views import RecipeViewSet
+from recipes.models import (Favorite, Ingredient, IngredientAmount, Recipe,
+                            ShoppingCart, ShoppingListItem, Tag)
+from users.models import CustomUser, Follow
+
+RECIPE_LIST_QUERIES = 5
+
+
+class RecipeListQueriesTest(TestCase):
+    # Число запросов страницы рецептов не зависит от её размера
+    # и от того, авторизован ли пользователь.
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = benchmark.seed(
+            users=10, recipes=120, ingredients=100, tags=5)['user']
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def get_client(self, user):
+        client = APIClient()
+        if user is not None:
+            client.force_authenticate(user)
+        return client
+
+    def test_page_query_count_is_constant(self):
+        for user in (None, self.user):
+            for limit in (6, 50):
+                with self.subTest(user=user, limit=limit):
+                    with self.assertNumQueries(RECIPE_LIST_QUERIES):
+                        response = self.get_client(user).get(
+                            reverse('recipes-list'), {'limit': limit})
+                    self.assertEqual(response.status_code, 200)
+                    self.assertEqual(len(response.data['results']), limit)
+
+
+class CursorPaginationTest(TestCase):
+    # Курсор продолжает порядок выдачи, а не сортирует по id.
+
+    @classmethod
+    def setUpTestData(cls):
+        benchmark.seed(users=3, recipes=12, ingredients=20, tags=2)
+        recipes = list(Recipe.objects.order_by('id'))
+        for index, recipe in enumerate(recipes):
+            recipe.trending_score = index % 4
+        Recipe.objects.bulk_update(recipes, ['trending_score'])
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def read_pages(self, params):
+        ids = []
+        response = self.client.get(reverse('recipes-list'), params)
+        while True:
+            self.assertEqual(response.status_code, 200)
+            ids.extend(item['id'] for item in response.data['results'])
+            if not response.data['next']:
+                return ids
+            response = self.client.get(response.data['next'])
+
+    def test_default_order(self):
+        self.assertEqual(
+            self.read_pages({'pagination': 'cursor', 'limit': 5}),
+            list(Recipe.objects.order_by('id').values_list('id', flat=True)))
+
+    def test_trending_order(self):
+        self.assertEqual(
+            self.read_pages({'pagination': 'cursor', 'limit': 5,
+                             'ordering': 'trending'}),
+            list(Recipe.objects.trending().values_list('id', flat=True)))
+
+    def test_search_rejected(self):
+        response = self.client.get(
+            reverse('recipes-list'),
+            {'pagination': 'cursor', 'search': 'рецепт'})
+        self.assertEqual(response.status_code, 400)
+
+
+class QueryInstrumentationTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        benchmark.seed(users=3, recipes=10, ingredients=20, tags=2)
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def test_server_timing_header(self):
+        response = self.client.get(reverse('recipes-list'))
+        self.assertRegex(
+            response['Server-Timing'],
+            rf'^db;dur=[\d.]+;desc="{RECIPE_LIST_QUERIES} queries"$')
+
+    def test_over_budget_warns(self):
+        with mock.patch.object(RecipeViewSet, 'query_budget', {'list': 1}):
+            with self.assertLogs('api.sql', 'WARNING') as logs:
+                response = self.client.get(reverse('recipes-list'))
+        self.assertEqual(response.status_code, 200)
+        record = json.loads(logs.records[0].getMessage())
+        self.assertEqual(record['budget'], 1)
+        self.assertEqual(record['queries'], RECIPE_LIST_QUERIES)
+
+    @override_settings(SQL_INSTRUMENTATION_STRICT=True)
+    def test_strict_mode_raises(self):
+        response = self.client.get(reverse('recipes-list'))
+        self.assertEqual(response.status_code, 200)
+        caches['default'].clear()
+        with mock.patch.object(RecipeViewSet, 'query_budget', {'list': 1}):
+            with self.assertLogs('api.sql', 'WARNING'):
+                with self.assertRaises(QueryBudgetExceeded):
+                    self.client.get(reverse('recipes-list'))
+
+
+class IngredientUniqueTest(TestCase):
+    # Дубль названия с той же единицей - ошибка валидации, а не 500.
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.admin = CustomUser.objects.create_superuser(
+            'admin@example.org', 'admin', 'password',
+            first_name='Admin', last_name='Admin')
+        Ingredient.objects.create(name='соль', measurement_unit='г')
+
+    def test_api_duplicate(self):
+        client = APIClient()
+        client.force_authenticate(self.admin)
+        response = client.post(
+            reverse('ingredients-list'),
+            {'name': 'соль', 'measurement_unit': 'г'}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = client.post(
+            reverse('ingredients-list'),
+            {'name': 'соль', 'measurement_unit': 'кг'}, format='json')
+        self.assertEqual(response.status_code, 201)
+
+    def test_admin_duplicate(self):
+        self.client.force_login(self.admin)
+        response = self.client.post(
+            reverse('admin:recipes_ingredient_add'),
+            {'name': 'соль', 'measurement_unit': 'г'})
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue(response.context['adminform'].form.errors)
+        self.assertEqual(Ingredient.objects.filter(name='соль').count(), 1)
+
+
+class AuthorCacheInvalidationTest(TransactionTestCase):
+    # Кеш ответов сбрасывается на коммите, поэтому TransactionTestCase.
+    # Вне транзакции GET уходит на реплику, если она настроена.
+    databases = {'default', *settings.DATABASE_REPLICAS}
+
+    def setUp(self):
+        caches['default'].clear()
+        benchmark.seed(users=3, recipes=10, ingredients=20, tags=2)
+        self.author = Recipe.objects.select_related('author').first().author
+        self.author.set_password('password')
+        self.author.save(update_fields=['password'])
+
+    def get_recipes(self, queries):
+        with ExitStack() as stack:
+            captured = [
+                stack.enter_context(CaptureQueriesContext(connections[alias]))
+                for alias in self.databases
+            ]
+            response = APIClient().get(reverse('recipes-list'))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(sum(len(queries) for queries in captured), queries)
+
+    def test_login_keeps_cache(self):
+        self.client.get(reverse('recipes-list'))
+        self.get_recipes(0)
+        response = APIClient().post(
+            '/api/auth/token/login/',
+            {'email': self.author.email, 'password': 'password'})
+        self.assertEqual(response.status_code, 200)
+        self.get_recipes(0)
+
+    def test_profile_change_invalidates(self):
+        self.client.get(reverse('recipes-list'))
+        self.author.first_name = 'Новое имя'
+        self.author.save()
+        self.get_recipes(RECIPE_LIST_QUERIES)
+
+
+class ShoppingListAggregateTest(TestCase):
+    # Сводный список покупок остается согласованным с корзинами
+    # при удалении рецептов и пользователей в обход API.
+
+    @classmethod
+    def setUpTestData(cls):
+        benchmark.seed(users=10, recipes=60, ingredients=50, tags=3)
+
+    def assertShoppingListsConsistent(self):
+        expected = {
+            (row['user_id'], row['ingredient_id']): row['total']
+            for row in ShoppingListItem.objects.cart_totals()
+        }
+        actual = {
+            (user_id, ingredient_id): amount
+            for user_id, ingredient_id, amount in
+            ShoppingListItem.objects.values_list(
+                'user_id', 'ingredient_id', 'amount')
+        }
+        self.assertEqual(actual, expected)
+
+    def test_recipe_delete(self):
+        Recipe.objects.filter(shopping_cart__isnull=False).first().delete()
+        self.assertShoppingListsConsistent()
+
+    def test_user_delete_cascade(self):
+        CustomUser.objects.filter(
+            recipes__shopping_cart__isnull=False).first().delete()
+        self.assertShoppingListsConsistent()
+
+
+class BatchRelationTest(TestCase):
+    # Пакетные POST/DELETE для корзины, избранного и подписок.
+
+    @classmethod
+    def setUpTestData(cls):
+        data = benchmark.seed(users=4, recipes=6, ingredients=20, tags=2,
+                              favorites=0, carts=0, follows=0)
+        cls.user = data['user']
+        cls.recipe_ids = data['recipe_ids'][:3]
+        cls.author_ids = list(CustomUser.objects.exclude(
+            pk=cls.user.pk).values_list('pk', flat=True))
+
+    def setUp(self):
+        caches['default'].clear()
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def test_cart_add_and_remove(self):
+        path = reverse('shopping_cart_batch')
+        response = self.client.post(
+            path, {'recipes': self.recipe_ids}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(len(response.data), len(self.recipe_ids))
+        response = self.client.post(
+            path, {'recipes': self.recipe_ids}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data, [])
+        self.assertEqual(Recipe.objects.get(
+            pk=self.recipe_ids[0]).shopping_cart_count, 1)
+        response = self.client.delete(
+            path, {'recipes': self.recipe_ids[:1]}, format='json')
+        self.assertEqual(response.status_code, 204)
+        self.assertEqual(
+            set(ShoppingCart.objects.filter(user=self.user).values_list(
+                'recipe_id', flat=True)), set(self.recipe_ids[1:]))
+        self.assertEqual(Recipe.objects.get(
+            pk=self.recipe_ids[0]).shopping_cart_count, 0)
+        self.assertEqual(
+            dict(ShoppingListItem.objects.filter(
+                user=self.user).values_list('ingredient_id', 'amount')),
+            {row['ingredient_id']: row['total']
+             for row in ShoppingListItem.objects.cart_totals()
+             if row['user_id'] == self.user.pk},
+        )
+
+    def test_add_rejects_missing_recipes(self):
+        response = self.client.post(
+            reverse('favorite_batch'),
+            {'recipes': [self.recipe_ids[0], 10 ** 6]}, format='json')
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(Favorite.objects.filter(user=self.user).exists())
+
+    def test_delete_requires_explicit_all(self):
+        path = reverse('favorite_batch')
+        self.client.post(path, {'recipes': self.recipe_ids}, format='json')
+        for body in ({}, {'recipe': self.recipe_ids[:1]},
+                     {'recipes': self.recipe_ids[:1], 'all': True},
+                     {'recipes': self.recipe_ids[:1], 'extra': 1}):
+            with self.subTest(body=body):
+                response = self.client.delete(path, body, format='json')
+                self.assertEqual(response.status_code, 400)
+        self.assertEqual(
+            Favorite.objects.filter(user=self.user).count(),
+            len(self.recipe_ids))
+        response = self.client.post(path, {'all': True}, format='json')
+        self.assertEqual(response.status_code, 400)
+        response = self.client.delete(path, {'all': True}, format='json')
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Favorite.objects.filter(user=self.user).exists())
+
+    def test_follow_add_and_clear(self):
+        path = reverse('follow_batch')
+        response = self.client.post(
+            path, {'authors': self.author_ids}, format='json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(
+            {item['id'] for item in response.data}, set(self.author_ids))
+        response = self.client.delete(path, {'all': True}, format='json')
+        self.assertEqual(response.status_code, 204)
+        self.assertFalse(Follow.objects.filter(user=self.user).exists())
+        self.assertFalse(CustomUser.objects.filter(
+            pk__in=self.author_ids, followers_count__gt=0).exists())
+
+
+@skipIf(connection.vendor == 'sqlite',
+        'SQLite блокирует всю базу на запись, гонки не воспроизводятся')
+class ConcurrentAddTest(TransactionTestCase):
+    # Одновременные добавления одного рецепта: ровно один 201,
+    # остальные 400 и никаких IntegrityError.
+    threads = 8
+
+    def setUp(self):
+        caches['default'].clear()
+        data = benchmark.seed(users=2, recipes=self.threads, ingredients=20,
+                              tags=2, favorites=0, carts=0, follows=0)
+        self.user = data['user']
+        self.recipe_ids = data['recipe_ids']
+        self.recipe = Recipe.objects.get(pk=self.recipe_ids[0])
+
+    def request_concurrently(self, requests):
+        barrier = threading.Barrier(len(requests))
+        statuses = []
+
+        def send(method, path):
+            client = APIClient()
+            client.force_authenticate(self.user)
+            barrier.wait()
+            try:
+                statuses.append(getattr(client, method)(path).status_code)
+            except Exception:
+                statuses.append(500)
+            finally:
+                connection.close()
+
+        workers = [threading.Thread(target=send, args=request)
+                   for request in requests]
+        for worker in workers:
+            worker.start()
+        for worker in workers:
+            worker.join()
+        return statuses
+
+    def post_concurrently(self, path):
+        return self.request_concurrently([('post', path)] * self.threads)
+
+    def assertOneCreated(self, statuses):
+        self.assertEqual(statuses.count(201), 1, statuses)
+        self.assertEqual(statuses.count(400), self.threads - 1, statuses)
+
+    def test_favorite(self):
+        self.assertOneCreated(self.post_concurrently(
+            reverse('favorite', args=[self.recipe.pk])))
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.favorites_count, 1)
+
+    def test_shopping_cart(self):
+        self.assertOneCreated(self.post_concurrently(
+            reverse('shopping_cart', args=[self.recipe.pk])))
+        self.recipe.refresh_from_db()
+        self.assertEqual(self.recipe.shopping_cart_count, 1)
+        self.assertEqual(
+            dict(ShoppingListItem.objects.filter(
+                user=self.user).values_list('ingredient_id', 'amount')),
+            dict(IngredientAmount.objects.filter(
+                recipe=self.recipe).values_list('ingredient_id', 'amount')),
+        )
+
+    def test_shopping_cart_add_and_remove(self):
+        # Один рецепт уходит из корзины, остальные добавляются, у всех
+        # один ингредиент: его строка в списке покупок обнуляется и
+        # удаляется одновременно с прибавками от других запросов.
+        ingredient = Ingredient.objects.first()
+        IngredientAmount.objects.filter(recipe_id__in=self.recipe_ids).delete()
+        IngredientAmount.objects.bulk_create(
+            IngredientAmount(recipe_id=recipe_id, ingredient=ingredient,
+                             amount=10)
+            for recipe_id in self.recipe_ids)
+        removed, added = self.recipe_ids[:1], self.recipe_ids[1:]
+        for recipe_id in removed:
+            ShoppingCart.objects.add(user=self.user, recipe_id=recipe_id)
+        statuses = self.request_concurrently(
+            [('delete', reverse('shopping_cart', args=[recipe_id]))
+             for recipe_id in removed]
+            + [('post', reverse('shopping_cart', args=[recipe_id]))
+               for recipe_id in added])
+        self.assertEqual(sorted(statuses), [201] * len(added)
+                         + [204] * len(removed), statuses)
+        self.assertEqual(
+            dict(ShoppingListItem.objects.filter(
+                user=self.user).values_list('ingredient_id', 'amount')),
+            {ingredient.pk: 10 * len(added)},
+        )
+
+
+@skipUnless(settings.DATABASE_REPLICAS,
+            'Реплики не настроены: задайте DB_REPLICAS')
+class ReplicaRoutingTest(TransactionTestCase):
+    # Реплики в тестах - зеркала default (TEST MIRROR), поэтому видят
+    # те же данные; по журналам соединений видно, куда ушли запросы.
+    databases = {'default', *settings.DATABASE_REPLICAS}
+
+    def setUp(self):
+        caches['default'].clear()
+        replica_health._down_until.clear()
+        data = benchmark.seed(users=2, recipes=5, ingredients=20, tags=2,
+                              favorites=0, carts=0, follows=0)
+        self.user = data['user']
+        self.recipe_id = data['recipe_ids'][0]
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_recipes(self):
+        caches['default'].clear()
+        with CaptureQueriesContext(connections['default']) as primary:
+            with ExitStack() as stack:
+                replicas = [
+                    stack.enter_context(
+                        CaptureQueriesContext(connections[alias]))
+                    for alias in settings.DATABASE_REPLICAS
+                ]
+                response = self.client.get(reverse('recipes-list'))
+        self.assertEqual(response.status_code, 200)
+        return len(primary), sum(len(queries) for queries in replicas)
+
+    def test_reads_from_replica(self):
+        primary, replica = self.get_recipes()
+        self.assertEqual(primary, 0)
+        self.assertGreater(replica, 0)
+        self.assertNotIn(settings.REPLICA_PIN_COOKIE, self.client.cookies)
+
+    def test_pinned_to_primary_after_write(self):
+        response = self.client.post(
+            reverse('favorite', args=[self.recipe_id]))
+        self.assertEqual(response.status_code, 201)
+        self.assertIn(settings.REPLICA_PIN_COOKIE, response.cookies)
+        primary, replica = self.get_recipes()
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+
+    def test_failover_to_primary(self):
+        execute = CursorWrapper._execute
+
+        def broken_replica(cursor, *args):
+            if cursor.db.alias in settings.DATABASE_REPLICAS:
+                raise OperationalError('реплика недоступна')
+            return execute(cursor, *args)
+
+        with mock.patch.object(CursorWrapper, '_execute', autospec=True,
+                               side_effect=broken_replica):
+            primary, replica = self.get_recipes()
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica_health.available(), [])
+        # Пока реплика исключена, чтения сразу идут в основную базу.
+        primary, replica = self.get_recipes()
+        self.assertGreater(primary, 0)
+        self.assertEqual(replica, 0)
+
+
+class ShoppingListDownloadTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(
+            email='cook@example.org', username='cook', password='password')
+        salt = Ingredient.objects.create(name='соль', measurement_unit='г')
+        flour = Ingredient.objects.create(name='мука', measurement_unit='г')
+        for amounts in ({salt: 5, flour: 100}, {salt: 10}):
+            recipe = Recipe.objects.create(
+                author=cls.user, name='Рецепт', text='Текст', cooking_time=1)
+            IngredientAmount.objects.bulk_create(
+                IngredientAmount(
+                    recipe=recipe, ingredient=ingredient, amount=amount)
+                for ingredient, amount in amounts.items())
+            ShoppingCart.objects.create(user=cls.user, recipe=recipe)
+
+    def download(self, file_format):
+        client = APIClient()
+        client.force_authenticate(self.user)
+        response = client.get(
+            reverse('recipes-download-shopping-cart'),
+            {'format': file_format})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            response['Content-Disposition'],
+            f'attachment; filename="shop_list.{file_format}"')
+        return b''.join(response.streaming_content).decode()
+
+    def test_txt(self):
+        self.assertEqual(
+            self.download('txt'), 'мука – 100г.\nсоль – 15г.\n')
+
+    def test_csv(self):
+        self.assertEqual(
+            self.download('csv').splitlines(),
+            ['name,amount,measurement_unit', 'мука,100,г', 'соль,15,г'])
+
+    def test_json(self):
+        self.assertEqual(json.loads(self.download('json')), [
+            {'name': 'мука', 'amount': 100, 'measurement_unit': 'г'},
+            {'name': 'соль', 'amount': 15, 'measurement_unit': 'г'},
+        ])
+
+    def test_anonymous(self):
+        response = self.client.get(reverse('recipes-download-shopping-cart'))
+        self.assertEqual(response.status_code, 401)
+
+
+class IngredientAutocompleteTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        Ingredient.objects.bulk_create(
+            Ingredient(name=name, measurement_unit='г')
+            for name in ('Соль', 'соль морская', 'сода', 'фасоль', 'мука'))
+
+    def setUp(self):
+        caches['default'].clear()
+        ingredient_index.invalidate()
+
+    def search(self, name):
+        response = self.client.get(reverse('ingredients-list'), {'name': name})
+        self.assertEqual(response.status_code, 200)
+        return [item['name'] for item in response.data]
+
+    def test_prefix_then_substring(self):
+        self.assertEqual(
+            self.search('СОЛ'), ['Соль', 'соль морская', 'фасоль'])
+        self.assertEqual(self.search('со'), [
+            'сода', 'Соль', 'соль морская', 'фасоль'])
+        self.assertEqual(self.search('нет'), [])
+
+    @override_settings(INGREDIENT_SEARCH_LIMIT=2)
+    def test_limit(self):
+        self.assertEqual(self.search('со'), ['сода', 'Соль'])
+
+    def test_new_ingredient_is_found(self):
+        # Индекс уже собран, сигнал сбрасывает его при сохранении.
+        self.assertEqual(len(ingredient_index.search('сол')), 3)
+        Ingredient.objects.create(name='солод', measurement_unit='г')
+        self.assertIn('солод', [
+            entry['name'] for entry in ingredient_index.search('сол')])
+
+
+class SubscriptionsTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user, first, second = (
+            CustomUser.objects.create_user(
+                email=f'user{index}@example.org', username=f'user{index}',
+                password='password')
+            for index in range(3))
+        for author, count in ((first, 3), (second, 1)):
+            for index in range(count):
+                Recipe.objects.create(
+                    author=author, name=f'Рецепт {index}', text='Текст',
+                    cooking_time=1)
+            Follow.objects.create(user=cls.user, author=author)
+
+    def setUp(self):
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def get_subscriptions(self, params):
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('subscriptions'), params)
+        self.assertEqual(response.status_code, 200)
+        return response.data['results'], len(queries)
+
+    def test_recipes_limit(self):
+        subscriptions, _ = self.get_subscriptions({'recipes_limit': 2})
+        self.assertEqual(
+            [(len(item['recipes']), item['recipes_count'])
+             for item in subscriptions],
+            [(2, 3), (1, 1)])
+        first = Recipe.objects.filter(
+            author_id=subscriptions[0]['id']).order_by('id')
+        self.assertEqual(
+            [recipe['id'] for recipe in subscriptions[0]['recipes']],
+            [recipe.id for recipe in first[:2]])
+        subscriptions, _ = self.get_subscriptions({})
+        self.assertEqual(len(subscriptions[0]['recipes']), 3)
+
+    def test_query_count_does_not_grow(self):
+        _, before = self.get_subscriptions({'recipes_limit': 2})
+        author = CustomUser.objects.create_user(
+            email='new@example.org', username='new', password='password')
+        Recipe.objects.create(
+            author=author, name='Рецепт', text='Текст', cooking_time=1)
+        Follow.objects.create(user=self.user, author=author)
+        subscriptions, after = self.get_subscriptions({'recipes_limit': 2})
+        self.assertEqual(len(subscriptions), 3)
+        self.assertEqual(after, before)
+
+
+class BenchmarkTest(TestCase):
+
+    def test_scenarios_succeed(self):
+        # Сценарии benchmark_api не должны устаревать вместе с API.
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        data = benchmark.seed(users=5, recipes=20, ingredients=30, tags=3)
+        with override_settings(MEDIA_ROOT=media_root,
+                               RECIPE_IMAGE_ASYNC=False,
+                               THROTTLE_ENABLED=False):
+            for name, user, method, path, body in benchmark.get_scenarios(
+                    data):
+                with self.subTest(name=name):
+                    result = benchmark.run_scenario(
+                        benchmark.make_client(user), method, path, body,
+                        iterations=1)
+                    self.assertLess(result['status'], 400)
+
+    def test_compare(self):
+        baseline = {
+            'recipes': {'queries': 5, 'p95_ms': 10.0, 'peak_kb': 100.0},
+            'tags': {'queries': 1, 'p95_ms': 1.0, 'peak_kb': 10.0},
+        }
+        within = {
+            'recipes': {'queries': 5, 'p95_ms': 12.0, 'peak_kb': 160.0},
+            'tags': {'queries': 1, 'p95_ms': 2.9, 'peak_kb': 10.0},
+            'new': {'queries': 100, 'p95_ms': 100.0, 'peak_kb': 1000.0},
+        }
+        self.assertEqual(benchmark.compare(within, baseline, 0.25), [])
+        worse = {
+            'recipes': {'queries': 6, 'p95_ms': 13.0, 'peak_kb': 100.0},
+            'tags': {'queries': 1, 'p95_ms': 1.0, 'peak_kb': 80.0},
+        }
+        failures = benchmark.compare(worse, baseline, 0.25)
+        self.assertEqual(len(failures), 3)
+        self.assertTrue(failures[0].startswith('recipes: запросов 6'))
+
+
+class RecipeSearchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        author = CustomUser.objects.create_user(
+            email='cook@example.org', username='cook', password='password')
+        beet = Ingredient.objects.create(name='свекла', measurement_unit='г')
+        cls.recipes = {}
+        for name, text, ingredients in (
+                ('Салат', 'Подавать как борщ, холодным', []),
+                ('Борщ', 'Варить два часа', [beet]),
+                ('Омлет', 'Взбить яйца', [])):
+            recipe = Recipe.objects.create(
+                author=author, name=name, text=text, cooking_time=1)
+            for ingredient in ingredients:
+                IngredientAmount.objects.create(
+                    recipe=recipe, ingredient=ingredient, amount=1)
+            cls.recipes[name] = recipe.id
+        Recipe.objects.update_search_documents()
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def search(self, query):
+        response = self.client.get(
+            reverse('recipes-list'), {'search': query})
+        self.assertEqual(response.status_code, 200)
+        return [item['id'] for item in response.data['results']]
+
+    def test_name_ranks_first(self):
+        self.assertEqual(self.search('борщ'), [
+            self.recipes['Борщ'], self.recipes['Салат']])
+
+    def test_ingredient_names(self):
+        self.assertEqual(self.search('свекла'), [self.recipes['Борщ']])
+
+    def test_no_match(self):
+        self.assertEqual(self.search('пицца'), [])
+        self.assertEqual(len(self.search('  ')), 3)
+
+
+class RecipeMatchTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        author = CustomUser.objects.create_user(
+            email='cook@example.org', username='cook', password='password')
+        cls.ingredients = [
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('a', 'b', 'c', 'd')]
+        cls.recipes = []
+        for indexes in ((0, 1), (0, 1, 2), (2, 3), (0,)):
+            recipe = Recipe.objects.create(
+                author=author, name='Рецепт', text='Текст', cooking_time=1)
+            IngredientAmount.objects.bulk_create(
+                IngredientAmount(
+                    recipe=recipe, ingredient=cls.ingredients[index],
+                    amount=1)
+                for index in indexes)
+            cls.recipes.append(recipe.id)
+
+    def setUp(self):
+        # Индекс живет в памяти процесса, у каждого теста свой.
+        self.index = RecipeMatchIndex()
+        patcher = mock.patch('api.views.recipe_match_index', self.index)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def match(self, **params):
+        params['ingredients'] = ','.join(
+            str(ingredient.id) for ingredient in self.ingredients[:2])
+        response = self.client.get(reverse('recipes-match'), params)
+        self.assertEqual(response.status_code, 200)
+        return [(item['id'], item['missing_ingredients'],
+                 item['matched_ingredients'])
+                for item in response.data['results']]
+
+    def assertMatches(self):
+        first, second, third, fourth = self.recipes
+        self.assertEqual(self.match(), [
+            (first, 0, 2), (fourth, 0, 1), (second, 1, 2)])
+        self.assertEqual(self.match(max_missing=0), [
+            (first, 0, 2), (fourth, 0, 1)])
+        # Изменения после сборки снимка видны сразу.
+        self.index.update_recipe(third, [
+            ingredient.id for ingredient in self.ingredients[:2]])
+        self.index.remove_recipe(fourth)
+        self.assertEqual(self.match(), [
+            (first, 0, 2), (third, 0, 2), (second, 1, 2)])
+
+    def test_match(self):
+        self.assertMatches()
+
+    def test_match_without_numpy(self):
+        with mock.patch('api.search.numpy', None):
+            self.assertMatches()
+
+    def test_requires_ingredients(self):
+        response = self.client.get(
+            reverse('recipes-match'), {'ingredients': 'соль'})
+        self.assertEqual(response.status_code, 400)
+
+
+class SimilarRecipesTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        author = CustomUser.objects.create_user(
+            email='cook@example.org', username='cook', password='password')
+        ingredients = [
+            Ingredient.objects.create(name=name, measurement_unit='г')
+            for name in ('a', 'b', 'c', 'd')]
+        cls.recipes = []
+        for indexes in ((0, 1, 2), (0, 1, 3), (0, 3), (3,)):
+            recipe = Recipe.objects.create(
+                author=author, name='Рецепт', text='Текст', cooking_time=1)
+            IngredientAmount.objects.bulk_create(
+                IngredientAmount(
+                    recipe=recipe, ingredient=ingredients[index], amount=1)
+                for index in indexes)
+            cls.recipes.append(recipe.id)
+        call_command('build_similar', stdout=io.StringIO())
+
+    def setUp(self):
+        caches['default'].clear()
+
+    def get_similar(self, recipe_id):
+        return self.client.get(reverse('recipes-similar', args=[recipe_id]))
+
+    def test_ranked_by_similarity(self):
+        first, second, third, _ = self.recipes
+        response = self.get_similar(first)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            [(item['id'], round(item['similarity'], 2))
+             for item in response.data],
+            [(second, 0.5), (third, 0.25)])
+
+    @override_settings(SIMILAR_RECIPES_LIMIT=1)
+    def test_limit(self):
+        self.assertEqual(len(self.get_similar(self.recipes[0]).data), 1)
+
+    def test_unknown_recipe(self):
+        self.assertEqual(self.get_similar(0).status_code, 404)
+
+
+class TokenCacheTest(TransactionTestCase):
+    databases = {'default', *settings.DATABASE_REPLICAS}
+
+    def setUp(self):
+        self.user = CustomUser.objects.create_user(
+            email='cook@example.org', username='cook', password='password')
+        self.token = Token.objects.create(user=self.user)
+        self.client = APIClient()
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {self.token.key}')
+
+    def get_me(self):
+        with ExitStack() as stack:
+            captured = [
+                stack.enter_context(CaptureQueriesContext(connections[alias]))
+                for alias in self.databases
+            ]
+            response = self.client.get(reverse('users-me'))
+        token_queries = [
+            query for queries in captured for query in queries
+            if Token._meta.db_table in query['sql']]
+        return response.status_code, len(token_queries)
+
+    def test_token_is_cached(self):
+        self.assertEqual(self.get_me(), (200, 1))
+        self.assertEqual(self.get_me(), (200, 0))
+
+    def assertRejected(self):
+        # С репликами отказ повторяется на основной базе: два запроса.
+        status, queries = self.get_me()
+        self.assertEqual(status, 401)
+        self.assertGreater(queries, 0)
+
+    def test_user_change_invalidates(self):
+        self.get_me()
+        self.user.is_active = False
+        self.user.save()
+        self.assertRejected()
+
+    def test_token_delete_invalidates(self):
+        self.get_me()
+        self.token.delete()
+        self.assertRejected()
+
+    @override_settings(AUTH_TOKEN_CACHE_SIZE=1)
+    def test_lru_size(self):
+        cache = TokenCache()
+        cache.set('first', self.token)
+        cache.set('second', self.token)
+        self.assertIsNone(cache.get('first'))
+        self.assertEqual(cache.get('second').key, self.token.key)
+
+
+class ExplainHotPathsTest(TestCase):
+
+    def test_seq_scans(self):
+        self.assertEqual(seq_scans(
+            'Limit\n  ->  Seq Scan on recipes_recipe\n'
+            '  ->  Index Scan using x on recipes_tag\n'
+            '  ->  Seq Scan on recipes_favorite', 'postgresql'),
+            ['recipes_favorite', 'recipes_recipe'])
+        self.assertEqual(seq_scans(
+            '3 0 0 SCAN recipes_ingredient\n'
+            '5 0 0 SCAN recipes_tag USING INDEX tag_slug\n'
+            '7 0 0 SCAN recipes_recipe_fts VIRTUAL TABLE INDEX 0:M1',
+            'sqlite'),
+            ['recipes_ingredient'])
+        self.assertEqual(seq_scans('Seq Scan on x', 'mysql'), [])
+
+    def explain(self, *args):
+        stdout = io.StringIO()
+        call_command('explain_hot_paths', *args, stdout=stdout)
+        return dict(
+            line.split(': ', 1) for line in stdout.getvalue().splitlines())
+
+    def test_reports_every_path(self):
+        benchmark.seed(users=5, recipes=30, ingredients=40, tags=3)
+        report = self.explain()
+        self.assertEqual(
+            list(report),
+            [name for name, _ in get_hot_paths(CustomUser.objects.first())])
+        if connection.vendor == 'sqlite':
+            # Индекс ленты автора из миграции для горячих запросов.
+            self.assertEqual(report['recipes_author'], 'ok')
+            self.assertEqual(report['subscriptions_recipes'], 'ok')
+
+    def test_strict(self):
+        CustomUser.objects.create_user(
+            email='cook@example.org', username='cook', password='password')
+        paths = [('feed', 'SCAN recipes_recipe', ['recipes_recipe'])]
+        with mock.patch(
+                'api.management.commands.explain_hot_paths.'
+                'explain_hot_paths', return_value=paths):
+            self.assertEqual(
+                self.explain(), {'feed': 'полный просмотр recipes_recipe'})
+            with self.assertRaises(CommandError):
+                self.explain('--strict')
+
+
+@override_settings(THROTTLE_BUCKETS={
+    'user': {'capacity': 10, 'rate': 1.0},
+    'ip': {'capacity': 10, 'rate': 1.0},
+})
+class ThrottlingTest(TestCase):
+
+    def setUp(self):
+        caches['default'].clear()
+        patcher = mock.patch('api.throttling.token_buckets',
+                             TokenBucketStore())
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.now = 1000.0
+        clock = mock.patch('api.throttling.time')
+        clock.start().time.side_effect = lambda: self.now
+        self.addCleanup(clock.stop)
+
+    def get_ingredients(self, params=None):
+        return self.client.get(reverse('ingredients-list'), params)
+
+    def test_expensive_calls_spend_tokens(self):
+        # Полный справочник стоит 5 жетонов из 10.
+        self.assertEqual(self.get_ingredients().status_code, 200)
+        self.assertEqual(self.get_ingredients().status_code, 200)
+        response = self.get_ingredients()
+        self.assertEqual(response.status_code, 429)
+        self.assertEqual(response['Retry-After'], '5')
+        # Поиск по индексу бесплатный и в лимит не упирается.
+        self.assertEqual(
+            self.get_ingredients({'name': 'соль'}).status_code, 200)
+        self.now += 5
+        self.assertEqual(self.get_ingredients().status_code, 200)
+
+    @override_settings(THROTTLE_ENABLED=False)
+    def test_disabled(self):
+        for _ in range(3):
+            self.assertEqual(self.get_ingredients().status_code, 200)
+
+
+@override_settings(THROTTLE_ENABLED=False)
+class RecipeWriteTest(TestCase):
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.user = CustomUser.objects.create_user(
+            email='cook@example.org', username='cook', password='password')
+        cls.ingredients = [
+            Ingredient.objects.create(name=f'ингредиент {index}',
+                                      measurement_unit='г')
+            for index in range(10)]
+        cls.tags = [
+            Tag.objects.create(name=f'Тег {index}', slug=f'tag-{index}',
+                               color=f'#00000{index}')
+            for index in range(3)]
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        media = override_settings(MEDIA_ROOT=media_root)
+        media.enable()
+        self.addCleanup(media.disable)
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def body(self, amounts, tags):
+        return {
+            'name': 'Рецепт',
+            'text': 'Описание',
+            'cooking_time': 10,
+            'image': benchmark.IMAGE,
+            'tags': [tag.id for tag in tags],
+            'ingredients': [
+                {'id': ingredient.id, 'amount': amount}
+                for ingredient, amount in amounts.items()],
+        }
+
+    def write(self, method, path, body):
+        with CaptureQueriesContext(connection) as queries:
+            response = getattr(self.client, method)(path, body, format='json')
+        self.assertIn(response.status_code, (200, 201), response.data)
+        return response.data, len(queries)
+
+    def amounts(self, recipe_id):
+        return dict(IngredientAmount.objects.filter(
+            recipe_id=recipe_id).values_list('ingredient_id', 'amount'))
+
+    def test_create_queries_do_not_grow(self):
+        # Ингредиенты проверяются и пишутся пачками, а не построчно.
+        _, few = self.write('post', reverse('recipes-list'), self.body(
+            {ingredient: 1 for ingredient in self.ingredients[:2]},
+            self.tags))
+        data, many = self.write('post', reverse('recipes-list'), self.body(
+            {ingredient: 1 for ingredient in self.ingredients},
+            self.tags))
+        self.assertEqual(few, many)
+        self.assertEqual(len(data['ingredients']), 10)
+        self.assertEqual(len(data['tags']), 3)
+
+    def test_update_applies_difference(self):
+        first, second, third, fourth = self.ingredients[:4]
+        data, _ = self.write('post', reverse('recipes-list'), self.body(
+            {first: 1, second: 1, third: 1}, self.tags[:2]))
+        recipe_id = data['id']
+        ShoppingCart.objects.create(user=self.user, recipe_id=recipe_id)
+        kept = IngredientAmount.objects.get(
+            recipe_id=recipe_id, ingredient=third).pk
+        self.write('patch', reverse('recipes-detail', args=[recipe_id]),
+                   self.body({second: 5, third: 1, fourth: 2},
+                             self.tags[1:]))
+        expected = {second.id: 5, third.id: 1, fourth.id: 2}
+        self.assertEqual(self.amounts(recipe_id), expected)
+        self.assertTrue(IngredientAmount.objects.filter(pk=kept).exists())
+        self.assertEqual(
+            set(Recipe.objects.get(pk=recipe_id).tags.all()),
+            set(self.tags[1:]))
+        self.assertEqual(dict(ShoppingListItem.objects.filter(
+            user=self.user).values_list('ingredient_id', 'amount')),
+            expected)
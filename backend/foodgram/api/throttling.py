@@ -0,0 +1,102 @@
+import math
+import threading
+import time
+from collections import OrderedDict
+
+from django.conf import settings
+from django.core.cache import caches
+from rest_framework.throttling import BaseThrottle
+
+# Емкость ведра и пополнение в жетонах в секунду.
+DEFAULT_BUCKETS = {
+    'user': {'capacity': 60, 'rate': 1.0},
+    'ip': {'capacity': 30, 'rate': 0.5},
+}
+
+
+def get_bucket(scope):
+    buckets = getattr(settings, 'THROTTLE_BUCKETS', DEFAULT_BUCKETS)
+    return buckets[scope]
+
+
+def get_throttle_cost(view):
+    # Стоимость действия в жетонах из throttle_costs представления.
+    # Действия без стоимости не ограничиваются и ведро не трогают.
+    costs = getattr(view, 'throttle_costs', None) or {}
+    return costs.get(getattr(view, 'action', None), 0)
+
+
+class TokenBucketStore:
+    # Ведра в памяти процесса (LRU на THROTTLE_MEMORY_SIZE ключей) или,
+    # если задан THROTTLE_CACHE_ALIAS, в общем кеше Django. В общем кеше
+    # чтение и запись не атомарны: одновременные запросы одного клиента
+    # из разных воркеров могут изредка пройти сверх лимита.
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._buckets = OrderedDict()
+
+    @property
+    def max_size(self):
+        return getattr(settings, 'THROTTLE_MEMORY_SIZE', 10000)
+
+    @property
+    def backend(self):
+        alias = getattr(settings, 'THROTTLE_CACHE_ALIAS', None)
+        return caches[alias] if alias else None
+
+    def take(self, key, cost, capacity, rate):
+        # Списывает cost жетонов и возвращает 0 или, если их не хватает,
+        # через сколько секунд они накопятся.
+        backend = self.backend
+        if backend is not None:
+            key = 'api:throttle:' + key
+            state = backend.get(key)
+            wait, state = self.refill(state, cost, capacity, rate)
+            backend.set(key, state, math.ceil(capacity / rate))
+            return wait
+        with self._lock:
+            wait, self._buckets[key] = self.refill(
+                self._buckets.get(key), cost, capacity, rate)
+            self._buckets.move_to_end(key)
+            while len(self._buckets) > self.max_size:
+                self._buckets.popitem(last=False)
+        return wait
+
+    def refill(self, state, cost, capacity, rate):
+        now = time.time()
+        tokens, updated = state or (capacity, now)
+        tokens = min(capacity, tokens + (now - updated) * rate)
+        cost = min(cost, capacity)
+        if tokens >= cost:
+            return 0, (tokens - cost, now)
+        return (cost - tokens) / rate, (tokens, now)
+
+
+token_buckets = TokenBucketStore()
+
+
+class TokenBucketThrottle(BaseThrottle):
+    # Ведро на пользователя, для анонимов - на IP. Дорогие действия
+    # расходуют жетоны по throttle_costs, дешевое чтение бесплатно и
+    # не упирается в лимит, выбранный тяжелыми запросами.
+
+    def allow_request(self, request, view):
+        self.wait_seconds = None
+        if not getattr(settings, 'THROTTLE_ENABLED', True):
+            return True
+        get_cost = getattr(view, 'get_throttle_cost', None)
+        cost = get_cost() if get_cost else get_throttle_cost(view)
+        if not cost:
+            return True
+        if request.user.is_authenticated:
+            scope, ident = 'user', request.user.pk
+        else:
+            scope, ident = 'ip', self.get_ident(request)
+        bucket = get_bucket(scope)
+        self.wait_seconds = token_buckets.take(
+            f'{scope}:{ident}', cost, bucket['capacity'], bucket['rate'])
+        return not self.wait_seconds
+
+    def wait(self):
+        return self.wait_seconds
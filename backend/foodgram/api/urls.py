@@ -33,5 +33,21 @@ urlpatterns = [
         SubscribeView.as_view(),
         name='follow'
     ),
+    # Пакетные операции: тот же адрес без id, список id в теле запроса.
+    path(
+        'recipes/shopping_cart/',
+        ShoppingCartViewSet.as_view(),
+        name='shopping_cart_batch'
+    ),
+    path(
+        'recipes/favorite/',
+        FavoriteViewSet.as_view(),
+        name='favorite_batch'
+    ),
+    path(
+        'users/subscribe/',
+        SubscribeView.as_view(),
+        name='follow_batch'
+    ),
     path('', include(v1_router.urls)),
 ]
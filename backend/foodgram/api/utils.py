@@ -1,64 +1,134 @@
-from django.http.response import HttpResponse
+from django.db import transaction
+from django.db.models import F
+from django.http import Http404
+from django.http.response import StreamingHttpResponse
 from django.shortcuts import get_object_or_404
 from rest_framework import serializers, status
 from rest_framework.response import Response
+from rest_framework.settings import api_settings
 
-from recipes.models import Recipe
+from recipes.models import Recipe, ShoppingListItem
+from .serializers import RecipeIdsSerializer
+from .signals import change_counters
 
+SHOPPING_LIST_CHUNK_SIZE = 500
 
-def download_file_response(list_to_download, filename):
-    response = HttpResponse(list_to_download, 'Content-Type: text/plain')
+
+def shopping_list_items(user):
+    return ShoppingListItem.objects.filter(user=user).values(
+        'amount',
+        name=F('ingredient__name'),
+        measurement_unit=F('ingredient__measurement_unit'),
+    ).order_by('name')
+
+
+def shopping_list_rows(user):
+    return shopping_list_items(user).iterator(
+        chunk_size=SHOPPING_LIST_CHUNK_SIZE)
+
+
+def get_recipes_limit(request):
+    recipes_limit = request.query_params.get('recipes_limit')
+    if recipes_limit is None or not recipes_limit.isdigit():
+        return None
+    return int(recipes_limit)
+
+
+def get_ingredient_ids(request):
+    values = []
+    for value in request.query_params.getlist('ingredients'):
+        values.extend(part for part in value.split(',') if part.strip())
+    if not values:
+        raise serializers.ValidationError(
+            {'ingredients': 'Укажите хотя бы один ингредиент'})
+    if not all(value.strip().isdigit() for value in values):
+        raise serializers.ValidationError(
+            {'ingredients': 'Ингредиенты задаются числовыми id'})
+    return {int(value) for value in values}
+
+
+def get_max_missing(request):
+    max_missing = request.query_params.get('max_missing')
+    if max_missing is None or not max_missing.isdigit():
+        return None
+    return int(max_missing)
+
+
+def get_batch_ids(request, serializer_cls, allow_all=False):
+    # None - явный {"all": true} при удалении: очистить весь список.
+    serializer = serializer_cls(
+        data=request.data, context={'allow_all': allow_all})
+    serializer.is_valid(raise_exception=True)
+    if serializer.validated_data['all']:
+        return None
+    return list(dict.fromkeys(
+        serializer.validated_data[serializer.ids_field]))
+
+
+def batch_add_status(created):
+    # 201, если что-то добавлено; если все уже было - 200 и пустой список.
+    return status.HTTP_201_CREATED if created else status.HTTP_200_OK
+
+
+def download_file_response(content, filename, content_type='text/plain'):
+    response = StreamingHttpResponse(content, content_type=content_type)
     response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    response['X-Accel-Buffering'] = 'no'
     return response
 
 
 class DataMixin:
 
-    def add_to_universal_method(self, model, serializer_crtd_cls,
-                                serializer_cls, recipe_id):
-        value = get_object_or_404(Recipe, pk=recipe_id)
+    def after_add_many(self, user, recipe_ids):
+        pass
+
+    @transaction.atomic
+    def add_to_universal_method(self, model, serializer_cls, recipe_id):
+        recipe = get_object_or_404(Recipe, pk=recipe_id)
         user = self.request.user
-        serializer = serializer_crtd_cls(
-            data={'recipe': recipe_id, 'user': user.id})
-        serializer.is_valid(raise_exception=True)
-        serializer.save(user=self.request.user)
-        obj_data = get_object_or_404(
-            model,
-            recipe=value,
-            user=user,
-        )
-        serializer = serializer_cls(obj_data)
+        obj, created = model.objects.add(user=user, recipe=recipe)
+        if not created:
+            raise serializers.ValidationError(
+                {api_settings.NON_FIELD_ERRORS_KEY: ['Рецепт уже добавлен']})
+        serializer = serializer_cls(obj)
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
+    @transaction.atomic
     def del_from_universal_method(self, model, recipe_id):
         user = self.request.user
-        value = get_object_or_404(Recipe, pk=recipe_id)
-        obj_data = get_object_or_404(
-            model,
-            recipe=value,
-            user=user
-        )
-        obj_data.delete()
+        recipe = get_object_or_404(Recipe, pk=recipe_id)
+        if not model.objects.remove(user=user, recipe=recipe):
+            raise Http404
         return Response(
             'Удаление прошло успешно!', status=status.HTTP_204_NO_CONTENT
         )
 
+    @transaction.atomic
+    def add_many_universal_method(self, model, serializer_cls):
+        recipe_ids = get_batch_ids(self.request, RecipeIdsSerializer)
+        recipes = Recipe.objects.only(
+            'id', 'name', 'image', 'image_variants_source', 'cooking_time'
+        ).in_bulk(recipe_ids)
+        missing = [pk for pk in recipe_ids if pk not in recipes]
+        if missing:
+            raise serializers.ValidationError({'recipes': [
+                f'Рецепты не найдены: {", ".join(map(str, missing))}']})
+        user = self.request.user
+        created = model.objects.add_many('recipe_id', recipe_ids, user=user)
+        added_ids = [obj.recipe_id for obj in created]
+        for obj in created:
+            obj.recipe = recipes[obj.recipe_id]
+        change_counters(model, added_ids, 1)
+        self.after_add_many(user, added_ids)
+        serializer = serializer_cls(created, many=True)
+        return Response(serializer.data, status=batch_add_status(created))
 
-class DataSerializerMixin:
-
-    def create_serializer(self, model, serializer_cls, validated_data):
-        recipe = get_object_or_404(
-            model,
-            pk=validated_data.get('recipe').get('id')
+    @transaction.atomic
+    def del_many_universal_method(self, model):
+        recipe_ids = get_batch_ids(
+            self.request, RecipeIdsSerializer, allow_all=True)
+        user = self.request.user
+        model.objects.remove_many('recipe_id', recipe_ids, user=user)
+        return Response(
+            'Удаление прошло успешно!', status=status.HTTP_204_NO_CONTENT
         )
-        user = validated_data.get('user')
-        return serializer_cls.objects.create(recipe=recipe, user=user)
-
-    def validate_serializer(self, serializer_cls, data):
-        if serializer_cls.objects.filter(
-                recipe__id=data.get('recipe').get('id'),
-                user__id=data.get('user').get('id')).exists():
-            raise serializers.ValidationError(
-                'Рецепт уже добавлен'
-            )
-        return data
@@ -1,32 +1,45 @@
-from django.db.models import Sum
+from django.db import transaction
+from django.db.models import F, prefetch_related_objects
+from django.http import Http404
 from django.shortcuts import get_object_or_404
 from django_filters.rest_framework import DjangoFilterBackend
 from djoser.views import UserViewSet
-from rest_framework import permissions, status, views, viewsets
+from rest_framework import permissions, serializers, status, views, viewsets
 from rest_framework.decorators import action
 from rest_framework.pagination import PageNumberPagination
 from rest_framework.response import Response
-
-from api.paginations import LimitPageNumberPagination
-from recipes.models import (Ingredient, IngredientAmount, Favorite, Recipe,
-                            ShoppingCart, Tag)
+from rest_framework.settings import api_settings
+
+from api.paginations import FeedPagination, LimitPageNumberPagination
+from recipes.models import (Ingredient, Favorite, Recipe, ShoppingCart,
+                            ShoppingListItem, Tag)
+from recipes.similarity import get_similar_limit
+from .cache import (INGREDIENTS, RECIPES, RECIPES_DETAIL, TAGS,
+                    CachedResponseMixin, recipe_namespace)
 from .filters import IngredientSearchFilter, RecipeFilterSet
+from users.managers import recipes_preview
 from users.models import CustomUser, Follow
 from .permissions import IsAdmin, IsAuthorOrAdmin, IsSuperuser
-from .serializers import (FavoriteCreateSerializer, FavoriteSerializer,
-                          FollowCreateSerializer, FollowSerializer,
-                          IngredientSerializer, ListRecipeSerializer,
-                          RecipeSerializer, ShoppingCartCreateSerializer,
-                          ShoppingCartSerializer, TagSerializer,
+from .renderers import SHOPPING_LIST_RENDERERS
+from .search import ingredient_index, recipe_match_index
+from .serializers import (AuthorIdsSerializer, FavoriteSerializer,
+                          FollowSerializer, IngredientSerializer,
+                          ListRecipeSerializer, MatchedRecipeSerializer,
+                          RecipeSerializer, ShoppingCartSerializer,
+                          SimilarRecipeSerializer, TagSerializer,
                           UserSerializer)
-from .utils import DataMixin, download_file_response
+from .signals import change_counters
+from .throttling import get_throttle_cost
+from .utils import (DataMixin, batch_add_status, download_file_response,
+                    get_batch_ids, get_ingredient_ids, get_max_missing,
+                    get_recipes_limit, shopping_list_rows)
 
 
 class CreateUserView(UserViewSet):
     serializer_class = UserSerializer
 
     def get_queryset(self):
-        return CustomUser.objects.all()
+        return CustomUser.objects.with_is_subscribed(self.request.user)
 
 
 class UsersViewSet(viewsets.ModelViewSet):
@@ -56,13 +69,31 @@ class UsersViewSet(viewsets.ModelViewSet):
             return Response(serializer.data)
 
 
-class RecipeViewSet(viewsets.ModelViewSet):
+class RecipeViewSet(CachedResponseMixin, viewsets.ModelViewSet):
     queryset = Recipe.objects.all()
     serializer_class = RecipeSerializer
     permission_classes = (IsAuthorOrAdmin,)
     filter_backends = (DjangoFilterBackend,)
     filter_class = RecipeFilterSet
-    pagination_class = LimitPageNumberPagination
+    pagination_class = FeedPagination
+    cache_namespaces = (RECIPES,)
+    query_budget = {'list': 8, 'retrieve': 7, 'match': 6, 'similar': 7}
+    # Создание и правка декодируют и пережимают base64-изображение.
+    throttle_costs = {'create': 5, 'update': 5, 'partial_update': 5,
+                      'download_shopping_cart': 10}
+
+    def get_queryset(self):
+        return Recipe.objects.for_list(self.request.user)
+
+    def get_cache_visibility(self):
+        if self.request.user.is_anonymous:
+            return 'anonymous'
+        return None
+
+    def get_cache_namespaces(self):
+        if self.action == 'retrieve':
+            return [RECIPES_DETAIL, recipe_namespace(self.kwargs['pk'])]
+        return super().get_cache_namespaces()
 
     def get_serializer_class(self):
         if self.request.method in ('POST', 'PUT', 'PATCH'):
@@ -74,42 +105,87 @@ class RecipeViewSet(viewsets.ModelViewSet):
         context.update({"user_id": self.request.user})
         return context
 
+    @action(detail=False, methods=['get', ])
+    def match(self, request):
+        matches = recipe_match_index.match(
+            get_ingredient_ids(request), get_max_missing(request))
+        paginator = LimitPageNumberPagination()
+        page = paginator.paginate_queryset(matches, request, view=self)
+        recipes = self.get_queryset().in_bulk(
+            [recipe_id for _, _, recipe_id in page])
+        results = []
+        for missing, matched, recipe_id in page:
+            recipe = recipes.get(recipe_id)
+            if recipe is not None:
+                recipe.missing_ingredients = missing
+                recipe.matched_ingredients = matched
+                results.append(recipe)
+        serializer = MatchedRecipeSerializer(
+            results, many=True, context=self.get_serializer_context())
+        return paginator.get_paginated_response(serializer.data)
+
+    @action(detail=True, methods=['get', ])
+    def similar(self, request, pk=None):
+        if not str(pk).isdigit():
+            raise Http404
+        recipes = list(self.get_queryset().filter(
+            similar_to__recipe_id=pk
+        ).annotate(
+            similarity=F('similar_to__score')
+        ).order_by('-similarity', 'id')[:get_similar_limit()])
+        if not recipes and not Recipe.objects.filter(pk=pk).exists():
+            raise Http404
+        serializer = SimilarRecipeSerializer(
+            recipes, many=True, context=self.get_serializer_context())
+        return Response(serializer.data)
+
     @action(
         detail=False,
         permission_classes=(permissions.IsAuthenticated,),
+        renderer_classes=SHOPPING_LIST_RENDERERS,
         methods=['get', ])
     def download_shopping_cart(self, request):
-        user = request.user
-        ingredients = IngredientAmount.objects.filter(
-            recipe__shopping_cart__user=user).values(
-            'ingredient__name', 'ingredient__measurement_unit').order_by(
-                'ingredient__name').annotate(ingredient_total=Sum('amount'))
-
-        lines = []
-
-        for ingredient in ingredients:
-            lines.append(
-                f'{ingredient["ingredient__name"]}'
-                + f' – {ingredient["ingredient_total"]}'
-                + f'{ingredient["ingredient__measurement_unit"]}.\n'
-            )
-        return download_file_response(lines, 'shop_list.txt')
+        renderer = request.accepted_renderer
+        return download_file_response(
+            renderer.stream(shopping_list_rows(request.user)),
+            renderer.get_filename(),
+            renderer.get_content_type(),
+        )
 
 
-class IngredientViewSet(viewsets.ModelViewSet):
+class IngredientViewSet(CachedResponseMixin, viewsets.ModelViewSet):
     permission_classes = (IsAuthorOrAdmin,)
     pagination_class = None
+    cache_namespaces = (INGREDIENTS,)
+    cache_detail_namespaces = (INGREDIENTS,)
     queryset = Ingredient.objects.all()
     serializer_class = IngredientSerializer
     filterset_class = IngredientSearchFilter
     search_fields = ('^name',)
+    query_budget = {'list': 3, 'retrieve': 3}
+    throttle_costs = {'list': 5}
 
+    def get_throttle_cost(self):
+        # С ?name= отвечает индекс в памяти, без него - весь справочник.
+        if 'name' in self.request.query_params:
+            return 0
+        return get_throttle_cost(self)
 
-class TagViewSet(viewsets.ModelViewSet):
+    def list(self, request, *args, **kwargs):
+        name = request.query_params.get('name')
+        if name is None:
+            return super().list(request, *args, **kwargs)
+        return Response(ingredient_index.search(name))
+
+
+class TagViewSet(CachedResponseMixin, viewsets.ModelViewSet):
     permission_classes = (IsAuthorOrAdmin,)
     pagination_class = None
+    cache_namespaces = (TAGS,)
+    cache_detail_namespaces = (TAGS,)
     queryset = Tag.objects.all()
     serializer_class = TagSerializer
+    query_budget = {'list': 3, 'retrieve': 3}
 
 
 class ShoppingCartViewSet(DataMixin, views.APIView):
@@ -117,12 +193,20 @@ class ShoppingCartViewSet(DataMixin, views.APIView):
     serializer_class = ShoppingCartSerializer
     pagination_class = LimitPageNumberPagination
 
-    def post(self, request, recipe_id):
+    # Пакетное добавление обходит post_save, см. api/signals.py.
+    def after_add_many(self, user, recipe_ids):
+        ShoppingListItem.objects.add_recipes(user.id, recipe_ids)
+
+    def post(self, request, recipe_id=None):
+        if recipe_id is None:
+            return self.add_many_universal_method(
+                ShoppingCart, ShoppingCartSerializer)
         return self.add_to_universal_method(
-            ShoppingCart, ShoppingCartCreateSerializer,
-            ShoppingCartSerializer, recipe_id)
+            ShoppingCart, ShoppingCartSerializer, recipe_id)
 
-    def delete(self, request, recipe_id):
+    def delete(self, request, recipe_id=None):
+        if recipe_id is None:
+            return self.del_many_universal_method(ShoppingCart)
         return self.del_from_universal_method(
             ShoppingCart, recipe_id)
 
@@ -132,12 +216,16 @@ class FavoriteViewSet(DataMixin, views.APIView):
     serializer_class = FavoriteSerializer
     pagination_class = None
 
-    def post(self, request, recipe_id):
+    def post(self, request, recipe_id=None):
+        if recipe_id is None:
+            return self.add_many_universal_method(
+                Favorite, FavoriteSerializer)
         return self.add_to_universal_method(
-            Favorite, FavoriteCreateSerializer,
-            FavoriteSerializer, recipe_id)
+            Favorite, FavoriteSerializer, recipe_id)
 
-    def delete(self, request, recipe_id):
+    def delete(self, request, recipe_id=None):
+        if recipe_id is None:
+            return self.del_many_universal_method(Favorite)
         return self.del_from_universal_method(
             Favorite, recipe_id)
 
@@ -145,27 +233,60 @@ class FavoriteViewSet(DataMixin, views.APIView):
 class SubscribeView(views.APIView):
     permission_classes = (permissions.IsAuthenticated,)
 
-    def post(self, request, user_id):
+    @transaction.atomic
+    def post(self, request, user_id=None):
+        if user_id is None:
+            return self.add_many(request)
         user = self.request.user
         author = get_object_or_404(CustomUser, pk=user_id)
-        serializer = FollowCreateSerializer(
-            data={'user': user.id, 'author': user_id},
-        )
-        serializer.is_valid(raise_exception=True)
-        serializer.save(user=self.request.user)
-        follow = get_object_or_404(
-            Follow,
-            user=user,
-            author=author
-        )
-        serializer = FollowSerializer(follow)
+        follow, created = Follow.objects.add(user=user, author=author)
+        if not created:
+            raise serializers.ValidationError({
+                api_settings.NON_FIELD_ERRORS_KEY: [
+                    'Вы уже подписаны на этого автора']
+            })
+        # В базе счетчик уже увеличен обработчиком post_save.
+        author.followers_count += 1
+        prefetch_related_objects(
+            [follow], recipes_preview(get_recipes_limit(request)))
+        serializer = FollowSerializer(follow, context={'request': request})
         return Response(serializer.data, status=status.HTTP_201_CREATED)
 
-    def delete(self, request, user_id):
+    def delete(self, request, user_id=None):
+        if user_id is None:
+            return self.delete_many(request)
         user = request.user
         author = get_object_or_404(CustomUser, pk=user_id)
-        follow = get_object_or_404(Follow, user=user, author=author)
-        follow.delete()
+        if not Follow.objects.remove(user=user, author=author):
+            raise Http404
+        return Response(
+            'Удаление прошло успешно!', status=status.HTTP_204_NO_CONTENT
+        )
+
+    def add_many(self, request):
+        author_ids = get_batch_ids(request, AuthorIdsSerializer)
+        authors = CustomUser.objects.in_bulk(author_ids)
+        missing = [pk for pk in author_ids if pk not in authors]
+        if missing:
+            raise serializers.ValidationError({'authors': [
+                f'Авторы не найдены: {", ".join(map(str, missing))}']})
+        follows = Follow.objects.add_many(
+            'author_id', author_ids, user=request.user)
+        change_counters(Follow, [follow.author_id for follow in follows], 1)
+        for follow in follows:
+            follow.author = authors[follow.author_id]
+            follow.author.followers_count += 1
+        prefetch_related_objects(
+            follows, recipes_preview(get_recipes_limit(request)))
+        serializer = FollowSerializer(
+            follows, many=True, context={'request': request})
+        return Response(serializer.data, status=batch_add_status(follows))
+
+    @transaction.atomic
+    def delete_many(self, request):
+        author_ids = get_batch_ids(
+            request, AuthorIdsSerializer, allow_all=True)
+        Follow.objects.remove_many('author_id', author_ids, user=request.user)
         return Response(
             'Удаление прошло успешно!', status=status.HTTP_204_NO_CONTENT
         )
@@ -175,10 +296,14 @@ class SubscribeListViewSet(viewsets.ModelViewSet, PageNumberPagination):
     permission_classes = (IsAuthorOrAdmin,)
     queryset = Follow.objects.all()
     serializer_class = FollowSerializer
+    pagination_class = FeedPagination
+    query_budget = {'list': 6}
 
     def list(self, request, *args, **kwargs):
         user = self.request.user
-        subscriptions = user.follower.all()
+        subscriptions = user.follower.with_recipes(
+            get_recipes_limit(request))
         page = self.paginate_queryset(subscriptions)
-        serializer = FollowSerializer(page, many=True)
+        serializer = FollowSerializer(
+            page, many=True, context={'request': request})
         return self.get_paginated_response(serializer.data)
@@ -0,0 +1,91 @@
+import sqlite3
+
+from django.db import connections, models, router
+from django.db.models.signals import post_save
+from django.db.models.sql import InsertQuery
+
+
+def can_return_rows(connection):
+    if connection.vendor == 'postgresql':
+        return True
+    # RETURNING в SQLite появился в 3.35.
+    return (connection.vendor == 'sqlite'
+            and sqlite3.sqlite_version_info >= (3, 35))
+
+
+class UniqueRelationQuerySet(models.QuerySet):
+    # Связи с уникальным ограничением (избранное, корзина, подписки):
+    # добавление одним INSERT ... ON CONFLICT DO NOTHING, поэтому
+    # повторный или одновременный запрос не падает с IntegrityError.
+
+    def add(self, **fields):
+        obj = self.model(**fields)
+        using = router.db_for_write(self.model)
+        query = InsertQuery(self.model, ignore_conflicts=True)
+        query.insert_values(
+            [field for field in self.model._meta.concrete_fields
+             if not isinstance(field, models.AutoField)],
+            [obj],
+        )
+        with connections[using].cursor() as cursor:
+            for sql, params in query.get_compiler(using=using).as_sql():
+                cursor.execute(sql, params)
+            created = cursor.rowcount > 0
+        if created:
+            # Строка вставлена в обход save(), но счетчики и прочие
+            # обработчики должны о ней узнать.
+            post_save.send(
+                sender=self.model, instance=obj, created=True,
+                update_fields=None, raw=False, using=using)
+        return obj, created
+
+    def remove(self, **fields):
+        deleted, _ = self.filter(**fields).delete()
+        return deleted > 0
+
+    def add_many(self, key, values, **fields):
+        # Пакетное добавление одним INSERT. Возвращает только реально
+        # вставленные строки; сигналы post_save не отправляются, счетчики
+        # обновляет вызывающий код.
+        objs = [self.model(**fields, **{key: value}) for value in values]
+        if not objs:
+            return []
+        using = router.db_for_write(self.model)
+        connection = connections[using]
+        if not can_return_rows(connection):
+            existing = set(self.filter(
+                **fields, **{f'{key}__in': values}
+            ).values_list(key, flat=True))
+            created = [
+                obj for obj in objs if getattr(obj, key) not in existing]
+            self.bulk_create(created, ignore_conflicts=True)
+            return created
+        query = InsertQuery(self.model, ignore_conflicts=True)
+        query.insert_values(
+            [field for field in self.model._meta.concrete_fields
+             if not isinstance(field, models.AutoField)],
+            objs,
+        )
+        returning = connection.ops.quote_name(
+            self.model._meta.get_field(key).column)
+        inserted = set()
+        with connection.cursor() as cursor:
+            for sql, params in query.get_compiler(using=using).as_sql():
+                cursor.execute(f'{sql} RETURNING {returning}', params)
+                inserted.update(row[0] for row in cursor.fetchall())
+        return [obj for obj in objs if getattr(obj, key) in inserted]
+
+    def remove_many(self, key, values=None, **fields):
+        # values=None удаляет все строки, подходящие под fields.
+        # Строки блокируются до удаления, чтобы вернуть ровно удаленные,
+        # а удаляются обычным delete(): обработчики pre_delete/post_delete
+        # (счетчики, список покупок) срабатывают для каждой строки, как и
+        # при одиночном remove(). Вызывать в транзакции.
+        rows = self.filter(**fields)
+        if values is not None:
+            rows = rows.filter(**{f'{key}__in': values})
+        removed = list(
+            rows.select_for_update().values_list(key, flat=True))
+        if removed:
+            rows.filter(**{f'{key}__in': removed}).delete()
+        return removed
@@ -34,6 +34,8 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
+    'api.middleware.QueryInstrumentationMiddleware',
+    'api.middleware.ReplicaRoutingMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -77,6 +79,29 @@ DATABASES = {
     }
 }
 
+# Реплики только для чтения через запятую: host[:port] для PostgreSQL,
+# для SQLite - пути к файлам. Без них маршрутизатор ничего не меняет.
+DATABASE_REPLICAS = []
+replicas = os.getenv('DB_REPLICAS', default='').split(',')
+for number, replica in enumerate(filter(None, map(str.strip, replicas)), 1):
+    if DATABASES['default']['ENGINE'].endswith('sqlite3'):
+        replica_options = {'NAME': replica}
+    else:
+        host, _, port = replica.partition(':')
+        replica_options = {
+            'HOST': host, 'PORT': port or DATABASES['default']['PORT']}
+    DATABASES[f'replica_{number}'] = {
+        **DATABASES['default'], **replica_options,
+        'TEST': {'MIRROR': 'default'},
+    }
+    DATABASE_REPLICAS.append(f'replica_{number}')
+
+DATABASE_ROUTERS = ['api.replicas.ReplicaRouter']
+REPLICA_RETRY_SECONDS = 30
+REPLICA_PIN_SECONDS = 5
+REPLICA_PIN_COOKIE = 'db_primary'
+REPLICA_PATH_PREFIX = '/api/'
+
 AUTH_PASSWORD_VALIDATORS = [
     {
         'NAME': 'django.contrib.auth.password_validation.UserAttributeSimilarityValidator',
@@ -115,7 +140,10 @@ REST_FRAMEWORK = {
         'rest_framework.permissions.IsAuthenticated'
     ],
     'DEFAULT_AUTHENTICATION_CLASSES': [
-        'rest_framework.authentication.TokenAuthentication',
+        'api.authentication.CachedTokenAuthentication',
+    ],
+    'DEFAULT_THROTTLE_CLASSES': [
+        'api.throttling.TokenBucketThrottle',
     ],
     'DEFAULT_FILTER_BACKENDS': [
         'django_filters.rest_framework.DjangoFilterBackend',
@@ -141,3 +169,73 @@ DJOSER = {
 
 EMAIL_BACKEND = "django.core.mail.backends.filebased.EmailBackend"
 EMAIL_FILE_PATH = os.path.join(BASE_DIR, "sent_emails")
+
+# TTF с кириллицей, без него выгрузка в PDF недоступна.
+SHOPPING_LIST_PDF_FONT = os.getenv(
+    'SHOPPING_LIST_PDF_FONT',
+    default='/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf')
+
+INGREDIENT_SEARCH_LIMIT = 20
+INGREDIENT_INDEX_TTL = 300
+RECIPE_MATCH_INDEX_TTL = 300
+RECIPE_MATCH_MAX_CHANGES = 1000
+SIMILAR_RECIPES_LIMIT = 10
+TRENDING_HALF_LIFE_HOURS = 72
+TRENDING_WINDOW_DAYS = 14
+
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv(
+            'CACHE_BACKEND',
+            default='django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', default='foodgram'),
+    }
+}
+
+API_CACHE_ALIAS = 'default'
+API_CACHE_TIMEOUT = 600
+
+# Пустое значение - кеш токенов в памяти каждого воркера.
+AUTH_TOKEN_CACHE_ALIAS = os.getenv('AUTH_TOKEN_CACHE_ALIAS') or None
+AUTH_TOKEN_CACHE_TTL = 60
+AUTH_TOKEN_CACHE_SIZE = 1024
+
+# Пустое значение - ведра в памяти каждого воркера.
+THROTTLE_CACHE_ALIAS = os.getenv('THROTTLE_CACHE_ALIAS') or None
+THROTTLE_ENABLED = True
+THROTTLE_MEMORY_SIZE = 10000
+THROTTLE_BUCKETS = {
+    'user': {'capacity': 60, 'rate': 1.0},
+    'ip': {'capacity': 30, 'rate': 0.5},
+}
+
+RECIPE_IMAGE_WORKERS = 2
+RECIPE_IMAGE_ASYNC = True
+
+SQL_N_PLUS_ONE_THRESHOLD = 5
+SQL_QUERY_BUDGET = None
+SQL_INSTRUMENTATION_STRICT = False
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'api.sql': {
+            'handlers': ['console'],
+            # INFO пишет строку на каждый запрос, по умолчанию - только
+            # превышения бюджета и повторяющиеся запросы.
+            'level': os.getenv('SQL_LOG_LEVEL', default='WARNING'),
+            'propagate': False,
+        },
+        'api.replicas': {
+            'handlers': ['console'],
+            'level': 'WARNING',
+            'propagate': False,
+        },
+    },
+}
@@ -1,8 +1,15 @@
 from django.contrib import admin
+from django.contrib.admin.widgets import AutocompleteSelect
+from django.forms.models import BaseInlineFormSet
+from django.db import transaction
 from django.utils.html import format_html
 
+from api.search import recipe_match_index
 from users.models import Follow
-from .models import Ingredient, IngredientAmount, Recipe, Tag, TagRecipe
+from .images import get_variant_urls, schedule_recipe_image
+from .models import (Ingredient, IngredientAmount, Recipe, ShoppingListItem,
+                     Tag, TagRecipe)
+from .similarity import schedule_similar_update
 
 
 @admin.register(Tag)
@@ -14,22 +21,70 @@ class TagAdmin(admin.ModelAdmin):
     prepopulated_fields = {'slug': ('name',)}
 
 
+class PreloadedAutocompleteSelect(AutocompleteSelect):
+    # Подпись выбранного значения берется из уже загруженных объектов,
+    # а не отдельным запросом для каждой строки инлайна.
+    preloaded = ()
+
+    def optgroups(self, name, value, attr=None):
+        known = {str(obj.pk): obj for obj in self.preloaded}
+        selected = {str(item) for item in value
+                    if str(item) not in self.choices.field.empty_values}
+        if not selected or not selected <= set(known):
+            return super().optgroups(name, value, attr)
+        options = []
+        if not self.is_required:
+            options.append(self.create_option(name, '', '', False, 0))
+        for pk in selected:
+            options.append(self.create_option(
+                name, known[pk].pk,
+                self.choices.field.label_from_instance(known[pk]),
+                True, len(options)))
+        return [(None, options, 0)]
+
+
+class RecipeIngredientFormSet(BaseInlineFormSet):
+
+    def _construct_form(self, i, **kwargs):
+        form = super()._construct_form(i, **kwargs)
+        if form.instance.ingredient_id is not None:
+            widget = form.fields['ingredient'].widget
+            getattr(widget, 'widget', widget).preloaded = [
+                form.instance.ingredient]
+        return form
+
+
 class RecipeIngredientInLine(admin.TabularInline):
     model = IngredientAmount
+    formset = RecipeIngredientFormSet
+
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('ingredient')
+
+    def formfield_for_foreignkey(self, db_field, request, **kwargs):
+        if db_field.name == 'ingredient':
+            kwargs['widget'] = PreloadedAutocompleteSelect(
+                db_field.remote_field, self.admin_site,
+                using=kwargs.get('using'))
+        return super().formfield_for_foreignkey(db_field, request, **kwargs)
 
 
 @admin.register(Ingredient)
 class IngredientAdmin(admin.ModelAdmin):
     list_display = ('name', 'measurement_unit')
     search_fields = ('name',)
-    list_filter = ('name',)
+    list_filter = ('measurement_unit',)
+    show_full_result_count = False
 
 
 @admin.register(Follow)
 class FollowAdmin(admin.ModelAdmin):
     list_display = ('user', 'author')
-    search_fields = ('user', 'author')
-    list_filter = ('user', 'author')
+    list_select_related = ('user', 'author')
+    search_fields = ('user__username', 'user__email',
+                     'author__username', 'author__email')
+    autocomplete_fields = ('user', 'author')
+    show_full_result_count = False
 
 
 class RecipeTagsInline(admin.TabularInline):
@@ -37,19 +92,46 @@ class RecipeTagsInline(admin.TabularInline):
     min_num = 1
     extra = 0
 
+    def get_queryset(self, request):
+        return super().get_queryset(request).select_related('tag')
+
 
 @admin.register(Recipe)
 class RecipeAdmin(admin.ModelAdmin):
-    list_display = ('author', 'name', 'image_tag')
-    search_fields = ('user', 'author')
-    list_filter = ('author', 'name', 'tags')
+    # Счетчики избранного и списков покупок хранятся в самом рецепте,
+    # поэтому список не агрегирует связанные таблицы.
+    list_display = ('author', 'name', 'image_tag', 'favorites_count',
+                    'shopping_cart_count', 'trending_score')
+    list_select_related = ('author',)
+    search_fields = ('name', 'author__username', 'author__email')
+    list_filter = ('tags',)
+    autocomplete_fields = ('author',)
+    show_full_result_count = False
     inlines = [RecipeTagsInline, RecipeIngredientInLine]
     readonly_fields = ('image_tag',)
 
     def image_tag(self, instance):
+        variants = get_variant_urls(instance)
         return format_html(
             '<img src="{0}" style="max-width: 40%"/>',
-            instance.image.url
+            variants['admin']['default'] if variants else instance.image.url
         )
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        schedule_recipe_image(obj)
+
+    def save_related(self, request, form, formsets, change):
+        recipe = form.instance
+        old_amounts = ShoppingListItem.objects.recipe_amounts(recipe.pk)
+        super().save_related(request, form, formsets, change)
+        new_amounts = ShoppingListItem.objects.recipe_amounts(recipe.pk)
+        ShoppingListItem.objects.change_recipe(
+            recipe, old_amounts, new_amounts)
+        Recipe.objects.filter(pk=recipe.pk).update_derived_fields()
+        ingredient_ids = list(new_amounts)
+        transaction.on_commit(lambda: recipe_match_index.update_recipe(
+            recipe.pk, ingredient_ids))
+        schedule_similar_update(recipe.pk)
+
     image_tag.short_description = 'Предпросмотр изображения'
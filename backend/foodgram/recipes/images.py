@@ -0,0 +1,149 @@
+import io
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.db import connections, transaction
+from PIL import Image
+
+from .models import Recipe
+
+logger = logging.getLogger(__name__)
+
+VARIANTS = {
+    'card': (480, 480),
+    'detail': (1200, 1200),
+    'admin': (200, 200),
+}
+VARIANTS_DIR = 'image/variants'
+FORMATS = {
+    'JPEG': 'jpg',
+    'PNG': 'png',
+    'WEBP': 'webp',
+}
+
+_executor = None
+
+
+def get_executor():
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=getattr(settings, 'RECIPE_IMAGE_WORKERS', 2),
+            thread_name_prefix='recipe-images',
+        )
+    return _executor
+
+
+def variant_name(source_name, variant, extension):
+    stem = os.path.splitext(os.path.basename(source_name))[0]
+    return f'{VARIANTS_DIR}/{stem}_{variant}.{extension}'
+
+
+def variant_names(source_name, source_format):
+    extension = FORMATS.get(source_format, 'jpg')
+    return {
+        variant: {
+            'default': variant_name(source_name, variant, extension),
+            'webp': variant_name(source_name, variant, 'webp'),
+        }
+        for variant in VARIANTS
+    }
+
+
+def source_format(source_name):
+    extension = os.path.splitext(source_name)[1][1:].lower()
+    return 'PNG' if extension == 'png' else 'JPEG'
+
+
+def save_image(image, name, image_format):
+    buffer = io.BytesIO()
+    if image_format == 'JPEG' and image.mode not in ('RGB', 'L'):
+        image = image.convert('RGB')
+    image.save(buffer, format=image_format, quality=85, optimize=True)
+    if default_storage.exists(name):
+        default_storage.delete(name)
+    default_storage.save(name, ContentFile(buffer.getvalue()))
+
+
+def generate_variants(source_name):
+    image_format = source_format(source_name)
+    names = variant_names(source_name, image_format)
+    with default_storage.open(source_name) as file:
+        original = Image.open(file)
+        original.load()
+    for variant, size in VARIANTS.items():
+        image = original.copy()
+        image.thumbnail(size, Image.LANCZOS)
+        save_image(image, names[variant]['default'], image_format)
+        save_image(image, names[variant]['webp'], 'WEBP')
+    return names
+
+
+def process_recipe_image(recipe_id):
+    recipe = Recipe.objects.filter(pk=recipe_id).only('image').first()
+    if recipe is None or not recipe.image:
+        return
+    source_name = recipe.image.name
+    generate_variants(source_name)
+    with transaction.atomic():
+        recipe = Recipe.objects.select_for_update().only(
+            'image', 'image_variants_source').filter(pk=recipe_id).first()
+        if recipe is None or recipe.image.name != source_name:
+            # Изображение успели заменить или удалить вместе с рецептом.
+            transaction.on_commit(lambda: delete_variants(source_name))
+            return
+        previous = recipe.image_variants_source
+        recipe.image_variants_source = source_name
+        recipe.save(update_fields=['image_variants_source'])
+        if previous and previous != source_name:
+            transaction.on_commit(lambda: delete_variants(previous))
+
+
+def delete_variants(source_name):
+    for formats in variant_names(
+            source_name, source_format(source_name)).values():
+        for name in formats.values():
+            default_storage.delete(name)
+
+
+def run_in_background(task, recipe_id):
+    try:
+        task(recipe_id)
+    except Exception:
+        logger.exception(
+            'Фоновая задача %s для рецепта %s завершилась ошибкой',
+            task.__name__, recipe_id)
+    finally:
+        connections.close_all()
+
+
+def schedule_recipe_task(task, recipe_id):
+    # Задачи по рецепту (изображения, похожие рецепты) выполняются после
+    # коммита в общем пуле воркеров, а не в обработчике запроса.
+    if getattr(settings, 'RECIPE_IMAGE_ASYNC', True):
+        transaction.on_commit(lambda: get_executor().submit(
+            run_in_background, task, recipe_id))
+    else:
+        transaction.on_commit(lambda: task(recipe_id))
+
+
+def schedule_recipe_image(recipe):
+    if not recipe.image or recipe.image_variants_source == recipe.image.name:
+        return
+    schedule_recipe_task(process_recipe_image, recipe.pk)
+
+
+def get_variant_urls(recipe):
+    source_name = recipe.image.name if recipe.image else None
+    if not source_name or recipe.image_variants_source != source_name:
+        return {}
+    return {
+        variant: {key: default_storage.url(name)
+                  for key, name in formats.items()}
+        for variant, formats in variant_names(
+            source_name, source_format(source_name)).items()
+    }
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from recipes.similarity import get_similar_limit, rebuild_similar_recipes
+
+
+class Command(BaseCommand):
+    help = ('Пересчитывает списки похожих рецептов по общим ингредиентам '
+            'и тегам')
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--limit', type=int,
+            help='Сколько соседей хранить для каждого рецепта'
+        )
+
+    def handle(self, *args, **options):
+        limit = options['limit'] or get_similar_limit()
+        total = rebuild_similar_recipes(limit)
+        self.stdout.write(self.style.SUCCESS(
+            f'Сохранено {total} пар похожих рецептов (до {limit} '
+            f'на рецепт)'
+        ))
@@ -0,0 +1,166 @@
+import csv
+import io
+import json
+import os
+import time
+from itertools import islice
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from api.cache import INGREDIENTS, response_cache
+from recipes.models import Ingredient
+
+NAME_MAX_LENGTH = Ingredient._meta.get_field('name').max_length
+UNIT_MAX_LENGTH = Ingredient._meta.get_field('measurement_unit').max_length
+
+
+def read_csv(path):
+    with open(path, encoding='utf-8', newline='') as file:
+        for row in csv.reader(file):
+            if len(row) < 2 or row[:2] == ['name', 'measurement_unit']:
+                continue
+            yield row[0], row[1]
+
+
+def read_json_lines(path):
+    with open(path, encoding='utf-8') as file:
+        for line in file:
+            if line.strip():
+                yield from read_json_items([json.loads(line)])
+
+
+def read_json(path):
+    with open(path, encoding='utf-8') as file:
+        yield from read_json_items(json.load(file))
+
+
+def read_json_items(items):
+    for item in items:
+        if 'fields' in item:
+            if item.get('model') != 'recipes.ingredient':
+                continue
+            item = item['fields']
+        yield item['name'], item['measurement_unit']
+
+
+READERS = {
+    'csv': read_csv,
+    'json': read_json,
+    'jsonl': read_json_lines,
+}
+
+
+def batched(iterable, size):
+    iterator = iter(iterable)
+    batch = list(islice(iterator, size))
+    while batch:
+        yield batch
+        batch = list(islice(iterator, size))
+
+
+class Command(BaseCommand):
+    help = 'Загружает ингредиенты из CSV, JSON или JSON Lines файлов'
+
+    def add_arguments(self, parser):
+        parser.add_argument('paths', nargs='+', help='Файлы с ингредиентами')
+        parser.add_argument(
+            '--format', choices=sorted(READERS),
+            help='Формат файлов, по умолчанию определяется по расширению'
+        )
+        parser.add_argument(
+            '--batch-size', type=int, default=5000,
+            help='Количество строк в одной пачке'
+        )
+        parser.add_argument(
+            '--no-copy', action='store_true',
+            help='Не использовать COPY даже на PostgreSQL'
+        )
+
+    def get_reader(self, path, file_format):
+        file_format = file_format or os.path.splitext(path)[1][1:].lower()
+        if file_format not in READERS:
+            raise CommandError(f'Неизвестный формат файла: {path}')
+        return READERS[file_format]
+
+    def read_rows(self, paths, file_format):
+        seen = set()
+        self.skipped = 0
+        for path in paths:
+            for name, measurement_unit in self.get_reader(
+                    path, file_format)(path):
+                key = (name.strip(), measurement_unit.strip())
+                if (not key[0] or not key[1]
+                        or len(key[0]) > NAME_MAX_LENGTH
+                        or len(key[1]) > UNIT_MAX_LENGTH):
+                    self.skipped += 1
+                    continue
+                if key in seen:
+                    continue
+                seen.add(key)
+                yield key
+
+    def write_bulk_create(self, batch):
+        Ingredient.objects.bulk_create(
+            [Ingredient(name=name, measurement_unit=measurement_unit)
+             for name, measurement_unit in batch],
+            ignore_conflicts=True,
+        )
+
+    def write_copy(self, batches):
+        table = Ingredient._meta.db_table
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'CREATE TEMP TABLE import_ingredients '
+                '(name varchar(200), measurement_unit varchar(200))'
+            )
+            for batch in batches:
+                buffer = io.StringIO()
+                csv.writer(buffer).writerows(batch)
+                buffer.seek(0)
+                cursor.copy_expert(
+                    'COPY import_ingredients (name, measurement_unit) '
+                    'FROM STDIN WITH (FORMAT csv)', buffer
+                )
+                yield batch
+            cursor.execute(
+                f'INSERT INTO {table} (name, measurement_unit) '
+                'SELECT name, measurement_unit FROM import_ingredients '
+                'ON CONFLICT DO NOTHING'
+            )
+            # Не ON COMMIT DROP: команду могут вызвать внутри внешней
+            # транзакции, и тогда повторный импорт не создал бы таблицу.
+            cursor.execute('DROP TABLE import_ingredients')
+
+    def handle(self, *args, **options):
+        use_copy = (connection.vendor == 'postgresql'
+                    and not options['no_copy'])
+        batches = batched(
+            self.read_rows(options['paths'], options['format']),
+            options['batch_size']
+        )
+        before = Ingredient.objects.count()
+        started = time.monotonic()
+        processed = 0
+        with transaction.atomic():
+            if use_copy:
+                batches = self.write_copy(batches)
+            for batch in batches:
+                if not use_copy:
+                    self.write_bulk_create(batch)
+                processed += len(batch)
+                elapsed = time.monotonic() - started
+                self.stdout.write(
+                    f'Обработано {processed} строк '
+                    f'({processed / max(elapsed, 1e-6):.0f} строк/с)'
+                )
+        elapsed = time.monotonic() - started
+        created = Ingredient.objects.count() - before
+        if created:
+            response_cache.invalidate(INGREDIENTS)
+        self.stdout.write(self.style.SUCCESS(
+            f'Загружено {created} новых ингредиентов из {processed} '
+            f'уникальных строк за {elapsed:.2f} с '
+            f'({"COPY" if use_copy else "bulk_create"}), '
+            f'пропущено некорректных строк: {self.skipped}'
+        ))
@@ -0,0 +1,58 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from recipes.models import ShoppingListItem
+
+
+class Command(BaseCommand):
+    help = 'Проверяет и пересобирает сводные списки покупок пользователей'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--user', type=int, nargs='+', dest='user_ids',
+            help='Обработать только указанных пользователей'
+        )
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Только сообщить о расхождениях, ничего не изменяя'
+        )
+
+    def get_expected(self, user_ids):
+        return {
+            (row['user_id'], row['ingredient_id']): row['total']
+            for row in ShoppingListItem.objects.cart_totals(
+                user_ids).iterator()
+        }
+
+    def get_actual(self, user_ids):
+        items = ShoppingListItem.objects.all()
+        if user_ids is not None:
+            items = items.filter(user_id__in=user_ids)
+        return {
+            (user_id, ingredient_id): amount
+            for user_id, ingredient_id, amount in items.values_list(
+                'user_id', 'ingredient_id', 'amount').iterator()
+        }
+
+    def handle(self, *args, **options):
+        user_ids = options['user_ids']
+        expected = self.get_expected(user_ids)
+        actual = self.get_actual(user_ids)
+        drift = {
+            key for key in set(expected) | set(actual)
+            if expected.get(key) != actual.get(key)
+        }
+        for user_id, ingredient_id in sorted(drift):
+            self.stdout.write(
+                f'user={user_id} ingredient={ingredient_id}: '
+                f'ожидалось {expected.get((user_id, ingredient_id))}, '
+                f'в таблице {actual.get((user_id, ingredient_id))}'
+            )
+        if options['check']:
+            self.stdout.write(f'Расхождений: {len(drift)}')
+            return
+        with transaction.atomic():
+            ShoppingListItem.objects.rebuild(user_ids)
+        self.stdout.write(self.style.SUCCESS(
+            f'Списки покупок пересобраны, исправлено позиций: {len(drift)}'
+        ))
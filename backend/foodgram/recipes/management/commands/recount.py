@@ -0,0 +1,55 @@
+from django.core.management.base import BaseCommand
+from django.db import transaction
+
+from recipes.models import Recipe
+from users.models import CustomUser
+
+MODELS = {
+    'recipes': Recipe,
+    'users': CustomUser,
+}
+
+
+class Command(BaseCommand):
+    help = 'Проверяет и пересчитывает денормализованные счётчики'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--only', choices=sorted(MODELS), nargs='+',
+            help='Пересчитать счётчики только указанных моделей'
+        )
+        parser.add_argument(
+            '--check', action='store_true',
+            help='Только сообщить о расхождениях, ничего не изменяя'
+        )
+
+    def report_drift(self, name, model):
+        counters = list(model.objects.get_counters())
+        rows = model.objects.with_counter_drift().values(
+            'pk', *counters, *(f'actual_{field}' for field in counters))
+        drift = 0
+        for row in rows.iterator():
+            drift += 1
+            for field in counters:
+                if row[field] != row[f'actual_{field}']:
+                    self.stdout.write(
+                        f'{name} id={row["pk"]} {field}: '
+                        f'сохранено {row[field]}, '
+                        f'на самом деле {row[f"actual_{field}"]}'
+                    )
+        return drift
+
+    def handle(self, *args, **options):
+        names = options['only'] or sorted(MODELS)
+        for name in names:
+            model = MODELS[name]
+            drift = self.report_drift(name, model)
+            if options['check']:
+                self.stdout.write(f'{name}: расхождений {drift}')
+                continue
+            with transaction.atomic():
+                updated = model.objects.recount()
+            self.stdout.write(self.style.SUCCESS(
+                f'{name}: пересчитано {updated} строк, '
+                f'исправлено расхождений {drift}'
+            ))
@@ -0,0 +1,13 @@
+from django.core.management.base import BaseCommand
+
+from recipes.models import Recipe
+
+
+class Command(BaseCommand):
+    help = ('Пересчитывает оценки популярности рецептов для '
+            '?ordering=trending. Запускать периодически, например по cron')
+
+    def handle(self, *args, **options):
+        updated = Recipe.objects.update_trending_scores()
+        self.stdout.write(self.style.SUCCESS(
+            f'Обновлены оценки {updated} рецептов'))
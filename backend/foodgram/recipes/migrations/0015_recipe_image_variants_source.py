@@ -0,0 +1,18 @@
+# Generated by Django 2.2.16 on 2022-11-07 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0014_ingredient_name_unit_unique'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='image_variants_source',
+            field=models.CharField(blank=True, default='', editable=False, max_length=100, verbose_name='Изображение, для которого созданы превью'),
+        ),
+    ]
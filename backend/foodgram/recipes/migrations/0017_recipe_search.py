@@ -0,0 +1,93 @@
+# Generated by Django 2.2.16 on 2022-11-09 10:00
+
+from collections import defaultdict
+
+import django.contrib.postgres.search
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations, models
+
+SEARCH_CONFIG = 'russian'
+SEARCH_FTS_TABLE = 'recipes_recipe_fts'
+
+
+def fts_text(text):
+    return text.replace('ё', 'е').replace('Ё', 'Е')
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute(
+            'CREATE INDEX recipe_search_vector_idx '
+            'ON recipes_recipe USING gin (search_vector)'
+        )
+    elif vendor == 'sqlite':
+        schema_editor.execute(
+            f'CREATE VIRTUAL TABLE {SEARCH_FTS_TABLE} '
+            'USING fts5(name, search_document, '
+            "tokenize = 'unicode61 remove_diacritics 2')"
+        )
+        # Совпадение в названии важнее совпадения в описании.
+        schema_editor.execute(
+            f"INSERT INTO {SEARCH_FTS_TABLE} ({SEARCH_FTS_TABLE}, rank) "
+            "VALUES ('rank', 'bm25(10.0, 1.0)')"
+        )
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        schema_editor.execute('DROP INDEX IF EXISTS recipe_search_vector_idx')
+    elif vendor == 'sqlite':
+        schema_editor.execute(f'DROP TABLE IF EXISTS {SEARCH_FTS_TABLE}')
+
+
+def fill_search_documents(apps, schema_editor):
+    Recipe = apps.get_model('recipes', 'Recipe')
+    IngredientAmount = apps.get_model('recipes', 'IngredientAmount')
+    names = defaultdict(list)
+    for recipe_id, name in IngredientAmount.objects.order_by(
+            'id').values_list('recipe_id', 'ingredient__name').iterator():
+        names[recipe_id].append(name)
+    recipes = list(Recipe.objects.only('id', 'name', 'text'))
+    for recipe in recipes:
+        recipe.search_document = '\n'.join([recipe.text, *names[recipe.pk]])
+    Recipe.objects.bulk_update(recipes, ['search_document'])
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        Recipe.objects.update(search_vector=(
+            SearchVector('name', weight='A', config=SEARCH_CONFIG)
+            + SearchVector('search_document', weight='B',
+                           config=SEARCH_CONFIG)
+        ))
+    elif vendor == 'sqlite' and recipes:
+        with schema_editor.connection.cursor() as cursor:
+            cursor.executemany(
+                f'INSERT INTO {SEARCH_FTS_TABLE} '
+                '(rowid, name, search_document) VALUES (%s, %s, %s)',
+                [(recipe.pk, fts_text(recipe.name),
+                  fts_text(recipe.search_document))
+                 for recipe in recipes]
+            )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0016_recipe_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='recipe',
+            name='search_document',
+            field=models.TextField(blank=True, default='', editable=False, verbose_name='Текст для поиска'),
+        ),
+        migrations.AddField(
+            model_name='recipe',
+            name='search_vector',
+            field=django.contrib.postgres.search.SearchVectorField(editable=False, null=True),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+        migrations.RunPython(fill_search_documents, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,51 @@
+# Generated by Django 2.2.16 on 2022-11-13 10:00
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+INGREDIENT_NAME_INDEX = 'recipes_ingredient_name_search_idx'
+
+
+def create_ingredient_name_index(apps, schema_editor):
+    # Индекс под name__istartswith. Django 2.2 не умеет индексы по
+    # выражениям, поэтому SQL свой для каждой базы.
+    vendor = schema_editor.connection.vendor
+    if vendor == 'postgresql':
+        # istartswith в PostgreSQL - UPPER("name"::text) LIKE UPPER(%s).
+        schema_editor.execute(
+            f'CREATE INDEX {INGREDIENT_NAME_INDEX} ON recipes_ingredient '
+            '(UPPER(name::text) text_pattern_ops)'
+        )
+    elif vendor == 'sqlite':
+        # LIKE в SQLite без учета регистра использует только NOCASE индекс.
+        schema_editor.execute(
+            f'CREATE INDEX {INGREDIENT_NAME_INDEX} ON recipes_ingredient '
+            '(name COLLATE NOCASE)'
+        )
+
+
+def drop_ingredient_name_index(apps, schema_editor):
+    if schema_editor.connection.vendor in ('postgresql', 'sqlite'):
+        schema_editor.execute(f'DROP INDEX IF EXISTS {INGREDIENT_NAME_INDEX}')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0020_trending'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='recipe',
+            index=models.Index(fields=['author', 'id'], name='recipe_author_feed_idx'),
+        ),
+        migrations.AlterField(
+            model_name='recipe',
+            name='author',
+            field=models.ForeignKey(db_index=False, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='recipes', to=settings.AUTH_USER_MODEL, verbose_name='Автор'),
+        ),
+        migrations.RunPython(
+            create_ingredient_name_index, drop_ingredient_name_index),
+    ]
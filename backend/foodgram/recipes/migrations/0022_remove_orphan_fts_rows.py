@@ -0,0 +1,23 @@
+# Generated by Django 2.2.16 on 2022-11-14 10:00
+
+from django.db import migrations
+
+
+def remove_orphan_fts_rows(apps, schema_editor):
+    # Строки удаленных рецептов, оставшиеся до обработчика post_delete.
+    if schema_editor.connection.vendor == 'sqlite':
+        schema_editor.execute(
+            'DELETE FROM recipes_recipe_fts '
+            'WHERE rowid NOT IN (SELECT id FROM recipes_recipe)'
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('recipes', '0021_hot_path_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(remove_orphan_fts_rows, migrations.RunPython.noop),
+    ]
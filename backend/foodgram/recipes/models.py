@@ -1,6 +1,18 @@
+import re
+from collections import defaultdict
+from datetime import timedelta
+
+from django.conf import settings
+from django.contrib.postgres.search import (SearchQuery, SearchRank,
+                                            SearchVector, SearchVectorField)
 from django.core.validators import MinValueValidator
-from django.db import models
+from django.db import IntegrityError, connections, models, transaction
+from django.db.models import (BooleanField, Exists, F, OuterRef, Prefetch,
+                              Q, Sum, Value)
+from django.utils import timezone
 
+from foodgram.querysets import UniqueRelationQuerySet
+from users.managers import CounterQuerySetMixin, related_count
 from users.models import CustomUser
 
 
@@ -20,11 +32,51 @@ class Ingredient(models.Model):
         ordering = ['id']
         verbose_name = 'Ингредиент'
         verbose_name_plural = 'Ингредиенты'
+        # unique_together, а не UniqueConstraint: его проверяют формы
+        # админки и UniqueTogetherValidator в DRF, дубль дает 400, а не 500.
+        unique_together = ('name', 'measurement_unit')
 
     def __str__(self):
         return f'{self.name} {self.measurement_unit}'
 
 
+TAG_MASK_BITS = 63
+TAG_MASK_IN_LIMIT = 8
+TAG_BIT_ATTEMPTS = 3
+
+
+class TagQuerySet(models.QuerySet):
+
+    def assign_bits(self, attempts=TAG_BIT_ATTEMPTS):
+        # Два одновременных сохранения тегов могут выбрать один свободный
+        # бит: уникальный индекс отклонит второе, и оно выберет заново
+        # среди битов, оставшихся свободными.
+        for attempt in range(attempts):
+            try:
+                with transaction.atomic(using=self.db):
+                    return self.assign_free_bits()
+            except IntegrityError:
+                if attempt == attempts - 1:
+                    raise
+        return []
+
+    def used_bits(self):
+        return set(self.model.objects.exclude(bit=None).values_list(
+            'bit', flat=True))
+
+    def assign_free_bits(self):
+        # Бит тега - его позиция в Recipe.tags_mask. Тегам сверх
+        # TAG_MASK_BITS бит не достается, для них фильтр идет через JOIN.
+        used = self.used_bits()
+        free = (bit for bit in range(TAG_MASK_BITS) if bit not in used)
+        tags = []
+        for tag, bit in zip(self.filter(bit=None).order_by('id'), free):
+            tag.bit = bit
+            tags.append(tag)
+        self.model.objects.bulk_update(tags, ['bit'])
+        return tags
+
+
 class Tag(models.Model):
     name = models.CharField('Тег', max_length=200, unique=True,)
     color = models.CharField(
@@ -35,6 +87,10 @@ class Tag(models.Model):
         help_text=(u'HEX color, as #RRGGBB')
     )
     slug = models.SlugField("Slug", unique=True, max_length=200)
+    bit = models.PositiveSmallIntegerField(
+        'Бит в маске тегов', null=True, unique=True, editable=False)
+
+    objects = TagQuerySet.as_manager()
 
     class Meta:
         ordering = ['id']
@@ -44,12 +100,243 @@ class Tag(models.Model):
     def __str__(self):
         return self.name
 
+    @property
+    def mask(self):
+        return None if self.bit is None else 1 << self.bit
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        if self.bit is None:
+            assigned = Tag.objects.filter(pk=self.pk).assign_bits()
+            if assigned:
+                self.bit = assigned[0].bit
+
+
+SEARCH_CONFIG = 'russian'
+SEARCH_FTS_TABLE = 'recipes_recipe_fts'
+SEARCH_BATCH_SIZE = 1000
+WORD = re.compile(r'\w+')
+TRENDING_FAVORITE_WEIGHT = 1.0
+TRENDING_CART_WEIGHT = 0.5
+TRENDING_BATCH_SIZE = 1000
+
+
+def fts_text(text):
+    # unicode61 не считает «ё» вариантом «е».
+    return text.replace('ё', 'е').replace('Ё', 'Е')
+
+
+def fts_match(query):
+    return ' '.join(f'"{word}"*' for word in WORD.findall(fts_text(query)))
+
+
+def delete_fts_rows(cursor, recipe_ids):
+    cursor.execute(
+        f'DELETE FROM {SEARCH_FTS_TABLE} WHERE rowid IN '
+        f'({", ".join(["%s"] * len(recipe_ids))})',
+        list(recipe_ids)
+    )
+
+
+def matching_masks(bits, mask, match_all=False):
+    masks = []
+    for subset in range(1 << len(bits)):
+        value = 0
+        for index, bit in enumerate(bits):
+            if subset & (1 << index):
+                value |= 1 << bit
+        if (value & mask == mask) if match_all else (value & mask):
+            masks.append(value)
+    return masks
+
+
+class RecipeQuerySet(CounterQuerySetMixin, models.QuerySet):
+
+    def get_counters(self):
+        return {
+            'favorites_count': related_count(Favorite, 'recipe'),
+            'shopping_cart_count': related_count(ShoppingCart, 'recipe'),
+        }
+
+    def with_user_flags(self, user):
+        if user is None or user.is_anonymous:
+            return self.annotate(
+                is_favorited=Value(False, output_field=BooleanField()),
+                is_in_shopping_cart=Value(False, output_field=BooleanField()),
+            )
+        return self.annotate(
+            is_favorited=Exists(Favorite.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+            is_in_shopping_cart=Exists(ShoppingCart.objects.filter(
+                user=user, recipe=OuterRef('pk'))),
+        )
+
+    def with_related(self, user):
+        return self.prefetch_related(
+            Prefetch(
+                'author',
+                queryset=CustomUser.objects.with_is_subscribed(user)
+            ),
+            'tags',
+            Prefetch(
+                'recipes_ingredients_list',
+                queryset=IngredientAmount.objects.select_related(
+                    'ingredient')
+            ),
+        )
+
+    def for_list(self, user):
+        return self.with_user_flags(user).with_related(user)
+
+    def with_tags(self, tags, match_all=False):
+        tags = list(tags)
+        if not tags:
+            return self
+        if any(tag.bit is None for tag in tags):
+            return self.with_tags_join(tags, match_all)
+        mask = 0
+        for tag in tags:
+            mask |= tag.mask
+        bits = list(Tag.objects.exclude(bit=None).values_list(
+            'bit', flat=True))
+        if len(bits) <= TAG_MASK_IN_LIMIT:
+            # Тегов немного: перечисляем все подходящие маски и фильтруем
+            # по индексированной колонке без побитовых операций.
+            return self.filter(
+                tags_mask__in=matching_masks(bits, mask, match_all))
+        # Дальше число масок растет как 2 ** len(bits), и фильтр идет
+        # через bitand: индекс по tags_mask ему не помогает, это полный
+        # просмотр таблицы рецептов (без JOIN и DISTINCT, но линейный по
+        # числу рецептов). При большом каталоге и десятках тегов фильтр
+        # по редким тегам дешевле через with_tags_join.
+        queryset = self.annotate(tags_hit=F('tags_mask').bitand(mask))
+        if match_all:
+            return queryset.filter(tags_hit=mask)
+        return queryset.exclude(tags_hit=0)
+
+    def with_tags_join(self, tags, match_all=False):
+        if not match_all:
+            return self.filter(tags__in=tags).distinct()
+        queryset = self
+        for tag in tags:
+            queryset = queryset.filter(tags=tag)
+        return queryset
+
+    def update_derived_fields(self):
+        self.update_tags_mask()
+        self.update_search_documents()
+
+    def update_tags_mask(self):
+        recipe_ids = list(self.values_list('pk', flat=True))
+        masks = dict.fromkeys(recipe_ids, 0)
+        for recipe_id, bit in TagRecipe.objects.filter(
+                recipe_id__in=recipe_ids).exclude(
+                    tag__bit=None).values_list('recipe_id', 'tag__bit'):
+            masks[recipe_id] |= 1 << bit
+        self.model.objects.bulk_update(
+            [self.model(pk=recipe_id, tags_mask=mask)
+             for recipe_id, mask in masks.items()],
+            ['tags_mask'],
+        )
+
+    def trending(self):
+        return self.order_by('-trending_score', 'id')
+
+    def update_trending_scores(self, now=None):
+        # Каждое добавление в избранное или список покупок весит тем
+        # меньше, чем оно старше: вес падает вдвое за период полураспада.
+        # Между пересчетами все оценки убывают одинаково, поэтому порядок
+        # выдачи меняют только новые события.
+        now = now or timezone.now()
+        half_life = getattr(settings, 'TRENDING_HALF_LIFE_HOURS', 72) * 3600
+        since = now - timedelta(
+            days=getattr(settings, 'TRENDING_WINDOW_DAYS', 14))
+        scores = defaultdict(float)
+        for model, weight in ((Favorite, TRENDING_FAVORITE_WEIGHT),
+                              (ShoppingCart, TRENDING_CART_WEIGHT)):
+            for recipe_id, created in model.objects.filter(
+                    recipe__in=self, created__gte=since).values_list(
+                        'recipe_id', 'created').iterator():
+                age = (now - created).total_seconds()
+                scores[recipe_id] += weight * 0.5 ** (age / half_life)
+        with transaction.atomic(using=self.db):
+            self.exclude(trending_score=0).update(trending_score=0)
+            self.model.objects.bulk_update(
+                [self.model(pk=recipe_id, trending_score=score)
+                 for recipe_id, score in scores.items()],
+                ['trending_score'],
+                batch_size=TRENDING_BATCH_SIZE,
+            )
+        return len(scores)
+
+    def search(self, query):
+        vendor = connections[self.db].vendor
+        if vendor == 'postgresql':
+            query = SearchQuery(query, config=SEARCH_CONFIG)
+            return self.filter(search_vector=query).annotate(
+                search_rank=SearchRank(F('search_vector'), query)
+            ).order_by('-search_rank', 'id')
+        if vendor == 'sqlite':
+            match = fts_match(query)
+            if not match:
+                return self.none()
+            table = self.model._meta.db_table
+            # rank (bm25 с весами из миграции) тем меньше, чем лучше
+            # совпадение. В SELECT его не выносим: в COUNT(*) по подзапросу
+            # SQLite не даёт вызывать функции ранжирования.
+            return self.extra(
+                tables=[SEARCH_FTS_TABLE],
+                where=[f'{SEARCH_FTS_TABLE} MATCH %s',
+                       f'{SEARCH_FTS_TABLE}.rowid = {table}.id'],
+                params=[match],
+                order_by=[f'{SEARCH_FTS_TABLE}.rank', 'id'],
+            )
+        return self.filter(
+            Q(name__icontains=query) | Q(search_document__icontains=query))
+
+    def update_search_documents(self):
+        recipe_ids = list(self.values_list('pk', flat=True))
+        for start in range(0, len(recipe_ids), SEARCH_BATCH_SIZE):
+            self.model.objects.filter(
+                pk__in=recipe_ids[start:start + SEARCH_BATCH_SIZE]
+            )._update_search_batch()
+
+    def _update_search_batch(self):
+        recipes = list(self.only('id', 'name', 'text'))
+        names = defaultdict(list)
+        for recipe_id, name in IngredientAmount.objects.filter(
+                recipe__in=recipes).order_by('id').values_list(
+                    'recipe_id', 'ingredient__name'):
+            names[recipe_id].append(name)
+        for recipe in recipes:
+            recipe.search_document = '\n'.join(
+                [recipe.text, *names[recipe.pk]])
+        self.model.objects.bulk_update(recipes, ['search_document'])
+        connection = connections[self.db]
+        if connection.vendor == 'postgresql':
+            self.update(search_vector=(
+                SearchVector('name', weight='A', config=SEARCH_CONFIG)
+                + SearchVector('search_document', weight='B',
+                               config=SEARCH_CONFIG)
+            ))
+        elif connection.vendor == 'sqlite':
+            with connection.cursor() as cursor:
+                delete_fts_rows(cursor, [recipe.pk for recipe in recipes])
+                cursor.executemany(
+                    f'INSERT INTO {SEARCH_FTS_TABLE} '
+                    '(rowid, name, search_document) VALUES (%s, %s, %s)',
+                    [(recipe.pk, fts_text(recipe.name),
+                      fts_text(recipe.search_document))
+                     for recipe in recipes]
+                )
+
 
 class Recipe(models.Model):
     author = models.ForeignKey(
         CustomUser,
         on_delete=models.CASCADE,
         null=True,
+        db_index=False,
         related_name='recipes',
         verbose_name='Автор',
     )
@@ -63,6 +350,13 @@ class Recipe(models.Model):
         upload_to='image/',
         verbose_name='Изображение',
     )
+    image_variants_source = models.CharField(
+        max_length=100,
+        blank=True,
+        default='',
+        editable=False,
+        verbose_name='Изображение, для которого созданы превью',
+    )
     text = models.TextField(
         verbose_name='Описание',
         help_text='Добавьте описание рецепта'
@@ -91,11 +385,36 @@ class Recipe(models.Model):
         related_name='recipes',
         verbose_name='Теги',
     )
+    favorites_count = models.PositiveIntegerField(
+        'В избранном', default=0, editable=False)
+    shopping_cart_count = models.PositiveIntegerField(
+        'В списках покупок', default=0, editable=False)
+    search_document = models.TextField(
+        'Текст для поиска', blank=True, default='', editable=False)
+    search_vector = SearchVectorField(null=True, editable=False)
+    tags_mask = models.BigIntegerField(
+        'Маска тегов', default=0, db_index=True, editable=False)
+    trending_score = models.FloatField(
+        'Популярность сейчас', default=0, editable=False)
+
+    objects = RecipeQuerySet.as_manager()
 
     class Meta:
         ordering = ['id']
         verbose_name = 'Рецепт'
         verbose_name_plural = 'Рецепты'
+        indexes = [
+            models.Index(
+                fields=['-trending_score', 'id'],
+                name='recipe_trending_idx'
+            ),
+            # Заменяет обычный индекс внешнего ключа: рецепты автора
+            # выбираются сразу в порядке выдачи.
+            models.Index(
+                fields=['author', 'id'],
+                name='recipe_author_feed_idx'
+            ),
+        ]
 
     def __str__(self):
         return self.name
@@ -170,6 +489,10 @@ class ShoppingCart(models.Model):
         related_name='shopping_cart',
         verbose_name='Товар'
     )
+    created = models.DateTimeField(
+        'Добавлено', auto_now_add=True, db_index=True)
+
+    objects = UniqueRelationQuerySet.as_manager()
 
     class Meta:
         ordering = ['id']
@@ -196,6 +519,10 @@ class Favorite(models.Model):
         blank=True,
         verbose_name='Рецепт в избранном'
     )
+    created = models.DateTimeField(
+        'Добавлено', auto_now_add=True, db_index=True)
+
+    objects = UniqueRelationQuerySet.as_manager()
 
     class Meta:
         ordering = ['id']
@@ -209,3 +536,158 @@ class Favorite(models.Model):
     def __str__(self):
         return (f'{self.user.username} '
                 + f'добавил в избранное {self.recipe.name}')
+
+
+class ShoppingListItemManager(models.Manager):
+
+    def recipe_amounts(self, recipe_id):
+        return dict(IngredientAmount.objects.filter(
+            recipe_id=recipe_id).values_list('ingredient_id', 'amount'))
+
+    def apply_deltas(self, user_ids, deltas):
+        user_ids = sorted(set(user_ids))
+        deltas = {key: value for key, value in deltas.items() if value}
+        if not user_ids or not deltas:
+            return
+        # INSERT ... ON CONFLICT DO UPDATE создает или меняет строку
+        # атомарно: добавление, пришедшее одновременно с удалением, которое
+        # обнулило строку, либо дождется его и вставит строку заново, либо
+        # прибавится до удаления. Отдельный UPDATE в этом случае не нашел
+        # бы строку и потерял прибавку. Нулевые строки удаляются следом.
+        connection = connections[self.db]
+        quote = connection.ops.quote_name
+        table = quote(self.model._meta.db_table)
+        user, ingredient, amount = (
+            quote(self.model._meta.get_field(name).column)
+            for name in ('user', 'ingredient', 'amount'))
+        rows = [
+            (user_id, ingredient_id, deltas[ingredient_id])
+            for user_id in user_ids for ingredient_id in sorted(deltas)
+        ]
+        batch_size = connection.ops.bulk_batch_size(
+            ['user', 'ingredient', 'amount'], rows)
+        with connection.cursor() as cursor:
+            for start in range(0, len(rows), batch_size):
+                batch = rows[start:start + batch_size]
+                cursor.execute(
+                    f'INSERT INTO {table} ({user}, {ingredient}, {amount}) '
+                    'VALUES ' + ', '.join(['(%s, %s, %s)'] * len(batch))
+                    + f' ON CONFLICT ({user}, {ingredient}) DO UPDATE '
+                    f'SET {amount} = {table}.{amount} + EXCLUDED.{amount}',
+                    [param for row in batch for param in row],
+                )
+        if any(delta < 0 for delta in deltas.values()):
+            self.filter(user_id__in=user_ids, ingredient_id__in=deltas,
+                        amount__lte=0).delete()
+
+    def add_recipe(self, user_id, recipe_id):
+        self.apply_deltas([user_id], self.recipe_amounts(recipe_id))
+
+    def remove_recipe(self, user_id, recipe_id):
+        self.apply_deltas([user_id], {
+            ingredient_id: -amount for ingredient_id, amount
+            in self.recipe_amounts(recipe_id).items()
+        })
+
+    def recipes_amounts(self, recipe_ids):
+        return dict(IngredientAmount.objects.filter(
+            recipe_id__in=recipe_ids).values_list('ingredient_id').annotate(
+                total=Sum('amount')).order_by())
+
+    def add_recipes(self, user_id, recipe_ids):
+        if recipe_ids:
+            self.apply_deltas([user_id], self.recipes_amounts(recipe_ids))
+
+    def change_recipe(self, recipe, old_amounts, new_amounts):
+        deltas = {
+            ingredient_id: (new_amounts.get(ingredient_id, 0)
+                            - old_amounts.get(ingredient_id, 0))
+            for ingredient_id in set(old_amounts) | set(new_amounts)
+        }
+        user_ids = ShoppingCart.objects.filter(
+            recipe=recipe).values_list('user_id', flat=True)
+        self.apply_deltas(user_ids, deltas)
+
+    def cart_totals(self, user_ids=None):
+        lookup = {'recipe__shopping_cart__isnull': False}
+        if user_ids is not None:
+            lookup = {'recipe__shopping_cart__user_id__in': user_ids}
+        return IngredientAmount.objects.filter(**lookup).values(
+            'ingredient_id', user_id=F('recipe__shopping_cart__user_id')
+        ).annotate(total=Sum('amount')).order_by()
+
+    def rebuild(self, user_ids=None):
+        items = self.all()
+        if user_ids is not None:
+            items = items.filter(user_id__in=user_ids)
+        items.delete()
+        self.bulk_create(
+            (self.model(user_id=row['user_id'],
+                        ingredient_id=row['ingredient_id'],
+                        amount=row['total'])
+             for row in self.cart_totals(user_ids).iterator()),
+        )
+
+
+class ShoppingListItem(models.Model):
+    user = models.ForeignKey(
+        CustomUser,
+        on_delete=models.CASCADE,
+        related_name='shopping_list',
+        verbose_name='Покупатель'
+    )
+    ingredient = models.ForeignKey(
+        Ingredient,
+        on_delete=models.CASCADE,
+        related_name='shopping_list',
+        verbose_name='Ингредиент'
+    )
+    amount = models.IntegerField(verbose_name='Количество')
+
+    objects = ShoppingListItemManager()
+
+    class Meta:
+        ordering = ['id']
+        verbose_name = 'Позиция списка покупок'
+        verbose_name_plural = 'Позиции списков покупок'
+        constraints = [models.UniqueConstraint(
+            fields=['user', 'ingredient'],
+            name='shopping_list_item_unique'
+        )]
+
+    def __str__(self):
+        return f'{self.user} - {self.ingredient} - {self.amount}'
+
+
+class SimilarRecipe(models.Model):
+    # Заранее посчитанные соседи рецепта по ингредиентам и тегам,
+    # см. recipes/similarity.py.
+    recipe = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='similar_recipes',
+        verbose_name='Рецепт'
+    )
+    similar = models.ForeignKey(
+        Recipe,
+        on_delete=models.CASCADE,
+        related_name='similar_to',
+        verbose_name='Похожий рецепт'
+    )
+    score = models.FloatField(verbose_name='Сходство')
+
+    class Meta:
+        ordering = ['recipe', '-score', 'similar']
+        verbose_name = 'Похожий рецепт'
+        verbose_name_plural = 'Похожие рецепты'
+        constraints = [models.UniqueConstraint(
+            fields=['recipe', 'similar'],
+            name='similar_recipe_unique'
+        )]
+        indexes = [models.Index(
+            fields=['recipe', '-score'],
+            name='similar_recipe_score_idx'
+        )]
+
+    def __str__(self):
+        return f'{self.recipe_id} ~ {self.similar_id}: {self.score:.2f}'
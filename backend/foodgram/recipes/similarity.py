@@ -0,0 +1,239 @@
+import heapq
+from collections import Counter, defaultdict
+from itertools import islice
+
+from django.conf import settings
+from django.db import transaction
+from django.db.models import Count, Min, Q
+
+from .images import schedule_recipe_task
+from .models import IngredientAmount, SimilarRecipe, TagRecipe
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+SIMILAR_BATCH_SIZE = 1000
+SIMILAR_CANDIDATE_BATCH = 200
+
+
+def get_similar_limit():
+    return getattr(settings, 'SIMILAR_RECIPES_LIMIT', 10)
+
+
+def ranked(scored, limit):
+    # При равном сходстве выше рецепт с меньшим id.
+    return heapq.nlargest(limit, scored, key=lambda item: (item[0], -item[1]))
+
+
+def feature_rows(recipe_ids=None):
+    # Ингредиенты и теги в одном пространстве признаков:
+    # четные ключи - ингредиенты, нечетные - теги.
+    ingredients = IngredientAmount.objects.values_list(
+        'recipe_id', 'ingredient_id').order_by()
+    tags = TagRecipe.objects.values_list('recipe_id', 'tag_id').order_by()
+    if recipe_ids is not None:
+        ingredients = ingredients.filter(recipe_id__in=recipe_ids)
+        tags = tags.filter(recipe_id__in=recipe_ids)
+    for recipe_id, ingredient_id in ingredients.iterator():
+        yield recipe_id, ingredient_id * 2
+    for recipe_id, tag_id in tags.iterator():
+        yield recipe_id, tag_id * 2 + 1
+
+
+def batches(values, size=SIMILAR_BATCH_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+
+def feature_sizes(recipe_ids):
+    sizes = Counter()
+    for batch in batches(recipe_ids):
+        for model in (IngredientAmount, TagRecipe):
+            sizes.update(dict(model.objects.filter(
+                recipe_id__in=batch).values_list('recipe_id').annotate(
+                    total=Count('id')).order_by()))
+    return sizes
+
+
+def similar_lists(recipe_ids):
+    # Худшее сходство и длина текущих списков соседей рецептов.
+    lists = {}
+    for batch in batches(recipe_ids):
+        lists.update(
+            (row['recipe_id'], row)
+            for row in SimilarRecipe.objects.filter(
+                recipe_id__in=batch).values('recipe_id').annotate(
+                    worst=Min('score'), total=Count('id')).order_by()
+        )
+    return lists
+
+
+def iter_neighbors(features, limit):
+    """Для каждого рецепта до limit соседей по коэффициенту Жаккара.
+
+    Пересечения считаются по спискам рецептов каждого признака, как в
+    RecipeMatchIndex: сравниваются только рецепты с общими признаками.
+    Возвращает тройки (recipe_id, similar_id, score).
+    """
+    recipe_ids = sorted(features)
+    positions = {recipe_id: index
+                 for index, recipe_id in enumerate(recipe_ids)}
+    postings = defaultdict(list)
+    for recipe_id in recipe_ids:
+        for feature in features[recipe_id]:
+            postings[feature].append(positions[recipe_id])
+    if numpy is None:
+        for recipe_id in recipe_ids:
+            own = features[recipe_id]
+            hits = Counter()
+            for feature in own:
+                hits.update(postings[feature])
+            hits.pop(positions[recipe_id])
+            scored = (
+                (shared / (len(own) + len(features[recipe_ids[position]])
+                           - shared), recipe_ids[position])
+                for position, shared in hits.items()
+            )
+            for score, similar_id in ranked(scored, limit):
+                yield recipe_id, similar_id, score
+        return
+    postings = {feature: numpy.array(value, dtype=numpy.int32)
+                for feature, value in postings.items()}
+    ids = numpy.array(recipe_ids, dtype=numpy.int64)
+    sizes = numpy.array([len(features[recipe_id])
+                         for recipe_id in recipe_ids], dtype=numpy.float64)
+    for position, recipe_id in enumerate(recipe_ids):
+        hits = numpy.bincount(
+            numpy.concatenate([postings[feature]
+                               for feature in features[recipe_id]]),
+            minlength=len(recipe_ids))
+        hits[position] = 0
+        candidates = numpy.flatnonzero(hits)
+        shared = hits[candidates]
+        scores = shared / (sizes[position] + sizes[candidates] - shared)
+        if len(candidates) > limit:
+            # Оставляем всех, кто не хуже limit-го, чтобы при равенстве
+            # выбор не зависел от порядка argpartition.
+            keep = scores >= numpy.partition(scores, -limit)[-limit]
+            candidates, scores = candidates[keep], scores[keep]
+        order = numpy.lexsort((ids[candidates], -scores))[:limit]
+        for similar_id, score in zip(ids[candidates[order]].tolist(),
+                                     scores[order].tolist()):
+            yield recipe_id, similar_id, score
+
+
+def rebuild_similar_recipes(limit=None):
+    limit = limit or get_similar_limit()
+    features = defaultdict(set)
+    for recipe_id, feature in feature_rows():
+        features[recipe_id].add(feature)
+    rows = iter_neighbors(features, limit)
+    total = 0
+    with transaction.atomic():
+        SimilarRecipe.objects.all().delete()
+        while True:
+            batch = [
+                SimilarRecipe(recipe_id=recipe_id, similar_id=similar_id,
+                              score=score)
+                for recipe_id, similar_id, score in islice(
+                    rows, SIMILAR_BATCH_SIZE)
+            ]
+            if not batch:
+                break
+            SimilarRecipe.objects.bulk_create(batch)
+            total += len(batch)
+    return total
+
+
+def shared_counts(model, field, values, recipe_ids=None):
+    rows = model.objects.filter(**{f'{field}__in': values})
+    if recipe_ids is not None:
+        rows = rows.filter(recipe_id__in=recipe_ids)
+    return Counter(dict(rows.values_list('recipe_id').annotate(
+        total=Count('id')).order_by()))
+
+
+@transaction.atomic
+def update_similar_recipes(recipe_id, limit=None):
+    # Пересчитывает соседей одного рецепта и добавляет его в списки
+    # тех рецептов, где он проходит в топ, вытесняя из них худших.
+    # Чужие списки поддерживаются приближенно: если рецепт из списка
+    # выпал, вытесненный им раньше сосед туда не вернется. Точные списки
+    # восстанавливает полная пересборка build_similar.
+    limit = limit or get_similar_limit()
+    own = {feature for _, feature in feature_rows([recipe_id])}
+    SimilarRecipe.objects.filter(
+        Q(recipe_id=recipe_id) | Q(similar_id=recipe_id)).delete()
+    if not own:
+        return
+    ingredients = [feature // 2 for feature in own if feature % 2 == 0]
+    tags = [feature // 2 for feature in own if feature % 2]
+    # Кандидаты - рецепты с общими ингредиентами (если их нет - с общими
+    # тегами), от большего числа общих к меньшему. Сходство не выше
+    # общих / len(own), поэтому перебор заканчивается, когда эта оценка
+    # для следующей пачки не лучше limit-го найденного: запросы идут
+    # только по пачкам кандидатов, а не по всему каталогу. Соседей
+    # только по тегам находит полная пересборка.
+    if ingredients:
+        primary = shared_counts(IngredientAmount, 'ingredient_id', ingredients)
+        extra_tags = tags
+    else:
+        primary = shared_counts(TagRecipe, 'tag_id', tags)
+        extra_tags = []
+    primary.pop(recipe_id, None)
+    candidates = sorted(primary, key=lambda pk: (-primary[pk], pk))
+    scored = []
+    lists = {}
+    for batch in batches(candidates, SIMILAR_CANDIDATE_BATCH):
+        best = ranked(scored, limit)
+        bound = (primary[batch[0]] + len(extra_tags)) / len(own)
+        if len(best) == limit and bound <= best[-1][0]:
+            break
+        shared = Counter({pk: primary[pk] for pk in batch})
+        if extra_tags:
+            shared.update(shared_counts(
+                TagRecipe, 'tag_id', extra_tags, batch))
+        sizes = feature_sizes(batch)
+        scored.extend(
+            (count / (len(own) + sizes[similar_id] - count), similar_id)
+            for similar_id, count in shared.items())
+        lists.update(similar_lists(batch))
+    rows = [
+        SimilarRecipe(recipe_id=recipe_id, similar_id=similar_id, score=score)
+        for score, similar_id in ranked(scored, limit)
+    ]
+    full = []
+    for score, similar_id in scored:
+        current = lists.get(similar_id)
+        if (current is None or current['total'] < limit
+                or score > current['worst']):
+            rows.append(SimilarRecipe(
+                recipe_id=similar_id, similar_id=recipe_id, score=score))
+            if current is not None and current['total'] >= limit:
+                full.append(similar_id)
+    SimilarRecipe.objects.bulk_create(rows, ignore_conflicts=True)
+    trim_similar_lists(full, limit)
+
+
+def trim_similar_lists(recipe_ids, limit):
+    # Оставляет в списках соседей этих рецептов limit лучших
+    # в том же порядке, что и ranked().
+    extra = []
+    for batch in batches(recipe_ids):
+        lists = defaultdict(list)
+        for pk, recipe_id, similar_id, score in SimilarRecipe.objects.filter(
+                recipe_id__in=batch).values_list(
+                    'pk', 'recipe_id', 'similar_id', 'score'):
+            lists[recipe_id].append((score, similar_id, pk))
+        for items in lists.values():
+            items.sort(key=lambda item: (-item[0], item[1]))
+            extra.extend(pk for _, _, pk in items[limit:])
+    for batch in batches(extra):
+        SimilarRecipe.objects.filter(pk__in=batch).delete()
+
+
+def schedule_similar_update(recipe_id):
+    schedule_recipe_task(update_similar_recipes, recipe_id)
@@ -0,0 +1,353 @@
+import io
+import json
+import os
+import shutil
+import tempfile
+from datetime import timedelta
+from unittest import mock
+
+from django.contrib import admin
+from django.core.files.base import ContentFile
+from django.core.files.storage import default_storage
+from django.core.management import CommandError, call_command
+from django.db import connection
+from django.db.models import Count
+from django.test import TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from api import benchmark
+from users.models import CustomUser, Follow
+from .images import process_recipe_image, variant_names
+from .models import (TAG_MASK_IN_LIMIT, Favorite, Ingredient, IngredientAmount,
+                     Recipe, ShoppingCart, SimilarRecipe, Tag, TagQuerySet,
+                     TagRecipe)
+from .similarity import rebuild_similar_recipes, update_similar_recipes
+
+
+class TagMaskTest(TestCase):
+
+    def create_tags(self, count):
+        for index in range(count):
+            Tag.objects.create(name=f'Тег {index}', slug=f'tag-{index}',
+                               color=f'#{index:06x}')
+        return list(Tag.objects.order_by('id'))
+
+    def assertSameAsJoin(self, tags):
+        for match_all in (False, True):
+            with self.subTest(tags=tags, match_all=match_all):
+                self.assertEqual(
+                    set(Recipe.objects.with_tags(tags, match_all)),
+                    set(Recipe.objects.with_tags_join(tags, match_all)),
+                )
+
+    def create_tagged_recipes(self, count):
+        # Рецепт с номером i получает теги, соответствующие битам i.
+        tags = self.create_tags(count)
+        benchmark.seed(users=2, recipes=40, ingredients=10, tags=0,
+                       favorites=0, carts=0, follows=0)
+        TagRecipe.objects.all().delete()
+        TagRecipe.objects.bulk_create(
+            TagRecipe(recipe=recipe, tag=tag)
+            for index, recipe in enumerate(Recipe.objects.order_by('id'))
+            for bit, tag in enumerate(tags) if index & (1 << bit)
+        )
+        Recipe.objects.update_tags_mask()
+        return tags
+
+    def test_mask_list_matches_join(self):
+        tags = self.create_tagged_recipes(TAG_MASK_IN_LIMIT)
+        self.assertSameAsJoin(tags[:1])
+        self.assertSameAsJoin(tags[1:4])
+
+    def test_bitand_matches_join(self):
+        tags = self.create_tagged_recipes(TAG_MASK_IN_LIMIT + 2)
+        self.assertSameAsJoin(tags[:1])
+        self.assertSameAsJoin(tags[1:4])
+
+    def test_concurrent_bit_retry(self):
+        # Другой процесс занял бит 0 уже после того, как assign_bits
+        # прочитал занятые биты: запись упирается в уникальный индекс,
+        # и со второй попытки тегу достается следующий свободный бит.
+        first, second = self.create_tags(2)
+        Tag.objects.filter(pk=second.pk).update(bit=None)
+        self.assertEqual(Tag.objects.get(pk=first.pk).bit, 0)
+        with mock.patch.object(TagQuerySet, 'used_bits', autospec=True,
+                               side_effect=[set(), {0}]):
+            assigned = Tag.objects.filter(pk=second.pk).assign_bits()
+        self.assertEqual([tag.bit for tag in assigned], [1])
+        self.assertEqual(Tag.objects.get(pk=second.pk).bit, 1)
+
+
+class SimilarRecipesTest(TestCase):
+    limit = 2
+
+    def setUp(self):
+        benchmark.seed(users=2, recipes=6, ingredients=6, tags=0,
+                       favorites=0, carts=0, follows=0)
+        IngredientAmount.objects.all().delete()
+        self.recipe, *self.others = Recipe.objects.order_by('id')
+        shared, *own = Ingredient.objects.order_by('id')
+        # Остальные рецепты похожи друг на друга на 1/3, а рецепт,
+        # у которого останется только общий ингредиент, на 1/2.
+        IngredientAmount.objects.bulk_create(
+            IngredientAmount(recipe=recipe, ingredient=ingredient, amount=1)
+            for recipe, extra in zip(self.others, own)
+            for ingredient in (shared, extra)
+        )
+        IngredientAmount.objects.create(
+            recipe=self.recipe, ingredient=shared, amount=1)
+
+    def similar(self):
+        return {
+            recipe_id: list(
+                SimilarRecipe.objects.filter(recipe_id=recipe_id)
+                .order_by('-score', 'similar_id')
+                .values_list('similar_id', 'score'))
+            for recipe_id in Recipe.objects.values_list('id', flat=True)
+        }
+
+    def test_incremental_update_trims_neighbours(self):
+        IngredientAmount.objects.filter(recipe=self.recipe).delete()
+        rebuild_similar_recipes(self.limit)
+        self.assertEqual(self.similar()[self.recipe.id], [])
+        IngredientAmount.objects.create(
+            recipe=self.recipe,
+            ingredient=Ingredient.objects.order_by('id').first(), amount=1)
+        update_similar_recipes(self.recipe.id, self.limit)
+        self.assertLessEqual(
+            SimilarRecipe.objects.values('recipe_id')
+            .annotate(total=Count('id'))
+            .order_by('-total').values_list('total', flat=True)[0],
+            self.limit)
+        updated = self.similar()
+        rebuild_similar_recipes(self.limit)
+        self.assertEqual(updated, self.similar())
+
+
+class RecipeImageVariantsTest(TransactionTestCase):
+
+    def setUp(self):
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root)
+        settings = override_settings(
+            MEDIA_ROOT=media_root, RECIPE_IMAGE_ASYNC=False)
+        settings.enable()
+        self.addCleanup(settings.disable)
+        author = CustomUser.objects.create_user(
+            email='cook@example.com', username='cook', password='pass')
+        self.recipe = Recipe.objects.create(
+            author=author, name='Рецепт', text='Текст', cooking_time=1)
+
+    def set_image(self, name):
+        buffer = io.BytesIO()
+        Image.new('RGB', (1600, 900), 'red').save(buffer, format='PNG')
+        self.recipe.image.save(name, ContentFile(buffer.getvalue()))
+        process_recipe_image(self.recipe.pk)
+        self.recipe.refresh_from_db()
+        return self.recipe.image.name
+
+    def variant_files(self, source_name):
+        return [
+            name
+            for formats in variant_names(source_name, 'PNG').values()
+            for name in formats.values()
+        ]
+
+    def assertVariantsExist(self, source_name, exist=True):
+        for name in self.variant_files(source_name):
+            with self.subTest(name=name):
+                self.assertEqual(default_storage.exists(name), exist)
+
+    def test_variants_follow_image(self):
+        first = self.set_image('first.png')
+        self.assertEqual(self.recipe.image_variants_source, first)
+        self.assertVariantsExist(first)
+        with default_storage.open(self.variant_files(first)[0]) as file:
+            self.assertEqual(Image.open(file).size, (480, 270))
+        second = self.set_image('second.png')
+        self.assertEqual(self.recipe.image_variants_source, second)
+        self.assertVariantsExist(second)
+        self.assertVariantsExist(first, exist=False)
+        self.recipe.delete()
+        self.assertVariantsExist(second, exist=False)
+
+
+class ImportIngredientsTest(TestCase):
+
+    def setUp(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        self.directory = directory
+        Ingredient.objects.create(name='соль', measurement_unit='г')
+
+    def write(self, name, content):
+        path = os.path.join(self.directory, name)
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        return path
+
+    def import_ingredients(self, *paths, **options):
+        stdout = io.StringIO()
+        call_command('import_ingredients', *paths, stdout=stdout, **options)
+        return stdout.getvalue()
+
+    def ingredients(self):
+        return set(Ingredient.objects.values_list(
+            'name', 'measurement_unit'))
+
+    def test_import_formats(self):
+        paths = [
+            self.write('a.csv', 'name,measurement_unit\n'
+                                'соль,г\n мука , г\nмука,г\n,шт\n'),
+            self.write('b.json', json.dumps([
+                {'model': 'recipes.ingredient',
+                 'fields': {'name': 'сахар', 'measurement_unit': 'г'}},
+                {'model': 'recipes.tag',
+                 'fields': {'name': 'завтрак', 'measurement_unit': '-'}},
+            ])),
+            self.write('c.jsonl', json.dumps(
+                {'name': 'яйцо', 'measurement_unit': 'шт'}) + '\n\n'),
+        ]
+        output = self.import_ingredients(*paths, batch_size=1)
+        self.assertEqual(self.ingredients(), {
+            ('соль', 'г'), ('мука', 'г'), ('сахар', 'г'), ('яйцо', 'шт')})
+        self.assertIn('Загружено 3 новых ингредиентов из 4', output)
+        self.assertIn('пропущено некорректных строк: 1', output)
+        output = self.import_ingredients(*paths)
+        self.assertIn('Загружено 0 новых ингредиентов', output)
+        self.assertEqual(Ingredient.objects.count(), 4)
+
+    def test_unknown_format(self):
+        path = self.write('a.txt', 'соль,г\n')
+        with self.assertRaises(CommandError):
+            self.import_ingredients(path)
+        self.import_ingredients(path, format='csv')
+        self.assertEqual(self.ingredients(), {('соль', 'г')})
+
+
+class CountersTest(TestCase):
+
+    def setUp(self):
+        self.author, self.reader = (
+            CustomUser.objects.create_user(
+                email=f'user{index}@example.com', username=f'user{index}',
+                password='pass')
+            for index in range(2))
+        self.recipe = Recipe.objects.create(
+            author=self.author, name='Рецепт', text='Текст', cooking_time=1)
+
+    def counters(self):
+        recipe = Recipe.objects.get(pk=self.recipe.pk)
+        author = CustomUser.objects.get(pk=self.author.pk)
+        return (recipe.favorites_count, recipe.shopping_cart_count,
+                author.recipes_count, author.followers_count)
+
+    def recount(self, *args):
+        stdout = io.StringIO()
+        call_command('recount', *args, stdout=stdout)
+        return stdout.getvalue()
+
+    def test_signals_keep_counters(self):
+        favorite = Favorite.objects.create(
+            user=self.reader, recipe=self.recipe)
+        ShoppingCart.objects.create(user=self.reader, recipe=self.recipe)
+        Follow.objects.create(user=self.reader, author=self.author)
+        self.assertEqual(self.counters(), (1, 1, 1, 1))
+        favorite.delete()
+        self.reader.delete()
+        self.assertEqual(self.counters(), (0, 0, 1, 0))
+
+    def test_recount_fixes_drift(self):
+        Favorite.objects.create(user=self.reader, recipe=self.recipe)
+        Recipe.objects.update(favorites_count=5)
+        CustomUser.objects.filter(pk=self.author.pk).update(recipes_count=0)
+        output = self.recount('--check')
+        self.assertIn('favorites_count: сохранено 5, на самом деле 1', output)
+        self.assertIn('users: расхождений 1', output)
+        self.assertEqual(self.counters(), (5, 0, 0, 0))
+        self.recount()
+        self.assertEqual(self.counters(), (1, 0, 1, 0))
+        self.assertIn('recipes: расхождений 0', self.recount('--check'))
+
+
+class TrendingTest(TestCase):
+
+    def setUp(self):
+        benchmark.seed(users=3, recipes=3, ingredients=3, tags=0,
+                       favorites=0, carts=0, follows=0)
+        self.users = list(CustomUser.objects.order_by('id'))
+        self.recipes = list(Recipe.objects.order_by('id'))
+
+    def add(self, model, recipe, user, hours_ago):
+        obj = model.objects.create(user=user, recipe=recipe)
+        model.objects.filter(pk=obj.pk).update(
+            created=self.now - timedelta(hours=hours_ago))
+
+    def test_decayed_scores(self):
+        self.now = timezone.now()
+        first, second, third = self.recipes
+        self.add(Favorite, first, self.users[0], 0)
+        # Два избранных возрастом в период полураспада и свежая корзина.
+        self.add(Favorite, second, self.users[0], 72)
+        self.add(Favorite, second, self.users[1], 72)
+        self.add(ShoppingCart, second, self.users[2], 0)
+        # За пределами окна.
+        self.add(Favorite, third, self.users[0], 24 * 30)
+        Recipe.objects.filter(pk=third.pk).update(trending_score=5)
+        self.assertEqual(
+            Recipe.objects.update_trending_scores(now=self.now), 2)
+        self.assertEqual(
+            [(recipe.id, round(recipe.trending_score, 3))
+             for recipe in Recipe.objects.trending()],
+            [(second.id, 1.5), (first.id, 1.0), (third.id, 0)])
+
+
+class AdminQueriesTest(TestCase):
+    # Число запросов страниц админки не зависит от числа строк.
+
+    @classmethod
+    def setUpTestData(cls):
+        benchmark.seed(users=10, recipes=30, ingredients=40, tags=3,
+                       follows=3)
+        cls.admin = CustomUser.objects.create_superuser(
+            'admin@example.com', 'admin', 'password',
+            first_name='Admin', last_name='Admin')
+
+    def setUp(self):
+        self.client.force_login(self.admin)
+
+    def count_queries(self, url):
+        # Первый запрос прогревает кеш ContentType.
+        self.client.get(url)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelists(self):
+        for model in (Recipe, Ingredient, Follow, CustomUser):
+            url = reverse(f'admin:{model._meta.app_label}_'
+                          f'{model._meta.model_name}_changelist')
+            counts = []
+            for per_page in (2, 20):
+                with mock.patch.object(admin.site._registry[model],
+                                       'list_per_page', per_page):
+                    counts.append(self.count_queries(url))
+            with self.subTest(model=model.__name__):
+                self.assertEqual(counts[0], counts[1])
+
+    def test_recipe_change_page(self):
+        # Строки инлайна не запрашивают ингредиент каждая по отдельности.
+        first, second = Recipe.objects.order_by('id')[:2]
+        IngredientAmount.objects.filter(recipe=second).exclude(
+            pk=IngredientAmount.objects.filter(
+                recipe=second).values('pk')[:1]).delete()
+        counts = [
+            self.count_queries(
+                reverse('admin:recipes_recipe_change', args=[recipe.pk]))
+            for recipe in (first, second)
+        ]
+        self.assertEqual(counts[0], counts[1])
@@ -5,8 +5,10 @@ from .models import CustomUser
 
 @admin.register(CustomUser)
 class UserAdmin(admin.ModelAdmin):
-    list_filter = ('email', 'first_name')
+    list_filter = ('is_active', 'is_staff')
     search_fields = ('email', 'username')
     empty_value_display = '-пусто-'
+    show_full_result_count = False
     list_display = ('id', 'username', 'email', 'first_name',
-                    'last_name', 'is_staff')
+                    'last_name', 'is_staff', 'recipes_count',
+                    'followers_count')
@@ -1,7 +1,79 @@
+from django.apps import apps
 from django.contrib.auth.base_user import BaseUserManager
+from django.db import models
+from django.db.models import (BooleanField, Count, Exists, F, IntegerField,
+                              OuterRef, Prefetch, Q, Subquery, Value)
+from django.db.models.functions import Coalesce
 
+from foodgram.querysets import UniqueRelationQuerySet
 
-class CustomUserManager(BaseUserManager):
+
+def related_count(model, field):
+    return Coalesce(Subquery(
+        model.objects.filter(**{field: OuterRef('pk')}).order_by().values(
+            field).annotate(total=Count('pk')).values('total'),
+        output_field=IntegerField(),
+    ), 0)
+
+
+class CounterQuerySetMixin:
+    # Наследник задаёт get_counters(): {поле счётчика: подзапрос}.
+
+    def with_counter_drift(self):
+        counters = self.get_counters()
+        annotations = {
+            f'actual_{field}': expression
+            for field, expression in counters.items()
+        }
+        drift = Q()
+        for field in counters:
+            drift |= ~Q(**{field: F(f'actual_{field}')})
+        return self.annotate(**annotations).filter(drift)
+
+    def recount(self):
+        return self.update(**self.get_counters())
+
+
+class CustomUserQuerySet(CounterQuerySetMixin, models.QuerySet):
+
+    def get_counters(self):
+        recipe_model = apps.get_model('recipes', 'Recipe')
+        return {
+            'recipes_count': related_count(recipe_model, 'author'),
+            'followers_count': related_count(
+                self.model.following.field.model, 'author'),
+        }
+
+    def with_is_subscribed(self, user):
+        if user is None or user.is_anonymous:
+            return self.annotate(
+                is_subscribed=Value(False, output_field=BooleanField()))
+        follow_model = self.model.following.field.model
+        return self.annotate(is_subscribed=Exists(follow_model.objects.filter(
+            user=user, author=OuterRef('pk'))))
+
+
+def recipes_preview(recipes_limit=None):
+    recipe_model = apps.get_model('recipes', 'Recipe')
+    recipes = recipe_model.objects.order_by('id')
+    if recipes_limit is not None:
+        recipes = recipes.filter(pk__in=Subquery(
+            recipe_model.objects.filter(
+                author_id=OuterRef('author_id')
+            ).order_by('id').values('pk')[:recipes_limit]
+        ))
+    return Prefetch(
+        'author__recipes', queryset=recipes, to_attr='recipes_preview')
+
+
+class FollowQuerySet(UniqueRelationQuerySet):
+
+    def with_recipes(self, recipes_limit=None):
+        return self.select_related('author').prefetch_related(
+            recipes_preview(recipes_limit))
+
+
+class CustomUserManager(BaseUserManager.from_queryset(CustomUserQuerySet)):
     def _create_user(self, email, username, password, **extra_fields):
         if not email:
             raise ValueError('Заполните поле email')
@@ -2,7 +2,7 @@ from django.contrib.auth.models import AbstractUser
 from django.db import models
 from foodgram import settings
 
-from .managers import CustomUserManager
+from .managers import CustomUserManager, FollowQuerySet
 
 
 class CustomUser(AbstractUser):
@@ -15,6 +15,10 @@ class CustomUser(AbstractUser):
         verbose_name='Юзернейм')
     first_name = models.CharField('Имя', max_length=150)
     last_name = models.CharField('Фамилия', max_length=150)
+    recipes_count = models.PositiveIntegerField(
+        'Количество рецептов', default=0, editable=False)
+    followers_count = models.PositiveIntegerField(
+        'Количество подписчиков', default=0, editable=False)
 
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = ['username', 'first_name', 'last_name']
@@ -44,6 +48,8 @@ class Follow(models.Model):
         verbose_name='Автор'
     )
 
+    objects = FollowQuerySet.as_manager()
+
     class Meta:
         ordering = ['id']
         verbose_name = 'Подписка',